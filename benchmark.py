@@ -0,0 +1,426 @@
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import numpy as np
+import pandas as pd
+from sklearn.metrics import silhouette_score, davies_bouldin_score, calinski_harabasz_score, adjusted_rand_score
+import scipy.spatial.distance as ssd
+from scipy.stats import fisher_exact
+from clustr.utils import map_to_scale, get_bubble_heatmap_input, iter_data_chunks
+from clustr.scoring import get_scores
+from clustr.lca import LCA, CONVERGENCE_CRITERIA
+from clustr.precision import configure_precision
+from clustr.hier_agg_utils import get_distance_matrix
+from clustr.kernels import configure_kernels, e_step, m_step_sums, hamming_distances
+from clustr.sharded import write_shards
+from clustr.lca_utils import make_lca
+from clustr.kmodes_utils import fit_minibatch_kmodes
+from clustr.hamming_index import HammingIndex
+from clustr.readers import read_cohort, parse_filter
+from clustr.store import configure_store, get_store_settings, list_artifacts, evict
+from clustr.utils import get_arfs_prevalences, get_fischers_coefficients
+from clustr.cooccurrence import get_cluster_cooccurrences, get_cooccurrence_table
+from clustr.enrichment import get_enrichments
+from kmodes.kmodes import KModes
+
+
+def timed(func, *args, **kwargs):
+    """Runs func and returns its result and the time taken in seconds"""
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def loop_bubble_heatmap_input(values_dict,
+                              pvalue_dict,
+                              alpha: float = 0.05,
+                              arf_scaling=False):
+    """The previous, loop-based get_bubble_heatmap_input; kept as the reference for bench_bubble_heatmap"""
+    heatmap_data = pd.DataFrame(values_dict)
+    heatmap_masks = {key: dict() for key in values_dict.keys()}
+    for cluster, val in values_dict.items():
+        for condition in val:
+            heatmap_masks[cluster][condition] = pvalue_dict[cluster][condition] >= alpha
+    heatmap_masks = pd.DataFrame(heatmap_masks)
+    true_indices = heatmap_masks.all(axis=1)
+    true_indices = list(true_indices.index[true_indices])
+    heatmap_data.drop(true_indices, inplace=True)
+    heatmap_masks.drop(true_indices, inplace=True)
+    if arf_scaling:
+        heatmap_data = heatmap_data.applymap(map_to_scale) if hasattr(heatmap_data, 'applymap') \
+            else heatmap_data.map(map_to_scale)
+    result_df = heatmap_data.where(~heatmap_masks, np.nan)
+    flattened_df = pd.melt(result_df.reset_index(), id_vars=['index'], var_name='cluster', value_name='values')
+    flattened_df.rename(columns={'index': 'condition'}, inplace=True)
+    flattened_df['abs_values'] = flattened_df['values'].map(lambda x: abs(x))
+    flattened_df['overrep'] = flattened_df['values'].map(lambda x: 1 if x > 0 else 0)
+    return flattened_df
+
+
+def bench_bubble_heatmap(n_conditions: int = 500,
+                         n_clusters: int = 50):
+    """Compares get_bubble_heatmap_input with the loop-based version on random ARFs and p-values"""
+    rng = np.random.default_rng(0)
+    conditions = [f'disease_{i}' for i in range(n_conditions)]
+    arfs = rng.lognormal(0, 1, (n_conditions, n_clusters))
+    pvals = rng.uniform(0, 0.2, (n_conditions, n_clusters)) ** 2
+    pvals[:n_conditions // 10] = 1  # some conditions are never significant
+    values_dict = {c: dict(zip(conditions, arfs[:, c])) for c in range(n_clusters)}
+    pvalue_dict = {c: dict(zip(conditions, pvals[:, c])) for c in range(n_clusters)}
+
+    expected, loop_time = timed(loop_bubble_heatmap_input, values_dict, pvalue_dict, arf_scaling=True)
+    result, dict_time = timed(get_bubble_heatmap_input, values_dict, pvalue_dict, arf_scaling=True)
+    _, array_time = timed(get_bubble_heatmap_input, arfs, pvals, arf_scaling=True,
+                          conditions=conditions, clusters=list(range(n_clusters)))
+    pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+    print(f'get_bubble_heatmap_input, {n_conditions} conditions x {n_clusters} clusters: '
+          f'loops {loop_time:.3f}s, dicts {dict_time:.3f}s, arrays {array_time:.3f}s')
+
+
+def bench_scoring(n_rows: int = 20000,
+                  n_conditions: int = 50,
+                  k: int = 10):
+    """Compares the count-matrix scores with scikit-learn's on random binary data and labels"""
+    rng = np.random.default_rng(0)
+    data_mat = (rng.random((n_rows, n_conditions)) < 0.2).astype(int)
+    labels = rng.integers(0, k, n_rows)
+
+    def sklearn_scores():
+        return {'silhouette': silhouette_score(data_mat, labels, metric='hamming'),
+                'davies_boulden': davies_bouldin_score(data_mat, labels),
+                'calinski_harabasz': calinski_harabasz_score(data_mat, labels)}
+
+    expected, sklearn_time = timed(sklearn_scores)
+    result, count_time = timed(get_scores, data_mat, labels)
+    for name, value in expected.items():
+        assert np.isclose(result[name], value), name
+    print(f'scores, {n_rows} rows x {n_conditions} conditions, k={k}: '
+          f'scikit-learn {sklearn_time:.3f}s, count matrices {count_time:.3f}s')
+
+
+def get_planted_classes(n_rows: int,
+                        n_conditions: int,
+                        k: int,
+                        seed: int = 0,
+                        theta_range=(0.02, 0.6)):
+    """Random binary data drawn from k latent classes, and the class of each row; the narrower theta_range,
+    the more the classes overlap"""
+    rng = np.random.default_rng(seed)
+    theta = rng.uniform(*theta_range, (k, n_conditions))
+    classes = rng.integers(0, k, n_rows)
+    return (rng.random((n_rows, n_conditions)) < theta[classes]).astype(int), classes
+
+
+def check_precision(n_rows: int = 20000,
+                    n_conditions: int = 50,
+                    k: int = 5,
+                    bic_rtol: float = 1e-5,
+                    min_ari: float = 0.99):
+    """Checks that the float32 mode keeps the LCA labels and BIC, and the Hamming distances,
+    within tolerance of the float64 path"""
+    data_mat, _ = get_planted_classes(n_rows, n_conditions, k)
+    results = {}
+    for dtype in (np.float64, np.float32):
+        lca = LCA(n_components=k, tol=10e-4, max_iter=1000, random_state=0, dtype=dtype)
+        data = data_mat.astype(np.uint8) if dtype == np.float32 else data_mat
+        _, fit_time = timed(lca.fit, data)
+        results[dtype] = lca.bic, lca.predict(data), fit_time
+    (bic64, labels64, time64), (bic32, labels32, time32) = results[np.float64], results[np.float32]
+    ari = adjusted_rand_score(labels64, labels32)
+    assert np.isclose(bic32, bic64, rtol=bic_rtol), (bic32, bic64)
+    assert ari >= min_ari, ari
+    print(f'LCA, {n_rows} rows x {n_conditions} conditions, k={k}: float64 {time64:.3f}s, float32 {time32:.3f}s, '
+          f'BIC relative difference {abs(bic32 - bic64) / abs(bic64):.1e}, adjusted Rand index {ari:.4f}')
+
+    sample = data_mat[:2000].astype(np.uint8)
+    expected = ssd.squareform(ssd.pdist(sample, metric='hamming'))
+    configure_precision('float32')
+    try:
+        dists = get_distance_matrix(sample)
+    finally:
+        configure_precision('float64')
+    assert dists.dtype == np.float32 and np.allclose(dists, expected, atol=1e-6)
+    print(f'Hamming distances, {len(sample)} rows: {expected.nbytes / 2 ** 20:.0f}MB in float64, '
+          f'{dists.nbytes / 2 ** 20:.0f}MB in float32')
+
+
+def check_kernels(n_rows: int = 20000,
+                  n_conditions: int = 50,
+                  k: int = 10,
+                  n_distance_rows: int = 4000):
+    """Checks the numba kernels against the numpy reference kernels, in both precisions, and times them
+    (after a first call, which compiles them or loads them from the cache)"""
+    data_mat, _ = get_planted_classes(n_rows, n_conditions, k)
+    rng = np.random.default_rng(1)
+    theta = rng.uniform(0, 1, (k, n_conditions))
+    theta[0, :5] = 0  # conditions impossible in a class
+    weight = rng.dirichlet(np.ones(k))
+    sample = data_mat[:n_distance_rows].astype(np.uint8)
+    for dtype, rtol in ((np.float64, 1e-9), (np.float32, 1e-4)):
+        data = data_mat.astype(dtype)
+        results, times = {}, {}
+        for backend in ('numpy', 'numba'):
+            configure_kernels(backend)
+            m_step_sums(data, e_step(data, theta, weight)[0])
+            resp, e_time = timed(e_step, data, theta, weight)
+            sums, m_time = timed(m_step_sums, data, resp[0])
+            hamming_distances(sample[:10], dtype)
+            dists, h_time = timed(hamming_distances, sample, dtype)
+            results[backend] = resp, sums, dists
+            times[backend] = f'E-step {e_time:.3f}s, M-step {m_time:.3f}s, Hamming {h_time:.3f}s'
+        configure_kernels('numpy')
+        (resp, ll), (resp_sum, weighted_sum), dists = results['numpy']
+        (resp_nb, ll_nb), (resp_sum_nb, weighted_sum_nb), dists_nb = results['numba']
+        assert np.allclose(resp_nb, resp, rtol=rtol, atol=rtol) and np.isclose(ll_nb, ll, rtol=rtol)
+        assert np.allclose(resp_sum_nb, resp_sum, rtol=rtol) and np.allclose(weighted_sum_nb, weighted_sum, rtol=rtol)
+        assert np.array_equal(dists_nb, dists)
+        print(f'kernels, {np.dtype(dtype).name}, {n_rows} rows x {n_conditions} conditions, k={k}, '
+              f'{n_distance_rows} rows for the distances:')
+        for backend, line in times.items():
+            print(f'    {backend}: {line}')
+
+
+def bench_sharded_lca(n_rows: int = 200000,
+                      n_conditions: int = 50,
+                      k: int = 8,
+                      max_workers: int = None):
+    """Compares map-reduce LCA over shards with the single-process fit, for 1, 2, 4, ... workers up to the number
+    of cores; the BIC and labels should match, and the time should fall near-linearly with the workers"""
+    data_mat, _ = get_planted_classes(n_rows, n_conditions, k)
+    reference = LCA(n_components=k, tol=10e-4, max_iter=1000, random_state=0)
+    _, reference_time = timed(reference.fit, data_mat)
+    labels = reference.predict(data_mat)
+    print(f'LCA, {n_rows} rows x {n_conditions} conditions, k={k}: one process {reference_time:.3f}s, '
+          f'{len(reference.ll_)} iterations')
+    max_workers = max_workers or os.cpu_count() or 1
+    workers = [2 ** i for i in range(int(np.log2(max_workers)) + 1)]
+    with tempfile.TemporaryDirectory() as folder:
+        for n_workers in workers:
+            shards = write_shards(data_mat, os.path.join(folder, str(n_workers)), n_workers)
+            with ProcessPoolExecutor(max_workers=n_workers) as executor:
+                lca = LCA(n_components=k, tol=10e-4, max_iter=1000, random_state=0)
+                _, sharded_time = timed(lca.fit_shards, shards, executor)
+                assert np.isclose(lca.bic, reference.bic, rtol=1e-9), (lca.bic, reference.bic)
+                assert np.array_equal(lca.predict_shards(shards, executor), labels)
+            print(f'    {n_workers} shards and workers: {sharded_time:.3f}s, '
+                  f'speedup {reference_time / sharded_time:.2f}')
+
+
+def bench_accelerated_em(n_rows: int = 20000,
+                         n_conditions: int = 30,
+                         k: int = 5,
+                         n_seeds: int = 3):
+    """Compares plain and SQUAREM-accelerated EM on overlapping planted classes, where the likelihood is flat and
+    plain EM creeps, under each convergence criterion; the accelerated fit should reach at least the same log
+    likelihood in fewer passes over the data and less time"""
+    data_mat, _ = get_planted_classes(n_rows, n_conditions, k, theta_range=(0.15, 0.35))
+    print(f'EM on overlapping classes, {n_rows} rows x {n_conditions} conditions, k={k}:')
+    for convergence in CONVERGENCE_CRITERIA:
+        for seed in range(n_seeds):
+            results = {}
+            for accelerate in (False, True):
+                lca = make_lca(k, convergence, accelerate, random_state=seed)
+                lca.max_iter = 10000
+                _, fit_time = timed(lca.fit, data_mat)
+                # an accelerated iteration takes up to three E-steps
+                n_passes = (len(lca.ll_) - 1) * (3 if accelerate else 1)
+                results[accelerate] = lca.ll_[-1], n_passes, fit_time
+            (plain_ll, plain_passes, plain_time), (fast_ll, fast_passes, fast_time) = results[False], results[True]
+            assert fast_ll >= plain_ll - 1e-6 * abs(plain_ll), (fast_ll, plain_ll)
+            print(f'    {convergence}, seed {seed}: plain {plain_passes} passes, {plain_time:.2f}s, '
+                  f'log likelihood {plain_ll:.2f}; SQUAREM at most {fast_passes} passes, {fast_time:.2f}s, '
+                  f'log likelihood {fast_ll:.2f}')
+
+
+def bench_minibatch_kmodes(n_rows: int = 30000,
+                           n_conditions: int = 30,
+                           k: int = 8,
+                           batch_size: int = 5000,
+                           max_cost_ratio: float = 1.05):
+    """Compares mini-batch k-modes, streamed from a file, with full k-modes on planted classes: the cost (total
+    Hamming distance to the modes) should stay close, and the agreement with the planted classes similar"""
+    data_mat, classes = get_planted_classes(n_rows, n_conditions, k, theta_range=(0.05, 0.95))
+    kmodes = KModes(n_clusters=k, init='Huang', n_init=1, random_state=0)
+    _, full_time = timed(kmodes.fit, data_mat)
+    cgrps = [f'condition_{i}' for i in range(n_conditions)]
+    with tempfile.TemporaryDirectory() as folder:
+        infile = os.path.join(folder, 'cohort.tsv')
+        participants = [f'participant_{i}' for i in range(n_rows)]
+        pd.DataFrame(data_mat, index=participants, columns=cgrps).to_csv(infile, sep='\t')
+        get_batches = partial(iter_data_chunks, infile, batch_size)
+        (centroids, labelled), minibatch_time = timed(fit_minibatch_kmodes, get_batches, folder, cgrps, k,
+                                                      random_state=0)
+    # each batch is shuffled as it is prepared
+    labels = labelled['kmodes_cluster_labels'].reindex(participants).to_numpy()
+    cost = np.sum(data_mat != centroids[labels])
+    assert cost <= max_cost_ratio * kmodes.cost_, (cost, kmodes.cost_)
+    print(f'k-modes, {n_rows} rows x {n_conditions} conditions, k={k}: full {full_time:.2f}s, cost {kmodes.cost_:.0f}, '
+          f'ARI with the planted classes {adjusted_rand_score(classes, kmodes.labels_):.3f}; '
+          f'mini-batch from file (batches of {batch_size}) {minibatch_time:.2f}s, cost {cost:.0f}, '
+          f'ARI {adjusted_rand_score(classes, labels):.3f}, ARI with full {adjusted_rand_score(kmodes.labels_, labels):.3f}')
+
+
+def loop_nearest_centroids(data_mat, centroids):
+    """The previous assignment: every row against every centroid, by two matrix products"""
+    centroids = np.asarray(centroids, dtype=np.float64)
+    present = np.asarray(data_mat, dtype=np.float64)
+    dists = present @ (1 - centroids).T + (1 - present) @ centroids.T
+    return np.argmin(dists, axis=1)
+
+
+def bench_hamming_index(n_rows: int = 200000,
+                        ks=(8, 32, 128, 512),
+                        ms=(30, 100)):
+    """Times the nearest-centroid search of HammingIndex against comparing every row with every centroid, across
+    the number of centroids k and of conditions m, on sparse cohorts (in which many rows repeat) and dense ones;
+    the labels should be identical"""
+    for theta_range in ((0.005, 0.1), (0.02, 0.6)):
+        for n_conditions in ms:
+            data_mat, _ = get_planted_classes(n_rows, n_conditions, 8, theta_range=theta_range)
+            data_mat = data_mat.astype(np.uint8)
+            density = data_mat.mean()
+            for k in ks:
+                centroids = data_mat[np.random.default_rng(1).choice(n_rows, k, replace=False)]
+                expected, loop_time = timed(loop_nearest_centroids, data_mat, centroids)
+                (labels, _), index_time = timed(HammingIndex(centroids).query, data_mat)
+                assert np.array_equal(labels, expected)
+                print(f'Nearest of {k} centroids, {n_rows} rows x {n_conditions} conditions, density {density:.2f}: '
+                      f'every pair {loop_time:.3f}s, index {index_time:.3f}s')
+
+
+def bench_cooccurrence(n_rows: int = 1000000,
+                       n_conditions: int = 200,
+                       k: int = 10,
+                       n_checked: int = 2000):
+    """Times the per-cluster co-occurrence counts and Fisher's exact tests of every condition pair (about 20k pairs
+    per cluster at 200 conditions), checks the counts against a Gram matrix per cluster, and a sample of the p values
+    against scipy's fisher_exact"""
+    data_mat, classes = get_planted_classes(n_rows, n_conditions, k, theta_range=(0.001, 0.08))
+    data_mat = data_mat.astype(np.uint8)
+    (clusters, sizes, counts), count_time = timed(get_cluster_cooccurrences, data_mat, classes)
+    for cluster in clusters[:2]:
+        members = data_mat[classes == cluster].astype(np.int64)
+        assert np.array_equal(counts[cluster], members.T @ members)
+    conditions = [f'disease_{i}' for i in range(n_conditions)]
+    table, test_time = timed(get_cooccurrence_table, clusters, sizes, counts, conditions)
+    checked = table.sample(min(n_checked, len(table)), random_state=0)
+    positions = {condition: i for i, condition in enumerate(conditions)}
+    first, second = checked['condition_1'].map(positions), checked['condition_2'].map(positions)
+    count_1, count_2 = counts[checked['cluster'], first, first], counts[checked['cluster'], second, second]
+    observed, size = checked['observed'].to_numpy(), sizes[checked['cluster']]
+    expected = [fisher_exact([[o, c1 - o], [c2 - o, n - c1 - c2 + o]])[1]
+                for o, c1, c2, n in zip(observed, count_1, count_2, size)]
+    assert np.allclose(checked['pvalue'], expected, rtol=1e-6, atol=0)
+    print(f'Co-occurrence of {n_conditions} conditions in {k} clusters of {n_rows} rows: counts {count_time:.2f}s, '
+          f'{len(table)} Fisher tests {test_time:.2f}s')
+
+
+def bench_columnar_input(n_rows: int = 200000,
+                         n_conditions: int = 200):
+    """Times reading one subgroup of a master file with metadata columns: the whole tab-separated file filtered
+    afterwards, against read_cohort on the tab-separated file and on Parquet, which reads only the condition columns
+    and filters while scanning; the subgroups should be identical"""
+    data_mat, _ = get_planted_classes(n_rows, n_conditions, 8, theta_range=(0.005, 0.1))
+    rng = np.random.default_rng(0)
+    cohort = pd.DataFrame(data_mat.astype(np.uint8), index=pd.Index([f'p{i}' for i in range(n_rows)], name='id'),
+                          columns=[f'disease_{i}' for i in range(n_conditions)])
+    cohort.insert(0, 'sex', rng.choice(['F', 'M'], n_rows))
+    cohort.insert(1, 'age', rng.integers(18, 90, n_rows))
+    filters = [parse_filter('sex == F'), parse_filter('age >= 65')]
+    with tempfile.TemporaryDirectory() as folder:
+        tsv, parquet = os.path.join(folder, 'cohort.tsv'), os.path.join(folder, 'cohort.parquet')
+        cohort.to_csv(tsv, sep='\t')
+        cohort.to_parquet(parquet, row_group_size=50000)
+
+        def read_and_filter():
+            df = pd.read_csv(tsv, sep='\t', index_col=0)
+            return df.loc[(df['sex'] == 'F') & (df['age'] >= 65)].drop(columns=['sex', 'age'])
+
+        expected, full_time = timed(read_and_filter)
+        from_tsv, tsv_time = timed(read_cohort, tsv, ['sex', 'age'], filters)
+        from_parquet, parquet_time = timed(read_cohort, parquet, ['sex', 'age'], filters)
+    for subgroup in (from_tsv, from_parquet):
+        pd.testing.assert_frame_equal(subgroup, expected, check_dtype=False, check_index_type=False)
+    print(f'Subgroup of {len(expected)} from {n_rows} rows x {n_conditions} conditions: whole tsv then filter '
+          f'{full_time:.2f}s, filtered tsv chunks {tsv_time:.2f}s, parquet with pushdown {parquet_time:.2f}s')
+
+
+def bench_artifact_store(n_rows: int = 20000,
+                         n_conditions: int = 50,
+                         k: int = 8):
+    """Times the enrichment stages of the bubble heatmap tutorial computed, and then returned from the store as after
+    a kernel restart; the results should be identical. Then checks that the size cap evicts the least recently used
+    results first"""
+    settings = get_store_settings()
+    data_mat, classes = get_planted_classes(n_rows, n_conditions, k)
+    conditions = [f'disease_{i}' for i in range(n_conditions)]
+    df = pd.DataFrame(data_mat.astype(np.int64), columns=conditions)
+    df['cluster'] = classes
+    with tempfile.TemporaryDirectory() as folder:
+        configure_store(enabled=True, folder=folder)
+        computed, compute_time = timed(lambda: (get_arfs_prevalences(df, 'cluster', conditions),
+                                                get_fischers_coefficients(df, 'cluster', conditions)))
+        loaded, load_time = timed(lambda: (get_arfs_prevalences(df, 'cluster', conditions),
+                                           get_fischers_coefficients(df, 'cluster', conditions)))
+        assert repr(computed) == repr(loaded)
+        artifacts = list_artifacts()
+        assert len(artifacts) == 2
+        # a change upstream is a new key, and the oldest result goes first when the cap is reached
+        df.loc[0, conditions[0]] = 1 - df.loc[0, conditions[0]]
+        get_arfs_prevalences(df, 'cluster', conditions)
+        recent = list_artifacts().iloc[:2]
+        evict(recent['size_mb'].sum() * 1024 ** 2)
+        assert list(list_artifacts()['key']) == list(recent['key'])
+    configure_store(*settings)
+    print(f'ARFs and Fisher tests of {k} clusters x {n_conditions} conditions on {n_rows} rows: computed '
+          f'{compute_time:.2f}s, from the store {load_time:.3f}s')
+
+
+def bench_enrichment(n_rows: int = 20000,
+                     n_conditions: int = 200,
+                     k: int = 10,
+                     n_runs: int = 50,
+                     n_looped: int = 2):
+    """Times the enrichment of every cluster of many runs (e.g. repetitions) at once, against get_arfs_prevalences and
+    get_fischers_coefficients run after run, which are timed on a few runs and extrapolated; the ARFs, prevalences and
+    p values of those runs should agree"""
+    data_mat, classes = get_planted_classes(n_rows, n_conditions, k, theta_range=(0.005, 0.2))
+    rng = np.random.default_rng(0)
+    # the runs relabel the planted classes and move a tenth of the patients to other clusters
+    label_matrix = np.stack([np.where(rng.random(n_rows) < 0.1, rng.integers(0, k, n_rows), rng.permutation(k)[classes])
+                             for _ in range(n_runs)])
+    enrichments, engine_time = timed(get_enrichments, data_mat.astype(np.uint8), label_matrix)
+    conditions = [f'disease_{i}' for i in range(n_conditions)]
+    df = pd.DataFrame(data_mat.astype(np.int64), columns=conditions)
+    start = time.perf_counter()
+    for run in range(n_looped):
+        df['cluster'] = label_matrix[run]
+        arfs, prevalences = get_arfs_prevalences(df, 'cluster', conditions)
+        pvalues, adj_pvalues = get_fischers_coefficients(df, 'cluster', conditions)
+        for i, cluster in enumerate(enrichments['clusters'][run].astype(int)):
+            for name, expected in (('arfs', arfs), ('prevalences', prevalences), ('pvalues', pvalues),
+                                   ('adj_pvalues', adj_pvalues)):
+                assert np.allclose(enrichments[name][run, i], [expected[cluster][c] for c in conditions],
+                                   rtol=1e-6, atol=1e-12)
+    loop_time = (time.perf_counter() - start) / n_looped * n_runs
+    print(f'Enrichment of {n_runs} runs x {k} clusters x {n_conditions} conditions on {n_rows} rows: '
+          f'run by run ~{loop_time:.1f}s, at once {engine_time:.2f}s')
+
+
+if __name__ == '__main__':
+    # the timings are of the computations, not of the stored results
+    configure_store(enabled=False)
+    bench_bubble_heatmap()
+    bench_scoring()
+    check_precision()
+    check_kernels()
+    bench_sharded_lca()
+    bench_accelerated_em()
+    bench_minibatch_kmodes()
+    bench_hamming_index()
+    bench_cooccurrence()
+    bench_columnar_input()
+    bench_artifact_store()
+    bench_enrichment()
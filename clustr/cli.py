@@ -1,26 +1,86 @@
 import click
+from click.core import ParameterSource
 import logging
-import os
-import os.path as osp
+import pandas as pd
+from typing import List, Tuple
 from memory_profiler import profile
-from clustr.constants import HIER_AGG_RESULTS
-from clustr.constants import LCA_RESULTS
-from clustr.constants import KMEDOIDS_RESULTS
-from clustr.constants import KMODES_RESULTS
-from clustr.utils import get_data, plot_ks, plot_morbidity_dist, dict_to_json
-from clustr.hier_agg_utils import get_agg_clusters, plot_dendrogram
-from clustr.lca_utils import select_lca_model, get_lca_clusters
-from clustr.kmedoids_utils import calculate_kmedoids, fit_kmedoids
-from clustr.kmodes_utils import calculate_kmodes, fit_kmodes
+from clustr.utils import get_data
+from clustr.plotting import configure_plots, wait_for_plots
+from clustr.precision import PRECISIONS, configure_precision
+from clustr.kernels import KERNEL_BACKENDS, configure_kernels
+from clustr.planner import configure_memory_limit
+from clustr.progress import configure_progress
+from clustr.store import DEFAULT_STORE_GB, configure_store, list_artifacts, invalidate
+from clustr.lca import CONVERGENCE_CRITERIA
+from clustr.lca_utils import load_lca_model
+from clustr.kmodes_utils import load_kmodes_state
+from clustr.readers import parse_filter
+from clustr.runner import run_agg, run_lcaselect, run_lca, run_kmeselect, run_kmedoids, run_kmoselect, run_kmodes
+from clustr.runner import run_kmodes_stream, run_cooccurrence, run_enrichment
+from clustr.runner import load_config, run_experiments
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
 
+def get_filters(ctx, param, value):
+    """Parses the --filters of a command into (column, operator, value) filters"""
+    try:
+        return [parse_filter(expression) for expression in value]
+    except ValueError as error:
+        raise click.BadParameter(str(error))
+
+
+def check_warm_start_k(kclusters: int,
+                       get_warm_k):
+    """Stops a warm start whose --kclusters was given and differs from the number of clusters of the model it
+    starts from; get_warm_k loads that number, so the model is only read when --kclusters was given"""
+    if click.get_current_context().get_parameter_source('kclusters') == ParameterSource.DEFAULT:
+        return
+    warm_k = get_warm_k()
+    if kclusters != warm_k:
+        raise click.UsageError(f'--kclusters {kclusters} differs from the {warm_k} clusters of the warm start; '
+                               f'a warm start keeps its number of clusters')
+
+
 @click.group()
-def cli():
+@click.option("-np", "--no_plots", is_flag=True, default=False,
+              help="skip rendering the figures")
+@click.option("-dt", "--dtype", type=click.Choice(list(PRECISIONS)), default='float64',
+              help="the precision mode; float32 holds the data as uint8 and computes in float32")
+@click.option("-kb", "--kernels", type=click.Choice(list(KERNEL_BACKENDS)), default='numpy',
+              help="the backend of the EM and Hamming distance kernels; numba requires numba to be installed")
+@click.option("-ml", "--memory_limit", type=float, default=None,
+              help="the memory budget in GB; by default, the available memory")
+@click.option("-npb", "--no_progress", is_flag=True, default=False,
+              help="skip drawing the progress bars")
+@click.option("-mf", "--metrics_file", type=str, default=None,
+              help="a file to which progress metrics are written; JSON lines, or Prometheus textfiles if it ends with .prom")
+@click.option("-us", "--use_store", is_flag=True, default=False,
+              help="return the stored results of stages whose inputs are unchanged, and store new ones")
+@click.option("-sg", "--store_gb", type=float, default=DEFAULT_STORE_GB,
+              help="the size cap of the store of stage results in GB, beyond which the least recently used are evicted")
+def cli(no_plots: bool = False,
+        dtype: str = 'float64',
+        kernels: str = 'numpy',
+        memory_limit: float = None,
+        no_progress: bool = False,
+        metrics_file: str = None,
+        use_store: bool = False,
+        store_gb: float = DEFAULT_STORE_GB):
     """Entry method for the CLI."""
-    pass
+    configure_plots(enabled=not no_plots)
+    configure_precision(dtype)
+    configure_kernels(kernels)
+    configure_memory_limit(memory_limit)
+    configure_progress(bars=not no_progress, metrics_file=metrics_file)
+    configure_store(enabled=use_store, max_gb=store_gb)
+
+
+@cli.result_callback()
+def finish(*args, **kwargs):
+    """Waits for the figures rendering in the background once a command has finished."""
+    wait_for_plots()
 
 
 @profile
@@ -39,13 +99,19 @@ def cli():
               help="whether to drop those who have no conditions")
 @click.option("-c", "--coi", type=str, default=None,
               help="the name of some condition of interest (e.g. 'Depression') which is taken out of the analysis")
+@click.option("-md", "--metadata", type=str, multiple=True,
+              help="a column of the input file which is not a condition (e.g. sex), and is not read; can be repeated")
+@click.option("-f", "--filters", type=str, multiple=True, callback=get_filters,
+              help="a filter of the rows to read, e.g. 'sex == F' or 'age >= 40'; can be repeated")
 def agg(infile: str,
         subdir: str,
         metric: str = 'hamming',
         linkage: str = 'complete',
         sample_frac: float = 1,
         drop_healthy: bool = False,
-        coi=None):
+        coi=None,
+        metadata: Tuple[str] = (),
+        filters: List[tuple] = ()):
     """Hierarchical agglomerative clustering from command line
     :param infile: the input filepath; recommended to store within the 'data' directory
     :param subdir: denotes a subdirectory to create and write
@@ -54,15 +120,11 @@ def agg(infile: str,
     :param sample_frac: the fraction of the data to be sampled; default is 1, so all the data is used
     :param drop_healthy: boolean value indicating whether to drop those with no conditions,
     :param coi: the name of some condition of interest (e.g. 'Depression') which is taken out of the analysis
+    :param metadata: the columns of the input file which are not conditions (e.g. sex or age); they are not read
+    :param filters: the filters the rows must pass to be read, e.g. 'sex == F'; see clustr.readers.parse_filter
     """
-    df, mat, _, _, _ = get_data(infile, sample_frac, drop_healthy, coi)
-    foldr = osp.join(HIER_AGG_RESULTS, subdir) if subdir else HIER_AGG_RESULTS
-    os.makedirs(foldr, exist_ok=True)
-    _, labels = get_agg_clusters(mat, foldr, metric, linkage)
-    plot_dendrogram(mat, foldr, metric, linkage)
-    df['aggl_cluster_labels'] = labels
-    df.to_csv(osp.join(foldr, 'hier_agg_labels.tsv'), sep='\t')
-    plot_morbidity_dist(df, 'aggl_cluster_labels', foldr, 'agglomerative_hierarchical')
+    df, mat, _, _, cgrps = get_data(infile, sample_frac, drop_healthy, coi, list(metadata), filters)
+    run_agg(df, mat, cgrps, subdir, metric, linkage)
 
 
 @cli.command()
@@ -80,13 +142,31 @@ def agg(infile: str,
               help="whether to drop those who have no conditions")
 @click.option("-c", "--coi", type=str, default=None,
               help="the name of some condition of interest (e.g. 'Depression') which is taken out of the analysis")
+@click.option("-md", "--metadata", type=str, multiple=True,
+              help="a column of the input file which is not a condition (e.g. sex), and is not read; can be repeated")
+@click.option("-f", "--filters", type=str, multiple=True, callback=get_filters,
+              help="a filter of the rows to read, e.g. 'sex == F' or 'age >= 40'; can be repeated")
+@click.option("-ce", "--checkpoint_every", type=int, default=10,
+              help="the number of EM iterations between saves of the EM state; 0 disables this")
+@click.option("-sh", "--shards", type=int, default=1,
+              help="the number of row shards to fit across worker processes; 1 fits in one process")
+@click.option("-cv", "--convergence", type=click.Choice(CONVERGENCE_CRITERIA), default='absolute',
+              help="how EM convergence is judged: by the absolute, relative or per-participant change of the log likelihood")
+@click.option("-ac", "--accelerate", type=bool, default=False,
+              help="whether to run SQUAREM-accelerated EM")
 def lcaselect(infile: str,
               subdir: str,
               min_k: int = 2,
               max_k: int = 10,
               sample_frac: float = 1,
               drop_healthy: bool = False,
-              coi=None
+              coi=None,
+              metadata: Tuple[str] = (),
+              filters: List[tuple] = (),
+              checkpoint_every: int = 10,
+              shards: int = 1,
+              convergence: str = 'absolute',
+              accelerate: bool = False
               ):
     """Helps facilitate model selection for LCA using BIC criterion
     :param infile: the input filepath; recommended to store within the 'data' directory
@@ -96,12 +176,16 @@ def lcaselect(infile: str,
     :param sample_frac: the fraction of the data to be sampled; default is 1, so all the data is used
     :param drop_healthy: boolean value indicating whether to drop those with no conditions
     :param coi: the name of some condition of interest (e.g. 'Depression') which is taken out of the analysis
+    :param metadata: the columns of the input file which are not conditions (e.g. sex or age); they are not read
+    :param filters: the filters the rows must pass to be read, e.g. 'sex == F'; see clustr.readers.parse_filter
+    :param checkpoint_every: the number of EM iterations between saves of the EM state; 0 disables this
+    :param shards: the number of row shards to fit across worker processes; 1 fits in one process
+    :param convergence: how EM convergence is judged: by the 'absolute', 'relative' or 'per_sample' change of the
+            log likelihood
+    :param accelerate: whether to run SQUAREM-accelerated EM
     """
-    _, mat, _, _, _ = get_data(infile, sample_frac, drop_healthy, coi)
-    foldr = osp.join(LCA_RESULTS, subdir) if subdir else LCA_RESULTS
-    os.makedirs(foldr, exist_ok=True)
-    bics = select_lca_model(mat, foldr, min_k, max_k)
-    dict_to_json(bics, osp.join(foldr, 'bics.json'))
+    df, mat, _, _, cgrps = get_data(infile, sample_frac, drop_healthy, coi, list(metadata), filters)
+    run_lcaselect(df, mat, cgrps, subdir, min_k, max_k, checkpoint_every, shards, convergence, accelerate)
 
 
 @cli.command()
@@ -119,13 +203,43 @@ def lcaselect(infile: str,
               help="whether to drop those who have no conditions")
 @click.option("-c", "--coi", type=str, default=None,
               help="the name of some condition of interest (e.g. 'Depression') which is taken out of the analysis")
+@click.option("-md", "--metadata", type=str, multiple=True,
+              help="a column of the input file which is not a condition (e.g. sex), and is not read; can be repeated")
+@click.option("-f", "--filters", type=str, multiple=True, callback=get_filters,
+              help="a filter of the rows to read, e.g. 'sex == F' or 'age >= 40'; can be repeated")
+@click.option("-w", "--warm_start", type=str, default=None,
+              help="a previous results folder of this method to warm start from")
+@click.option("-u", "--update_only", type=bool, default=False,
+              help="whether to update the warm-started model with only the rows it has not seen")
+@click.option("-ce", "--checkpoint_every", type=int, default=10,
+              help="the number of EM iterations between saves of the EM state; 0 disables this")
+@click.option("-wt", "--wide_table", type=bool, default=False,
+              help="whether to write the labels of every repetition into one table, instead of one file per run")
+@click.option("-pp", "--posteriors", type=bool, default=False,
+              help="whether to also write the posterior class probabilities of each participant")
+@click.option("-sh", "--shards", type=int, default=1,
+              help="the number of row shards to fit across worker processes; 1 fits in one process")
+@click.option("-cv", "--convergence", type=click.Choice(CONVERGENCE_CRITERIA), default='absolute',
+              help="how EM convergence is judged: by the absolute, relative or per-participant change of the log likelihood")
+@click.option("-ac", "--accelerate", type=bool, default=False,
+              help="whether to run SQUAREM-accelerated EM")
 def lca(infile: str,
         subdir: str,
         repetitions: int = 1,
         kclusters: int = 10,
         sample_frac: float = 1,
         drop_healthy: bool = False,
-        coi=None):
+        coi=None,
+        metadata: Tuple[str] = (),
+        filters: List[tuple] = (),
+        warm_start: str = None,
+        update_only: bool = False,
+        checkpoint_every: int = 10,
+        wide_table: bool = False,
+        posteriors: bool = False,
+        shards: int = 1,
+        convergence: str = 'absolute',
+        accelerate: bool = False):
     """Performs LCA clustering
     :param infile: the input filepath; recommended to store within the 'data' directory
     :param subdir: denotes a subdirectory to create and write
@@ -134,22 +248,25 @@ def lca(infile: str,
     :param sample_frac: the fraction of the data to be sampled; default is 1, so all the data is used
     :param drop_healthy: boolean value indicating whether to drop those with no conditions,
     :param coi: the name of some condition of interest (e.g. 'Depression') which is taken out of the analysis
+    :param metadata: the columns of the input file which are not conditions (e.g. sex or age); they are not read
+    :param filters: the filters the rows must pass to be read, e.g. 'sex == F'; see clustr.readers.parse_filter
+    :param warm_start: a previous LCA results folder (containing lca_model.npz) to warm start from
+    :param update_only: whether to update the warm-started model with only the rows it has not seen
+    :param checkpoint_every: the number of EM iterations between saves of the EM state; 0 disables this
+    :param wide_table: whether to write the labels of every repetition into one table
+    :param posteriors: whether to also write the posterior class probabilities of each participant
+    :param shards: the number of row shards to fit across worker processes; 1 fits in one process
+    :param convergence: how EM convergence is judged: by the 'absolute', 'relative' or 'per_sample' change of the
+            log likelihood
+    :param accelerate: whether to run SQUAREM-accelerated EM
     """
-    df, mat, _, _, _ = get_data(infile, sample_frac, drop_healthy, coi)
-    foldr = osp.join(LCA_RESULTS, subdir) if subdir else LCA_RESULTS
-    
-    # do r number of times:
-    for i in range(repetitions):
-        if repetitions != 1:
-            subfolder = osp.join(foldr, f'run_{i}')
-        else:
-            subfolder = foldr
-        
-        os.makedirs(subfolder, exist_ok=True)
-        _, labels = get_lca_clusters(mat, subfolder, kclusters)
-        df['lca_cluster_labels'] = labels
-        df.to_csv(osp.join(subfolder, 'lca_cluster_labels.tsv'), sep='\t')
-        plot_morbidity_dist(df, 'lca_cluster_labels', subfolder, 'latent_class_analysis')
+    if update_only and not warm_start:
+        raise click.UsageError('--update_only requires --warm_start')
+    if warm_start:
+        check_warm_start_k(kclusters, lambda: load_lca_model(warm_start).n_components)
+    df, mat, _, _, cgrps = get_data(infile, sample_frac, drop_healthy, coi, list(metadata), filters)
+    run_lca(df, mat, cgrps, subdir, repetitions, kclusters, warm_start, update_only, checkpoint_every,
+            wide_table, posteriors, shards, convergence, accelerate)
 
 
 @cli.command()
@@ -167,13 +284,19 @@ def lca(infile: str,
               help="whether to drop those who have no conditions")
 @click.option("-c", "--coi", type=str, default=None,
               help="the name of some condition of interest (e.g. 'Depression') which is taken out of the analysis")
+@click.option("-md", "--metadata", type=str, multiple=True,
+              help="a column of the input file which is not a condition (e.g. sex), and is not read; can be repeated")
+@click.option("-f", "--filters", type=str, multiple=True, callback=get_filters,
+              help="a filter of the rows to read, e.g. 'sex == F' or 'age >= 40'; can be repeated")
 def kmeselect(infile: str,
               subdir: str,
               min_k: int = 2,
               max_k: int = 10,
               sample_frac: float = 1,
               drop_healthy: bool = False,
-              coi: str = None
+              coi: str = None,
+              metadata: Tuple[str] = (),
+              filters: List[tuple] = ()
               ):
     """Helps facilitate model selection for k-medoids using silhouette score
     :param infile: the input filepath; recommended to store within the 'data' directory
@@ -183,15 +306,11 @@ def kmeselect(infile: str,
     :param sample_frac: the fraction of the data to be sampled; default is 1, so all the data is used
     :param drop_healthy: boolean value indicating whether to drop those with no conditions
     :param coi: the name of some condition of interest (e.g. 'Depression') which is taken out of the analysis
+    :param metadata: the columns of the input file which are not conditions (e.g. sex or age); they are not read
+    :param filters: the filters the rows must pass to be read, e.g. 'sex == F'; see clustr.readers.parse_filter
     """
-    _, mat, _, _, _ = get_data(infile, sample_frac, drop_healthy, coi)
-    foldr = osp.join(KMEDOIDS_RESULTS, subdir) if subdir else KMEDOIDS_RESULTS
-    os.makedirs(foldr, exist_ok=True)
-    costs, sil_scores = calculate_kmedoids(mat, min_k, max_k)
-    dict_to_json(dict(costs), osp.join(foldr, 'costs.json'))
-    dict_to_json(dict(sil_scores), osp.join(foldr, 'sil_scores.json'))
-    plot_ks(costs, foldr, 'costs', min_k, max_k)
-    plot_ks(sil_scores, foldr, 'silhouette', min_k, max_k)
+    df, mat, _, _, cgrps = get_data(infile, sample_frac, drop_healthy, coi, list(metadata), filters)
+    run_kmeselect(df, mat, cgrps, subdir, min_k, max_k)
 
 
 @cli.command()
@@ -207,12 +326,18 @@ def kmeselect(infile: str,
               help="whether to drop those who have no conditions")
 @click.option("-c", "--coi", type=str, default=None,
               help="the name of some condition of interest (e.g. 'Depression') which is taken out of the analysis")
+@click.option("-md", "--metadata", type=str, multiple=True,
+              help="a column of the input file which is not a condition (e.g. sex), and is not read; can be repeated")
+@click.option("-f", "--filters", type=str, multiple=True, callback=get_filters,
+              help="a filter of the rows to read, e.g. 'sex == F' or 'age >= 40'; can be repeated")
 def kmedoids(infile: str,
              subdir: str,
              kclusters: int = 10,
              sample_frac: float = 1,
              drop_healthy: bool = False,
-             coi: str = None):
+             coi: str = None,
+             metadata: Tuple[str] = (),
+             filters: List[tuple] = ()):
     """Performs KMedoids clustering
     :param infile: the input filepath; recommended to store within the 'data' directory
     :param subdir: denotes a subdirectory to create and write
@@ -220,16 +345,11 @@ def kmedoids(infile: str,
     :param sample_frac: the fraction of the data to be sampled; default is 1, so all the data is used
     :param drop_healthy: boolean value indicating whether to drop those with no conditions
     :param coi: the name of some condition of interest (e.g. 'Depression') which is taken out of the analysis
+    :param metadata: the columns of the input file which are not conditions (e.g. sex or age); they are not read
+    :param filters: the filters the rows must pass to be read, e.g. 'sex == F'; see clustr.readers.parse_filter
     """
-    df, mat, _, _, cgrps = get_data(infile, sample_frac, drop_healthy, coi)
-    foldr = osp.join(KMEDOIDS_RESULTS, subdir) if subdir else KMEDOIDS_RESULTS
-
-    os.makedirs(foldr, exist_ok=True)
-
-    _, labels = fit_kmedoids(mat, foldr, cgrps, kclusters)
-    df['kmedoids_cluster_labels'] = labels
-    df.to_csv(osp.join(foldr, 'kmedoids_cluster_labels.tsv'), sep='\t')
-    plot_morbidity_dist(df, 'kmedoids_cluster_labels', foldr, 'kmedoids')
+    df, mat, _, _, cgrps = get_data(infile, sample_frac, drop_healthy, coi, list(metadata), filters)
+    run_kmedoids(df, mat, cgrps, subdir, kclusters)
 
 
 @cli.command()
@@ -247,13 +367,19 @@ def kmedoids(infile: str,
               help="whether to drop those who have no conditions")
 @click.option("-c", "--coi", type=str, default=None,
               help="the name of some condition of interest (e.g. 'Depression') which is taken out of the analysis")
+@click.option("-md", "--metadata", type=str, multiple=True,
+              help="a column of the input file which is not a condition (e.g. sex), and is not read; can be repeated")
+@click.option("-f", "--filters", type=str, multiple=True, callback=get_filters,
+              help="a filter of the rows to read, e.g. 'sex == F' or 'age >= 40'; can be repeated")
 def kmoselect(infile: str,
               subdir: str,
               min_k: int = 2,
               max_k: int = 10,
               sample_frac: float = 1,
               drop_healthy: bool = False,
-              coi: str = None
+              coi: str = None,
+              metadata: Tuple[str] = (),
+              filters: List[tuple] = ()
               ):
     """Helps facilitate model selection for k-modes using silhouette score
     :param infile: the input filepath; recommended to store within the 'data' directory
@@ -263,15 +389,11 @@ def kmoselect(infile: str,
     :param sample_frac: the fraction of the data to be sampled; default is 1, so all the data is used
     :param drop_healthy: boolean value indicating whether to drop those with no conditions
     :param coi: the name of some condition of interest (e.g. 'Depression') which is taken out of the analysis
+    :param metadata: the columns of the input file which are not conditions (e.g. sex or age); they are not read
+    :param filters: the filters the rows must pass to be read, e.g. 'sex == F'; see clustr.readers.parse_filter
     """
-    _, mat, _, _, _ = get_data(infile, sample_frac, drop_healthy, coi)
-    foldr = osp.join(KMODES_RESULTS, subdir) if subdir else KMODES_RESULTS
-    os.makedirs(foldr, exist_ok=True)
-    costs, sil_scores = calculate_kmodes(mat, min_k, max_k)
-    dict_to_json(dict(costs), osp.join(foldr, 'costs.json'))
-    dict_to_json(dict(sil_scores), osp.join(foldr, 'sil_scores.json'))
-    plot_ks(costs, foldr, 'costs', min_k, max_k)
-    plot_ks(sil_scores, foldr, 'silhouette', min_k, max_k)
+    df, mat, _, _, cgrps = get_data(infile, sample_frac, drop_healthy, coi, list(metadata), filters)
+    run_kmoselect(df, mat, cgrps, subdir, min_k, max_k)
 
 
 @cli.command()
@@ -289,13 +411,31 @@ def kmoselect(infile: str,
               help="whether to drop those who have no conditions")
 @click.option("-c", "--coi", type=str, default=None,
               help="the name of some condition of interest (e.g. 'Depression') which is taken out of the analysis")
+@click.option("-md", "--metadata", type=str, multiple=True,
+              help="a column of the input file which is not a condition (e.g. sex), and is not read; can be repeated")
+@click.option("-f", "--filters", type=str, multiple=True, callback=get_filters,
+              help="a filter of the rows to read, e.g. 'sex == F' or 'age >= 40'; can be repeated")
+@click.option("-w", "--warm_start", type=str, default=None,
+              help="a previous results folder of this method to warm start from")
+@click.option("-u", "--update_only", type=bool, default=False,
+              help="whether to update the warm-started model with only the rows it has not seen")
+@click.option("-wt", "--wide_table", type=bool, default=False,
+              help="whether to write the labels of every repetition into one table, instead of one file per run")
+@click.option("-bs", "--batch_size", type=int, default=None,
+              help="if given, fit mini-batch k-modes, streaming the input file in batches of this many rows")
 def kmodes(infile: str,
            subdir: str,
            repetitions: int = 1,
            kclusters: int = 10,
            sample_frac: float = 1,
            drop_healthy: bool = False,
-           coi: str = None):
+           coi: str = None,
+           metadata: Tuple[str] = (),
+           filters: List[tuple] = (),
+           warm_start: str = None,
+           update_only: bool = False,
+           wide_table: bool = False,
+           batch_size: int = None):
     """Performs KModes clustering
     :param infile: the input filepath; recommended to store within the 'data' directory
     :param subdir: denotes a subdirectory to create and write
@@ -304,20 +444,154 @@ def kmodes(infile: str,
     :param sample_frac: the fraction of the data to be sampled; default is 1, so all the data is used
     :param drop_healthy: boolean value indicating whether to drop those with no conditions
     :param coi: the name of some condition of interest (e.g. 'Depression') which is taken out of the analysis
+    :param metadata: the columns of the input file which are not conditions (e.g. sex or age); they are not read
+    :param filters: the filters the rows must pass to be read, e.g. 'sex == F'; see clustr.readers.parse_filter
+    :param warm_start: a previous k-modes results folder (containing kmodes_state.npz) to warm start from
+    :param update_only: whether to update the warm-started modes with only the rows they have not seen
+    :param wide_table: whether to write the labels of every repetition into one table
+    :param batch_size: if given, mini-batch k-modes is fitted while the input file is streamed in batches of this
+            many rows, so that it is never loaded at once; a sample_frac is then taken of each batch
+    """
+    if update_only and not warm_start:
+        raise click.UsageError('--update_only requires --warm_start')
+    if warm_start:
+        check_warm_start_k(kclusters, lambda: len(load_kmodes_state(warm_start)[0]))
+    if batch_size:
+        if update_only:
+            raise click.UsageError('--update_only cannot be combined with --batch_size')
+        run_kmodes_stream(infile, batch_size, sample_frac, drop_healthy, coi, subdir, repetitions, kclusters,
+                          warm_start, wide_table, list(metadata), filters)
+        return
+    df, mat, _, _, cgrps = get_data(infile, sample_frac, drop_healthy, coi, list(metadata), filters)
+    run_kmodes(df, mat, cgrps, subdir, repetitions, kclusters, warm_start, update_only, wide_table)
+
+
+@cli.command()
+@click.option("-i", "--infile", type=str, default=None,
+              help="the input filepath; recommended to store within the 'data' directory")
+@click.option("-l", "--labels_file", type=str, required=True,
+              help="a labels file written by a clustering command, e.g. results/kmodes/kmodes_cluster_labels.tsv.gz")
+@click.option("-lc", "--labels_column", type=str, default=None,
+              help="the column of the labels file containing the cluster labels; by default, the first")
+@click.option("-dh", "--drop_healthy", type=bool, default=False,
+              help="whether to drop those who have no conditions")
+@click.option("-c", "--coi", type=str, default=None,
+              help="the name of some condition of interest (e.g. 'Depression') which is taken out of the analysis")
+@click.option("-md", "--metadata", type=str, multiple=True,
+              help="a column of the input file which is not a condition (e.g. sex), and is not read; can be repeated")
+@click.option("-f", "--filters", type=str, multiple=True, callback=get_filters,
+              help="a filter of the rows to read, e.g. 'sex == F' or 'age >= 40'; can be repeated")
+@click.option("-mo", "--min_observed", type=int, default=1,
+              help="the fewest patients with both conditions for a pair to be tested in a cluster")
+def cooccurrence(infile: str,
+                 labels_file: str,
+                 labels_column: str = None,
+                 drop_healthy: bool = False,
+                 coi: str = None,
+                 metadata: Tuple[str] = (),
+                 filters: List[tuple] = (),
+                 min_observed: int = 1):
+    """Tests which pairs of conditions co-occur within each cluster more (or less) often than their prevalences in
+    the cluster imply
+    :param infile: the input filepath; recommended to store within the 'data' directory
+    :param labels_file: a labels file written by a clustering command
+    :param labels_column: the column of the labels file containing the cluster labels; by default, the first
+    :param drop_healthy: boolean value indicating whether to drop those with no conditions
+    :param coi: the name of some condition of interest (e.g. 'Depression') which is taken out of the analysis
+    :param metadata: the columns of the input file which are not conditions (e.g. sex or age); they are not read
+    :param filters: the filters the rows must pass to be read, e.g. 'sex == F'; see clustr.readers.parse_filter
+    :param min_observed: the fewest patients with both conditions for a pair to be tested in a cluster
+    """
+    df, mat, _, _, cgrps = get_data(infile, 1, drop_healthy, coi, list(metadata), filters)
+    run_cooccurrence(df, mat, cgrps, labels_file, labels_column, min_observed)
+
+
+@cli.command()
+@click.option("-i", "--infile", type=str, default=None,
+              help="the input filepath; recommended to store within the 'data' directory")
+@click.option("-l", "--labels_file", type=str, required=True,
+              help="a labels file written by a clustering command, e.g. results/lca/lca_cluster_labels.tsv")
+@click.option("-lc", "--labels_columns", type=str, multiple=True,
+              help="a column of the labels file containing cluster labels; can be repeated; by default, all of them")
+@click.option("-dh", "--drop_healthy", type=bool, default=False,
+              help="whether to drop those who have no conditions")
+@click.option("-c", "--coi", type=str, default=None,
+              help="the name of some condition of interest (e.g. 'Depression') which is taken out of the analysis")
+@click.option("-md", "--metadata", type=str, multiple=True,
+              help="a column of the input file which is not a condition (e.g. sex), and is not read; can be repeated")
+@click.option("-f", "--filters", type=str, multiple=True, callback=get_filters,
+              help="a filter of the rows to read, e.g. 'sex == F' or 'age >= 40'; can be repeated")
+@click.option("-w", "--workers", type=int, default=None,
+              help="the number of worker processes; by default, the number of cores")
+def enrichment(infile: str,
+               labels_file: str,
+               labels_columns: Tuple[str] = (),
+               drop_healthy: bool = False,
+               coi: str = None,
+               metadata: Tuple[str] = (),
+               filters: List[tuple] = (),
+               workers: int = None):
+    """Computes the ARFs, prevalences and Fisher's exact p values of every condition in every cluster of many
+    label columns at once, e.g. all the repetitions of a clustering command
+    :param infile: the input filepath; recommended to store within the 'data' directory
+    :param labels_file: a labels file written by a clustering command
+    :param labels_columns: the columns of the labels file containing cluster labels; by default, all of them
+    :param drop_healthy: boolean value indicating whether to drop those with no conditions
+    :param coi: the name of some condition of interest (e.g. 'Depression') which is taken out of the analysis
+    :param metadata: the columns of the input file which are not conditions (e.g. sex or age); they are not read
+    :param filters: the filters the rows must pass to be read, e.g. 'sex == F'; see clustr.readers.parse_filter
+    :param workers: the number of worker processes; by default, the number of cores
+    """
+    df, mat, _, _, cgrps = get_data(infile, 1, drop_healthy, coi, list(metadata), filters)
+    run_enrichment(df, mat, cgrps, labels_file, list(labels_columns), workers)
+
+
+@cli.command()
+@click.argument("config", type=click.Path(exists=True))
+def run(config: str):
+    """Runs a grid of methods, subgroups and conditions of interest described in a yaml file,
+    loading the input file only once
+    :param config: the yaml configuration file; see clustr.runner.load_config for the format
+    """
+    run_experiments(load_config(config))
+
+
+@cli.group()
+def store():
+    """Lists or invalidates the stored results of the pipeline stages (load, fit, labels, scores and enrichment)"""
+
+
+@store.command(name='list')
+@click.option("-st", "--stage", type=str, default=None,
+              help="only list the results of this stage")
+def list_store(stage: str = None):
+    """Lists the stored results, the most recently used first
+    :param stage: if given, only the results of this stage are listed
+    """
+    artifacts = list_artifacts(stage)
+    if artifacts.empty:
+        click.echo('No stored results')
+        return
+    for column in ('created', 'last_used'):
+        artifacts[column] = artifacts[column].dt.floor('s')
+    with pd.option_context('display.max_colwidth', 80, 'display.width', 200):
+        click.echo(artifacts.drop(columns='arguments').to_string(index=False, float_format='%.2f'))
+    click.echo(f'{len(artifacts)} results, {artifacts["size_mb"].sum():.1f} MB')
+
+
+@store.command(name='invalidate')
+@click.option("-st", "--stage", type=str, default=None,
+              help="only remove the results of this stage")
+@click.option("-k", "--key", type=str, default=None,
+              help="only remove the result whose key starts with this")
+@click.option("-fn", "--function", type=str, default=None,
+              help="only remove the results of this function, e.g. get_arfs_prevalences")
+def invalidate_store(stage: str = None,
+                     key: str = None,
+                     function: str = None):
+    """Removes stored results, so that their stages are computed again; with no options, all of them
+    :param stage: if given, only the results of this stage are removed
+    :param key: if given, only the result whose key starts with this is removed
+    :param function: if given, only the results of this function are removed
     """
-    df, mat, _, _, cgrps = get_data(infile, sample_frac, drop_healthy, coi)
-    foldr = osp.join(KMODES_RESULTS, subdir) if subdir else KMODES_RESULTS
-
-    # do r number of times:
-    for i in range(repetitions):
-        if repetitions != 1:
-            subfolder = osp.join(foldr, f'run_{i}')
-        else:
-            subfolder = foldr
-            
-        os.makedirs(subfolder, exist_ok=True)
-
-        model, labels = fit_kmodes(mat, subfolder, cgrps, kclusters)
-        df['kmodes_cluster_labels'] = labels
-        df.to_csv(osp.join(subfolder, 'kmodes_cluster_labels.tsv'), sep='\t')
-        plot_morbidity_dist(df, 'kmodes_cluster_labels', subfolder, 'kmodes')
+    click.echo(f'Removed {invalidate(stage, key, function)} results')
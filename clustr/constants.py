@@ -8,6 +8,7 @@ HOME = str(Path.home())
 # CACHE AND LOGGING
 CACHE = osp.join(HOME, '.clustr')
 LOGS = osp.join(CACHE, 'logs')
+STORE = osp.join(CACHE, 'store')
 
 # MAIN DIRS
 #PROJECT_DIR = osp.dirname(osp.dirname(osp.realpath(__file__)))
@@ -0,0 +1,141 @@
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from scipy.stats import hypergeom
+from typing import List
+from clustr.store import stored
+
+
+@stored('enrichment')
+def get_cluster_cooccurrences(data_mat,
+                              labels):
+    """Gets the condition co-occurrence counts (X^T X) of every cluster in one sparse pass: the rows are spread
+    into one block of columns per cluster, so that a single sparse product gives all the per-cluster Gram matrices
+    :param data_mat: the binary numpy array containing the sample features
+    :param labels: the cluster label of each row
+    :returns: the clusters (sorted), their sizes, and the co-occurrence counts (clusters x conditions x conditions),
+            whose diagonals are the per-cluster condition counts
+    """
+    clusters, codes = np.unique(labels, return_inverse=True)
+    codes = codes.ravel()
+    present = sp.csr_matrix(data_mat, dtype=np.int64)
+    n_rows, n_conditions = present.shape
+    row_codes = np.repeat(codes, np.diff(present.indptr))
+    blocks = sp.csr_matrix((present.data, row_codes * n_conditions + present.indices, present.indptr),
+                           shape=(n_rows, len(clusters) * n_conditions))
+    counts = (blocks.T @ present).toarray().reshape(len(clusters), n_conditions, n_conditions)
+    return clusters, np.bincount(codes, minlength=len(clusters)), counts
+
+
+# tables whose log probabilities differ by less than this are taken as equally likely
+LOG_TOLERANCE = 1e-7
+
+
+def _bisect(lo, hi, keep_lo, total, row_1, col_1):
+    """The largest x in [lo, hi) for which keep_lo holds of the hypergeometric log pmf at x, for each table, given
+    that it holds at lo and not at hi and that it changes only once in between"""
+    while np.any(hi - lo > 1):
+        mid = (lo + hi) // 2
+        moving = hi - lo > 1
+        keep = keep_lo(hypergeom.logpmf(mid, total, row_1, col_1)) & moving
+        lo = np.where(keep, mid, lo)
+        hi = np.where(~keep & moving, mid, hi)
+    return lo
+
+
+def _tail_sums(start, step, total, row_1, col_1):
+    """Sums the hypergeometric probabilities from start away from the mode (step 1 upwards, -1 downwards), term by
+    term through the ratio of consecutive probabilities, until the terms no longer change the sums"""
+    term = np.exp(hypergeom.logpmf(start, total, row_1, col_1))
+    sums, x = term.copy(), start.copy()
+    # the number of the table's patients in neither row 1 nor column 1, but for x
+    rest = total - row_1 - col_1
+    active = np.flatnonzero(term > 0)
+    while len(active):
+        xa, ra, ca, rest_a = x[active], row_1[active], col_1[active], rest[active]
+        if step > 0:
+            ratio = (ra - xa) * (ca - xa) / ((xa + 1) * (rest_a + xa + 1))
+        else:
+            ratio = xa * (rest_a + xa) / ((ra - xa + 1) * (ca - xa + 1))
+        term[active] *= ratio
+        x[active] += step
+        sums[active] += term[active]
+        active = active[term[active] > sums[active] * np.finfo(np.float64).eps]
+    return sums
+
+
+def fisher_exact_pvalues(a, b, c, d):
+    """Gets the two-sided Fisher's exact test p values of many 2x2 tables [[a, b], [c, d]] at once, as
+    scipy.stats.fisher_exact does one at a time: the probabilities of the tables at least as unlikely as the
+    observed one are summed over both tails, the other tail being found by bisection of the hypergeometric
+    log pmf, and the tails summed outwards from where they start
+    :param a: the top left counts (array)
+    :param b: the top right counts
+    :param c: the bottom left counts
+    :param d: the bottom right counts
+    :returns: the p values, in a flat array
+    """
+    a, b, c, d = (np.asarray(x, dtype=np.int64).ravel() for x in np.broadcast_arrays(a, b, c, d))
+    row_1, total, col_1 = a + b, a + b + c + d, a + c
+    pvalues = np.ones(len(a))
+    # as in scipy, a table with an empty row or column has a p value of 1
+    tested = np.flatnonzero((row_1 > 0) & (c + d > 0) & (col_1 > 0) & (b + d > 0))
+    a, total, row_1, col_1 = a[tested], total[tested], row_1[tested], col_1[tested]
+
+    mode = ((col_1 + 1) * (row_1 + 1)) // (total + 2)
+    log_exact = hypergeom.logpmf(a, total, row_1, col_1)
+    at_mode = np.abs(log_exact - hypergeom.logpmf(mode, total, row_1, col_1)) <= LOG_TOLERANCE
+    below = a < mode
+    for side, is_below in ((below & ~at_mode, True), (~below & ~at_mode, False)):
+        table = (total[side], row_1[side], col_1[side])
+        log_side = log_exact[side]
+        if is_below:
+            # the upper tail starts after the last x from the mode which is more likely than a
+            upper_end = _bisect(mode[side], col_1[side] + 1, lambda lp: lp > log_side + LOG_TOLERANCE, *table)
+            tails = _tail_sums(a[side], -1, *table) + _tail_sums(upper_end + 1, 1, *table)
+        else:
+            # the lower tail ends at the last x below the mode which is not more likely than a
+            lower_end = _bisect(np.full_like(mode[side], -1), mode[side],
+                                lambda lp: lp <= log_side + LOG_TOLERANCE, *table)
+            tails = _tail_sums(a[side], 1, *table) + _tail_sums(lower_end, -1, *table)
+        pvalues[tested[side]] = np.minimum(tails, 1.0)
+    return pvalues
+
+
+@stored('enrichment')
+def get_cooccurrence_table(clusters,
+                           sizes,
+                           counts,
+                           conditions: List[str],
+                           min_observed: int = 1):
+    """Tests every pair of conditions within every cluster for co-occurring more often than their prevalences in
+    the cluster imply, from the counts of get_cluster_cooccurrences
+    :param clusters: the clusters
+    :param sizes: the size of each cluster
+    :param counts: the co-occurrence counts (clusters x conditions x conditions)
+    :param conditions: the names of the conditions
+    :param min_observed: pairs which co-occur fewer times than this in a cluster are left out of the table
+    :returns: a dataframe with a row per cluster and pair of conditions: the observed and expected numbers of
+            patients with both, their ratio (O/E), and the two-sided Fisher's exact p value, also
+            Bonferroni-adjusted for the number of pairs, as get_fischers_coefficients does for the conditions
+    """
+    first, second = np.triu_indices(len(conditions), 1)
+    observed = counts[:, first, second]
+    prevalences = np.diagonal(counts, axis1=1, axis2=2)
+    count_1, count_2 = prevalences[:, first], prevalences[:, second]
+    cluster_idx, pair_idx = np.nonzero(observed >= min_observed)
+    observed = observed[cluster_idx, pair_idx]
+    count_1, count_2 = count_1[cluster_idx, pair_idx], count_2[cluster_idx, pair_idx]
+    size = np.asarray(sizes)[cluster_idx]
+    expected = count_1 * count_2 / size
+    pvalues = fisher_exact_pvalues(observed, count_1 - observed, count_2 - observed,
+                                   size - count_1 - count_2 + observed)
+    conditions = np.asarray(conditions)
+    return pd.DataFrame({'cluster': np.asarray(clusters)[cluster_idx],
+                         'condition_1': conditions[first[pair_idx]],
+                         'condition_2': conditions[second[pair_idx]],
+                         'observed': observed,
+                         'expected': expected,
+                         'oe_ratio': observed / expected,
+                         'pvalue': pvalues,
+                         'adj_pvalue': np.minimum(pvalues * len(first), 1.0)})
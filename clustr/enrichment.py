@@ -0,0 +1,113 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing as mp
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from clustr.cooccurrence import fisher_exact_pvalues
+from clustr.store import stored
+
+
+# the number of patients whose one-hot label rows are built and multiplied at once
+ENRICHMENT_CHUNK_ROWS = 100000
+
+# the data matrix and label codes shared by the worker processes; with the fork start method they are inherited,
+# not copied
+_DATA = None
+_CODES = None
+
+
+def encode_label_runs(label_matrix):
+    """Codes the cluster labels of every run (row) as 0, 1, ... in sorted order, as np.unique would
+    :param label_matrix: the cluster labels, runs x patients; missing labels (NaN) are left out of their run
+    :returns: the codes (runs x patients, -1 where a label is missing), and the clusters of each run, padded with
+            NaN to the most clusters of any run (runs x clusters)
+    """
+    label_matrix = np.atleast_2d(np.asarray(label_matrix))
+    codes = np.empty(label_matrix.shape, dtype=np.int64)
+    uniques = []
+    for run, labels in enumerate(label_matrix):
+        codes[run], run_uniques = pd.factorize(labels, sort=True)
+        uniques.append(np.asarray(run_uniques))
+    clusters = np.full((len(uniques), max(len(u) for u in uniques)), np.nan,
+                       dtype=np.result_type(*uniques, np.float64) if all(u.dtype.kind in 'iuf' for u in uniques)
+                       else object)
+    for run, run_uniques in enumerate(uniques):
+        clusters[run, :len(run_uniques)] = run_uniques
+    return codes, clusters
+
+
+def _init_worker(data_mat,
+                 codes):
+    global _DATA, _CODES
+    _DATA = data_mat
+    _CODES = codes
+
+
+def _get_chunk_counts(start: int,
+                      stop: int,
+                      n_clusters: int):
+    """The condition counts and sizes of every cluster of every run over one chunk of patients: the label codes of
+    all the runs are spread into one one-hot sparse matrix (patients x runs * clusters), so one sparse product
+    counts the conditions of all of them"""
+    codes = _CODES[:, start:stop]
+    n_runs, n_rows = codes.shape
+    labelled = codes >= 0
+    run_idx, row_idx = np.nonzero(labelled)
+    one_hot = sp.csr_matrix((np.ones(len(row_idx), dtype=np.int64), (run_idx * n_clusters + codes[labelled], row_idx)),
+                            shape=(n_runs * n_clusters, n_rows))
+    present = sp.csr_matrix(_DATA[start:stop], dtype=np.int64)
+    return (one_hot @ present).toarray(), np.asarray(one_hot.sum(axis=1)).ravel()
+
+
+@stored('enrichment', ignore=('n_workers',))
+def get_enrichments(data_mat,
+                    label_matrix,
+                    n_workers: int = None):
+    """Computes the enrichment of every condition in every cluster of many runs at once (e.g. the repetitions of
+    lca or kmodes, or the columns of a wide labels table), as get_arfs_prevalences and get_fischers_coefficients
+    do for one labels column. The patients are split into chunks across a process pool which shares the data
+    matrix, and each chunk is counted for all the runs together by one one-hot sparse product
+    :param data_mat: the binary numpy array containing the sample features (patients x conditions)
+    :param label_matrix: the cluster labels, runs x patients; missing labels (NaN) leave the patient out of its run
+    :param n_workers: the number of worker processes; by default, the number of cores
+    :returns: a dictionary of arrays: the clusters of each run (runs x clusters, padded with NaN where a run has
+            fewer clusters), their sizes, and the prevalences, ARFs, two-sided Fisher's exact p values and
+            Bonferroni-adjusted p values (runs x clusters x conditions), NaN for the padded clusters. A run's ARFs
+            and p values, transposed, can be passed to get_bubble_heatmap_input
+    """
+    codes, clusters = encode_label_runs(label_matrix)
+    n_runs, n_clusters = clusters.shape
+    chunks = [(start, min(start + ENRICHMENT_CHUNK_ROWS, len(data_mat)))
+              for start in range(0, len(data_mat), ENRICHMENT_CHUNK_ROWS)]
+    n_workers = max(1, min(n_workers or os.cpu_count() or 1, len(chunks)))
+    if n_workers == 1:
+        _init_worker(data_mat, codes)
+        results = [_get_chunk_counts(start, stop, n_clusters) for start, stop in chunks]
+    else:
+        context = mp.get_context('fork') if 'fork' in mp.get_all_start_methods() else None
+        with ProcessPoolExecutor(max_workers=n_workers, mp_context=context,
+                                 initializer=_init_worker, initargs=(data_mat, codes)) as executor:
+            results = list(executor.map(_get_chunk_counts, *zip(*chunks), [n_clusters] * len(chunks)))
+    counts = sum(result[0] for result in results).reshape(n_runs, n_clusters, -1)
+    sizes = sum(result[1] for result in results).reshape(n_runs, n_clusters)
+
+    # the cohort of each run is the patients labelled in it
+    cohort_counts = counts.sum(axis=1, keepdims=True)
+    cohort_sizes = sizes.sum(axis=1)[:, None, None]
+    cluster_sizes = sizes[:, :, None]
+    present = ~pd.isna(clusters)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        prevalences = counts / cluster_sizes
+        arfs = prevalences / (cohort_counts / cohort_sizes)
+    pvalues = fisher_exact_pvalues(counts, cluster_sizes - counts, cohort_counts - counts,
+                                   cohort_sizes - cluster_sizes - cohort_counts + counts).reshape(counts.shape)
+    adj_pvalues = np.minimum(pvalues * counts.shape[2], 1.0)
+    for values in (prevalences, arfs, pvalues, adj_pvalues):
+        values[~present] = np.nan
+    return {'clusters': clusters,
+            'sizes': sizes,
+            'prevalences': prevalences,
+            'arfs': arfs,
+            'pvalues': pvalues,
+            'adj_pvalues': adj_pvalues}
@@ -0,0 +1,85 @@
+import numpy as np
+from clustr.precision import get_float_dtype
+
+
+# below this many centroids, every row is compared with every centroid; hashing the rows costs more than it saves
+BRUTE_FORCE_K = 32
+
+# identical rows are only looked up once if at most this fraction of a sample of them is distinct
+MAX_DISTINCT_FRACTION = 0.5
+
+# the number of rows sampled to judge how many of them are distinct
+DISTINCT_SAMPLE_ROWS = 10000
+
+
+def pack_rows(data_mat):
+    """Packs the rows of a binary matrix into bytes, eight conditions per byte"""
+    return np.packbits(np.asarray(data_mat, dtype=bool), axis=1)
+
+
+def _get_keys(packed):
+    """One hashable value per row of a packed matrix, so that rows can be sorted and matched as a whole"""
+    packed = np.ascontiguousarray(packed)
+    return packed.view(np.dtype((np.void, packed.shape[1]))).ravel()
+
+
+class HammingIndex:
+    """An index of binary centroids (modes, medoids or fitted rows) which finds the nearest centroid of each row by
+    Hamming distance; as with an argmin over all the distances, ties go to the first centroid.
+    The centroids are hashed on their packed bits, so a row equal to a centroid is resolved without comparisons, and,
+    when a sample shows that many rows repeat (as in cohorts with few conditions per patient), identical rows are only
+    looked up once. The remaining rows are compared with the distinct centroids in chunks, by one matrix product each:
+    the distance from x to c is |x| + |c| - 2 x.c. With few centroids, every row is simply compared with every
+    centroid."""
+
+    def __init__(self, centroids, brute_force_k: int = BRUTE_FORCE_K):
+        """
+        :param centroids: the binary centroids (centroids x conditions)
+        :param brute_force_k: the fewest centroids for which the index is used, instead of comparing every row
+        """
+        centroids = np.asarray(centroids)
+        self.n_centroids = len(centroids)
+        self.brute_force = self.n_centroids < brute_force_k
+        if self.brute_force:
+            self.ids = np.arange(self.n_centroids)
+        else:
+            # the first of identical centroids stands for all of them
+            self._keys, self._key_ids = np.unique(_get_keys(pack_rows(centroids)), return_index=True)
+            self.ids = np.sort(self._key_ids)
+        self._centroids = centroids[self.ids].astype(get_float_dtype())
+        self._weights = self._centroids.sum(axis=1)
+
+    def _compare(self, data_mat, chunk_rows: int):
+        """Finds the nearest centroid of each row by comparing it with every distinct centroid"""
+        labels = np.empty(len(data_mat), dtype=np.int64)
+        dists = np.empty(len(data_mat), dtype=np.int64)
+        for start in range(0, len(data_mat), chunk_rows):
+            chunk = np.asarray(data_mat[start:start + chunk_rows], dtype=self._centroids.dtype)
+            # |x| is the same for every centroid, so it is only added to the nearest
+            partial = self._weights - 2 * (chunk @ self._centroids.T)
+            nearest = np.argmin(partial, axis=1)
+            labels[start:start + chunk_rows] = self.ids[nearest]
+            dists[start:start + chunk_rows] = np.rint(partial[np.arange(len(chunk)), nearest] + chunk.sum(axis=1))
+        return labels, dists
+
+    def query(self, data_mat, chunk_rows: int = 10000):
+        """Finds the nearest centroid of each row
+        :param data_mat: the binary numpy array of the rows
+        :param chunk_rows: the number of rows whose distances to the centroids are held at once
+        :returns: the index of the nearest centroid of each row, and its Hamming distance (the number of differing
+                conditions)
+        """
+        if self.brute_force:
+            return self._compare(data_mat, chunk_rows)
+        sample = np.asarray(data_mat[:DISTINCT_SAMPLE_ROWS])
+        if len(np.unique(_get_keys(pack_rows(sample)))) > MAX_DISTINCT_FRACTION * len(sample):
+            return self._compare(data_mat, chunk_rows)
+        row_keys, first, inverse = np.unique(_get_keys(pack_rows(data_mat)), return_index=True, return_inverse=True)
+        labels = np.empty(len(row_keys), dtype=np.int64)
+        dists = np.zeros(len(row_keys), dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self._keys, row_keys), len(self._keys) - 1)
+        exact = self._keys[positions] == row_keys
+        labels[exact] = self._key_ids[positions[exact]]
+        labels[~exact], dists[~exact] = self._compare(np.asarray(data_mat)[first[~exact]], chunk_rows)
+        inverse = inverse.ravel()
+        return labels[inverse], dists[inverse]
@@ -1,7 +1,14 @@
 from sklearn.cluster import AgglomerativeClustering
-from sklearn.metrics import silhouette_score, davies_bouldin_score, calinski_harabasz_score
+from clustr.scoring import get_scores
 from clustr.utils import dict_to_json
+from clustr.store import stored
 from clustr.startup import logger
+from clustr.plotting import submit_plot, plots_enabled
+from clustr.precision import get_float_dtype
+from clustr.kernels import hamming_distances
+from clustr.planner import get_fit_rows, get_plan_key
+from clustr.hamming_index import HammingIndex
+import numpy as np
 import scipy.cluster.hierarchy as sch
 import scipy.spatial.distance as ssd
 import matplotlib.pyplot as plt
@@ -11,44 +18,103 @@ import sys
 
 sys.setrecursionlimit(100000)
 
+# the number of clusters the agglomerative tree is cut into
+AGG_CLUSTERS = 10
 
+
+def get_distance_matrix(data_mat,
+                        metric: str = 'hamming'):
+    """Gets the square distance matrix of the rows, in the float dtype of the precision mode. Hamming distances
+    are counted straight into the square matrix by the kernel backend (see clustr.kernels); other metrics
+    go through pdist
+    :param data_mat: the binary numpy array containing the sample features
+    :param metric: the metric; default is hamming distance
+    """
+    dtype = get_float_dtype()
+    if metric != 'hamming':
+        return ssd.squareform(ssd.pdist(data_mat, metric=metric)).astype(dtype, copy=False)
+    return hamming_distances(data_mat, dtype)
+
+
+def assign_to_nearest(data_mat,
+                      fit_mat,
+                      fit_labels,
+                      metric: str = 'hamming',
+                      chunk_rows: int = 10000):
+    """Labels each row with the cluster of its nearest fitted row, a chunk of rows at a time
+    :param data_mat: the numpy array containing the sample features
+    :param fit_mat: the rows which were clustered
+    :param fit_labels: the cluster labels of fit_mat
+    :param metric: the metric; default is hamming distance
+    :param chunk_rows: the number of rows whose distances to fit_mat are held at once
+    """
+    fit_labels = np.asarray(fit_labels)
+    if metric == 'hamming':
+        # the fitted rows are indexed once (see clustr.hamming_index)
+        return fit_labels[HammingIndex(fit_mat).query(data_mat, chunk_rows)[0]]
+    labels = np.empty(len(data_mat), dtype=fit_labels.dtype)
+    for start in range(0, len(data_mat), chunk_rows):
+        dists = ssd.cdist(data_mat[start:start + chunk_rows], fit_mat, metric=metric)
+        labels[start:start + chunk_rows] = fit_labels[np.argmin(dists, axis=1)]
+    return labels
+
+
+@stored('fit', outputs='out_folder', keys={'plan': get_plan_key})
 def get_agg_clusters(data_mat,
                      out_folder: str,
                      metric: str = 'hamming',
-                     linkage: str = 'complete'):
+                     linkage: str = 'complete',
+                     plan=None):
     """Gets the hierarchical agglomerative clustering results for a given matrix
     :param data_mat: the numpy array containing the sample features
     :param out_folder: the folder to which the figure files should be written.
     :param metric: the metric type used for clustering; default is hamming distance
     :param linkage: linkage method; default is complete
+    :param plan: the memory plan (see clustr.planner.plan_job); with a deduplicated plan the distinct rows are
+            clustered, and with a sampled plan a sample is clustered and every row takes the label of its nearest
+            sampled row; if None, all rows are clustered
     """
     logger.info(f'Performing agglomerative hierarchical clustering with {linkage} linkage and the {metric} metric.')
-    model = AgglomerativeClustering(n_clusters=10, affinity='precomputed', linkage=linkage)
-    model.fit(ssd.squareform(ssd.pdist(data_mat, metric=metric)))
-    labels = model.labels_
-    sil_score = silhouette_score(data_mat, labels, metric='hamming')
-    db_score = davies_bouldin_score(data_mat, labels)
-    ch_score = calinski_harabasz_score(data_mat, labels)
-    dict_to_json({'silhouette': sil_score,
-                  'davies_boulden': db_score,
-                  'calinski_harabasz': ch_score},
-                 osp.join(out_folder, 'scores.json'))
+    fit_mat, inverse = get_fit_rows(data_mat, plan) if plan else (data_mat, None)
+    model = AgglomerativeClustering(n_clusters=AGG_CLUSTERS, affinity='precomputed', linkage=linkage)
+    model.fit(get_distance_matrix(fit_mat, metric))
+    if inverse is not None:
+        labels = model.labels_[inverse]
+    elif len(fit_mat) < len(data_mat):
+        labels = assign_to_nearest(data_mat, fit_mat, model.labels_, metric, plan['chunk_rows'])
+    else:
+        labels = model.labels_
+    dict_to_json(get_scores(data_mat, labels), osp.join(out_folder, 'scores.json'))
     logger.info(f'Finished agglomerative hierarchical clustering with {linkage} linkage and the {metric} metric.')
     return model, labels
 
 
+def render_dendrogram(linkage_mat,
+                      out_folder: str):
+    """Draws and saves the dendrogram of a precomputed linkage matrix"""
+    fig = plt.figure()
+    try:
+        sch.dendrogram(linkage_mat)
+        plt.savefig(osp.join(out_folder, 'dendrogram.png'), dpi=300, bbox_inches='tight')
+    finally:
+        plt.close(fig)
+
+
 def plot_dendrogram(data_mat,
                     out_folder: str,
                     metric: str = 'hamming',
-                    linkage: str = 'complete'):
+                    linkage: str = 'complete',
+                    plan=None):
     """Plots and saves the corresponding dendrogram for the hierarchical agglomerative clustering
     :param data_mat: the numpy array containing the sample features
     :param out_folder: the folder to which the figure files should be written.
     :param metric: the metric type used for clustering; default is hamming distance
     :param linkage: linkage method; default is complete
+    :param plan: the memory plan (see clustr.planner.plan_job); the dendrogram is drawn over the rows it fits on
     """
+    # the linkage is as costly as the clustering itself, so it is skipped along with the figure
+    if not plots_enabled():
+        return
     logger.info(f'Plotting the dendrogram for {linkage} linkage and the {metric} metric.')
-    dendrogram = sch.dendrogram(sch.linkage(data_mat,
-                                            metric=metric,
-                                            method=linkage))
-    plt.savefig(osp.join(out_folder, 'dendrogram.png'), dpi=300, bbox_inches='tight')
+    fit_mat, _ = get_fit_rows(data_mat, plan) if plan else (data_mat, None)
+    submit_plot(render_dendrogram, sch.linkage(fit_mat, metric=metric, method=linkage), out_folder)
@@ -0,0 +1,186 @@
+import os
+import numpy as np
+from scipy.special import logsumexp
+from clustr.startup import logger
+
+try:
+    import numba
+except ImportError:
+    numba = None
+else:
+    # the worker pools of the package are forked, which numba's TBB threading layer does not survive (the parent
+    # hangs on exit), so the workqueue layer is used unless another one is chosen with NUMBA_THREADING_LAYER
+    if 'NUMBA_THREADING_LAYER' not in os.environ:
+        numba.config.THREADING_LAYER = 'workqueue'
+
+
+KERNEL_BACKENDS = ('numpy', 'numba')
+
+# the backend of the inner loops; see configure_kernels
+_BACKEND = 'numpy'
+
+
+def configure_kernels(backend: str = 'numpy'):
+    """Sets the backend of the inner loops (the EM updates of LCA and the pairwise Hamming distances)
+    :param backend: 'numpy', the default, or 'numba', which runs parallel compiled kernels, cached on disk after
+            the first compilation; if numba is not installed, the numpy kernels are used instead
+    """
+    global _BACKEND
+    if backend not in KERNEL_BACKENDS:
+        raise ValueError(f'Unknown kernel backend {backend}; choose from {list(KERNEL_BACKENDS)}')
+    if backend == 'numba' and numba is None:
+        logger.warning('numba is not installed, so the numpy kernels are used; install it with `pip install numba`.')
+        backend = 'numpy'
+    _BACKEND = backend
+
+
+def get_kernel_backend():
+    """The name of the kernel backend in use"""
+    return _BACKEND
+
+
+def _get_log_params(theta,
+                    weight,
+                    dtype):
+    """Rewrites the Bernoulli mixture so that the log probability of row x under class k is
+    log_base[k] + x . log_odds[k]"""
+    tiny = np.finfo(dtype).tiny
+    log_theta = np.log(np.maximum(theta, tiny))
+    log_not_theta = np.log(np.maximum(1.0 - theta, tiny))
+    log_odds = (log_theta - log_not_theta).astype(dtype)
+    log_base = (log_not_theta.sum(axis=1) + np.log(np.maximum(weight, tiny))).astype(dtype)
+    return log_odds, log_base
+
+
+def _numpy_e_step(data, log_odds, log_base):
+    log_prob = data @ log_odds.T + log_base
+    row_log_likelihood = logsumexp(log_prob, axis=1, keepdims=True)
+    responsibility = np.exp(log_prob - row_log_likelihood)
+    # the total is accumulated in float64 whatever the working dtype
+    return responsibility, float(np.sum(row_log_likelihood, dtype=np.float64))
+
+
+def _numpy_m_step_sums(data, responsibility):
+    return responsibility.sum(axis=0), responsibility.T @ data
+
+
+def _numpy_hamming_distances(data_mat, dtype):
+    present = np.asarray(data_mat, dtype=dtype)
+    absent = 1 - present
+    dists = present @ absent.T
+    dists += absent @ present.T
+    dists /= data_mat.shape[1]
+    return dists
+
+
+if numba is not None:
+    @numba.njit(parallel=True, cache=True)
+    def _numba_e_step_kernel(data, log_odds_t, log_base, responsibility):
+        n_rows, n_cols = data.shape
+        n_components = log_base.shape[0]
+        row_log_likelihood = np.empty(n_rows, dtype=np.float64)
+        for i in numba.prange(n_rows):
+            # the class log probabilities, accumulated over the conditions the row has
+            for k in range(n_components):
+                responsibility[i, k] = log_base[k]
+            for j in range(n_cols):
+                if data[i, j] != 0:
+                    for k in range(n_components):
+                        responsibility[i, k] += log_odds_t[j, k]
+            # normalised in place
+            top = responsibility[i, 0]
+            for k in range(1, n_components):
+                top = max(top, responsibility[i, k])
+            total = 0.0
+            for k in range(n_components):
+                responsibility[i, k] = np.exp(responsibility[i, k] - top)
+                total += responsibility[i, k]
+            for k in range(n_components):
+                responsibility[i, k] /= total
+            row_log_likelihood[i] = top + np.log(total)
+        return row_log_likelihood.sum()
+
+    @numba.njit(parallel=True, cache=True)
+    def _numba_m_step_kernel(data, responsibility, n_chunks):
+        n_rows, n_cols = data.shape
+        n_components = responsibility.shape[1]
+        # each chunk of rows is reduced into its own partial sums, which are added up at the end; they are
+        # accumulated in float64 whatever the working dtype, as a float32 running sum over many rows drifts
+        resp_sums = np.zeros((n_chunks, n_components), dtype=np.float64)
+        weighted_sums = np.zeros((n_chunks, n_components, n_cols), dtype=np.float64)
+        chunk_size = (n_rows + n_chunks - 1) // n_chunks
+        for c in numba.prange(n_chunks):
+            for i in range(c * chunk_size, min((c + 1) * chunk_size, n_rows)):
+                for k in range(n_components):
+                    resp_sums[c, k] += responsibility[i, k]
+                for j in range(n_cols):
+                    if data[i, j] != 0:
+                        for k in range(n_components):
+                            weighted_sums[c, k, j] += responsibility[i, k]
+        return resp_sums.sum(axis=0), weighted_sums.sum(axis=0)
+
+    @numba.njit(parallel=True, cache=True)
+    def _numba_hamming_kernel(packed, n_cols, dists, block_size):
+        n_rows, n_bytes = packed.shape
+        n_blocks = (n_rows + block_size - 1) // block_size
+        # the number of set bits of each byte
+        popcount = np.zeros(256, dtype=np.uint8)
+        for byte in range(256):
+            popcount[byte] = popcount[byte >> 1] + (byte & 1)
+        # a block of rows is compared with the rows from that block onwards while it stays in cache;
+        # the lower triangle is mirrored
+        for b in numba.prange(n_blocks):
+            start, stop = b * block_size, min((b + 1) * block_size, n_rows)
+            for j in range(start, n_rows):
+                for i in range(start, min(stop, j + 1)):
+                    count = 0
+                    for c in range(n_bytes):
+                        count += popcount[packed[i, c] ^ packed[j, c]]
+                    dists[i, j] = count / n_cols
+                    dists[j, i] = dists[i, j]
+
+
+def e_step(data,
+           theta,
+           weight):
+    """Gets the posterior class probabilities of each row under a Bernoulli mixture, and the total log likelihood,
+    in one fused pass
+    :param data: the binary numpy array, in the working float dtype
+    :param theta: the per-class condition probabilities (classes x conditions)
+    :param weight: the class weights
+    :returns: the responsibility matrix (rows x classes), in the dtype of data, and the log likelihood
+    """
+    log_odds, log_base = _get_log_params(theta, weight, data.dtype)
+    if _BACKEND == 'numba':
+        responsibility = np.empty((len(data), len(log_base)), dtype=data.dtype)
+        log_likelihood = _numba_e_step_kernel(data, np.ascontiguousarray(log_odds.T), log_base, responsibility)
+        return responsibility, float(log_likelihood)
+    return _numpy_e_step(data, log_odds, log_base)
+
+
+def m_step_sums(data,
+                responsibility):
+    """Gets the weighted reductions of the M-step
+    :param data: the binary numpy array
+    :param responsibility: the responsibility matrix (rows x classes)
+    :returns: the sum of responsibilities per class, and the responsibility-weighted condition sums (classes x conditions)
+    """
+    if _BACKEND == 'numba':
+        resp_sums, weighted_sums = _numba_m_step_kernel(data, responsibility, numba.get_num_threads())
+        return resp_sums.astype(responsibility.dtype), weighted_sums.astype(responsibility.dtype)
+    return _numpy_m_step_sums(data, responsibility)
+
+
+def hamming_distances(data_mat,
+                      dtype=np.float64):
+    """Gets the square matrix of pairwise Hamming distances (the fraction of differing conditions) of the rows
+    :param data_mat: the binary numpy array containing the sample features
+    :param dtype: the float dtype of the distances
+    """
+    if _BACKEND == 'numba':
+        dists = np.empty((len(data_mat), len(data_mat)), dtype=dtype)
+        # eight conditions per byte, compared by xor
+        packed = np.packbits(np.asarray(data_mat, dtype=bool), axis=1)
+        _numba_hamming_kernel(packed, data_mat.shape[1], dists, 64)
+        return dists
+    return _numpy_hamming_distances(data_mat, dtype)
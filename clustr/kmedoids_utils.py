@@ -2,57 +2,89 @@ import os.path as osp
 from typing import List
 from sklearn_extra.cluster import KMedoids
 from clustr.startup import logger
-from sklearn.metrics import silhouette_score, davies_bouldin_score, calinski_harabasz_score
-from clustr.utils import dict_to_json
+from sklearn.metrics import pairwise_distances
+from clustr.precision import get_float_dtype
+from clustr.planner import get_fit_rows, get_plan_key
+from clustr.progress import Progress
+from clustr.scoring import get_scores, get_silhouette
+from clustr.utils import dict_to_json, get_checkpoint_key, load_checkpoint, write_checkpoint
+from clustr.store import stored
 from collections import OrderedDict
 
 
 def calculate_kmedoids(data_mat,
                        min_k: int = 1,
-                       max_k: int = 10):
+                       max_k: int = 10,
+                       checkpoint_file: str = None,
+                       plan=None):
     """Gets an array of costs per K
     :param data_mat: the numpy array containing the sample features
     :param min_k: the minimum k clusters to test
     :param max_k: the maximum k clusters to test
+    :param checkpoint_file: a file to which each finished k is written; k values already
+            in it are skipped, so an interrupted sweep can be resumed
+    :param plan: the memory plan (see clustr.planner.plan_job); with a sampled plan the costs and scores are
+            those of a sample; if None, all rows are used
     """
     logger.info(f'Choosing k for k-medoids clustering with cosine similarity.')
+    key = get_checkpoint_key(data_mat)
+    done = load_checkpoint(checkpoint_file, key)
     cost = OrderedDict()
     sil_scores = OrderedDict()
-    for cluster in range(min_k, max_k+1):
-        cobj = KMedoids(n_clusters=cluster, random_state=0, metric='cosine').fit(data_mat)
-        logger.info('Cluster initiation: {}'.format(cluster))
-        labels = cobj.labels_
-        cost[cluster] = cobj.inertia_
-        try:
-            sil_scores[cluster] = silhouette_score(data_mat, labels, metric='hamming')
-        except ValueError:
-            sil_scores[cluster] = -1
+    data_mat, _ = get_fit_rows(data_mat, plan) if plan else (data_mat, None)
+    # the distance matrix is the same for every k, so it is computed once
+    dists = None
+    with Progress('k-medoids sweep', max_k - min_k + 1, len(data_mat), unit='k') as progress:
+        for cluster in range(min_k, max_k+1):
+            if cluster in done:
+                cost[cluster] = done[cluster]['cost']
+                sil_scores[cluster] = done[cluster]['silhouette']
+                progress.update(k=cluster, cost=cost[cluster], silhouette=sil_scores[cluster])
+                continue
+            if dists is None:
+                dists = pairwise_distances(data_mat.astype(get_float_dtype(), copy=False), metric='cosine')
+            cobj = KMedoids(n_clusters=cluster, random_state=0, metric='precomputed').fit(dists)
+            logger.info('Cluster initiation: {}'.format(cluster))
+            labels = cobj.labels_
+            # as Python floats, which JSON can write whatever the precision mode
+            cost[cluster] = float(cobj.inertia_)
+            try:
+                sil_scores[cluster] = float(get_silhouette(data_mat, labels))
+            except ValueError:
+                sil_scores[cluster] = -1
+            done[cluster] = {'cost': cost[cluster], 'silhouette': sil_scores[cluster]}
+            write_checkpoint(done, checkpoint_file, key)
+            progress.update(k=cluster, cost=cost[cluster], silhouette=sil_scores[cluster])
 
     return cost, sil_scores
 
 
+@stored('fit', outputs='out_folder', seeds=('random_state',), keys={'plan': get_plan_key})
 def fit_kmedoids(data_mat,
                  out_folder: str,
                  cgrps: List[str],
-                 k: int = 10):
+                 k: int = 10,
+                 plan=None,
+                 random_state: int = None):
     """
     Fits KMedoids model to data
     :param data_mat: the numpy array containing the sample features
     :param out_folder: the folder to which the figure files should be written.
     :param cgrps: an array of the condition groups being clustered
     :param k: the number k clusters
+    :param plan: the memory plan (see clustr.planner.plan_job); with a sampled plan the medoids are fitted on a
+            sample and every row is assigned to its nearest medoid; if None, all rows are used
+    :param random_state: the seed of the medoid initialisation; unseeded fits are not stored (see clustr.store)
     :returns: the KMedoids model and the corresponding cluster labels
     """
     logger.info(f'Performing k-medoids clustering with cosine similarity.')
-    cobj = KMedoids(n_clusters=k, random_state=None, metric='cosine').fit(data_mat)
-    labels = cobj.labels_
-    db_score = davies_bouldin_score(data_mat, labels)
-    ch_score = calinski_harabasz_score(data_mat, labels)
-    sil_score = silhouette_score(data_mat, labels, metric='hamming')
-    dict_to_json({'silhouette': sil_score,
-        'davies_boulden': db_score,
-        'calinski_harabasz': ch_score},
-        osp.join(out_folder, 'scores.json'))
+    fit_mat, _ = get_fit_rows(data_mat, plan) if plan else (data_mat, None)
+    cobj = KMedoids(n_clusters=k, random_state=random_state, metric='cosine').fit(fit_mat.astype(get_float_dtype(), copy=False))
+    if len(fit_mat) < len(data_mat):
+        labels = cobj.predict(data_mat.astype(get_float_dtype(), copy=False))
+    else:
+        labels = cobj.labels_
+    dict_to_json(get_scores(data_mat, labels), osp.join(out_folder, 'scores.json'))
     # write centroids to file
     centroid_comorbidities = {}
     for count, cntrd in enumerate(cobj.cluster_centers_):
@@ -1,67 +1,289 @@
-from kmodes.kmodes import KModes
+from kmodes.kmodes import KModes, init_huang
+from kmodes.util.dissim import matching_dissim
+import numpy as np
 from clustr.startup import logger
 from typing import List
 import os.path as osp
-from sklearn.metrics import silhouette_score, davies_bouldin_score, calinski_harabasz_score
-from clustr.utils import dict_to_json
+from clustr.progress import Progress
+from clustr.hamming_index import HammingIndex
+from clustr.scoring import get_scores, get_silhouette, get_streamed_scores
+from clustr.utils import dict_to_json, get_checkpoint_key, load_checkpoint, write_checkpoint, warn_warm_start_k
+from clustr.store import stored
 import matplotlib.pyplot as plt
 import pandas as pd
 from collections import OrderedDict
 
 
+# the most passes of mini-batch k-modes over the cohort, before the labelling pass
+MINIBATCH_PASSES = 5
+
+
 def calculate_kmodes(data_mat,
                      min_k=1,
                      max_k=10,
-                     distance_metric='Huang'):
-    """Gets an array of costs per K"""
+                     distance_metric='Huang',
+                     checkpoint_file: str = None):
+    """Gets an array of costs per K
+    :param checkpoint_file: a file to which each finished k is written; k values already
+            in it are skipped, so an interrupted sweep can be resumed
+    """
     logger.info(f'Choosing k for k-modes clustering with Huang metric.')
+    key = get_checkpoint_key(data_mat)
+    done = load_checkpoint(checkpoint_file, key)
     cost = OrderedDict()
     sil_scores = OrderedDict()
-    for cluster in range(min_k, max_k+1):
-        logger.info('Cluster initiation: {}'.format(cluster))
-        kmodes = KModes(n_jobs=-1, n_clusters=cluster, init=distance_metric,
-                         n_init=1, random_state=0)
-        kmodes.fit_predict(data_mat)
-        labels = kmodes.labels_
-        cost[cluster] = kmodes.cost_
-        try:
-            sil_scores[cluster] = silhouette_score(data_mat, labels, metric='hamming')
-        except ValueError:
-            sil_scores[cluster] = -1
+    with Progress('k-modes sweep', max_k - min_k + 1, len(data_mat), unit='k') as progress:
+        for cluster in range(min_k, max_k+1):
+            if cluster in done:
+                cost[cluster] = done[cluster]['cost']
+                sil_scores[cluster] = done[cluster]['silhouette']
+                progress.update(k=cluster, cost=cost[cluster], silhouette=sil_scores[cluster])
+                continue
+            logger.info('Cluster initiation: {}'.format(cluster))
+            kmodes = KModes(n_jobs=-1, n_clusters=cluster, init=distance_metric,
+                             n_init=1, random_state=0)
+            kmodes.fit_predict(data_mat)
+            labels = kmodes.labels_
+            # as Python floats, which JSON can write whatever the precision mode
+            cost[cluster] = float(kmodes.cost_)
+            try:
+                sil_scores[cluster] = float(get_silhouette(data_mat, labels))
+            except ValueError:
+                sil_scores[cluster] = -1
+            done[cluster] = {'cost': cost[cluster], 'silhouette': sil_scores[cluster]}
+            write_checkpoint(done, checkpoint_file, key)
+            progress.update(k=cluster, cost=cost[cluster], silhouette=sil_scores[cluster])
 
     return cost, sil_scores
 
 
+def get_kmodes_counts(data_mat,
+                      labels,
+                      k: int):
+    """Gets the per-cluster condition counts (k x conditions) and cluster sizes from which
+    the binary modes can be derived
+    :param data_mat: the numpy array containing the sample features
+    :param labels: the cluster label of each row
+    :param k: the number k clusters
+    """
+    labels = np.asarray(labels)
+    counts = np.zeros((k, data_mat.shape[1]), dtype=np.int64)
+    np.add.at(counts, labels, data_mat)
+    sizes = np.bincount(labels, minlength=k)
+    return counts, sizes
+
+
+def counts_to_modes(counts,
+                    sizes):
+    """Derives the binary modes from the per-cluster condition counts;
+    a condition is in the mode if more than half of the cluster has it"""
+    return (2 * counts > sizes[:, np.newaxis]).astype(int)
+
+
+def assign_to_modes(data_mat,
+                    centroids):
+    """Assigns each row to the binary mode with the smallest Hamming distance (see clustr.hamming_index)"""
+    return HammingIndex(centroids).query(data_mat)[0]
+
+
+def save_kmodes_state(out_folder: str,
+                      centroids,
+                      counts,
+                      sizes):
+    """Writes the modes and their count matrices to kmodes_state.npz so that a later
+    run can warm start from them"""
+    np.savez(osp.join(out_folder, 'kmodes_state.npz'), centroids=centroids, counts=counts, sizes=sizes)
+
+
+def load_kmodes_state(in_folder: str):
+    """Loads the modes and count matrices written by save_kmodes_state
+    :param in_folder: the results folder of a previous k-modes run, containing kmodes_state.npz
+    :returns: the centroids, the per-cluster condition counts, and the cluster sizes
+    """
+    state = np.load(osp.join(in_folder, 'kmodes_state.npz'))
+    return state['centroids'], state['counts'], state['sizes']
+
+
+def write_kmodes_results(data_mat,
+                         labels,
+                         centroids,
+                         out_folder: str,
+                         cgrps: List[str]):
+    """Writes the scores, centroids and count matrices for a k-modes result"""
+    dict_to_json(get_scores(data_mat, labels), osp.join(out_folder, 'scores.json'))
+    write_kmodes_centroids(centroids, out_folder, cgrps)
+    counts, sizes = get_kmodes_counts(data_mat, labels, len(centroids))
+    save_kmodes_state(out_folder, np.asarray(centroids), counts, sizes)
+
+
+def write_kmodes_centroids(centroids,
+                           out_folder: str,
+                           cgrps: List[str]):
+    """Writes the conditions of each mode to centroids.json"""
+    centroid_comorbidities = {}
+    for count, cntrd in enumerate(centroids):
+        centroid_comorbidities[count] = []
+        for count2, m in enumerate(cntrd):
+            if m == 1:
+                centroid_comorbidities[count].append(cgrps[count2])
+    dict_to_json(centroid_comorbidities, osp.join(out_folder, 'centroids.json'))
+
+
+@stored('fit', outputs='out_folder', seeds=('init_centroids', 'random_state'))
 def fit_kmodes(data_mat,
                out_folder: str,
                cgrps: List[str],
-               k: int = 10):
+               k: int = 10,
+               init_centroids=None,
+               random_state: int = None):
     """Fits KModes model to data
     :param data_mat: the numpy array containing the sample features
     :param out_folder: the folder to which the figure files should be written.
     :param cgrps: an array of the condition groups being clustered
     :param k: the number k clusters
+    :param init_centroids: the centroids of a previous run (see load_kmodes_state) to warm start from;
+            if None, Huang initialisation is used
+    :param random_state: the seed of the Huang initialisation; unseeded fits are not stored (see clustr.store)
     :returns: the KModes model and the corresponding cluster labels
     """
     logger.info(f'Performing k-modes clustering with Huang metric.')
-    kmodes = KModes(n_jobs=-1, n_clusters=k,
-                    init='Huang', random_state=None, n_init=1)
-    kmodes.fit_predict(data_mat)
+    if init_centroids is None:
+        kmodes = KModes(n_jobs=-1, n_clusters=k,
+                        init='Huang', random_state=random_state, n_init=1)
+    else:
+        warn_warm_start_k(k, len(init_centroids))
+        kmodes = KModes(n_jobs=-1, n_clusters=len(init_centroids),
+                        init=np.asarray(init_centroids), n_init=1)
+    # the iterations run inside KModes, so the fit is reported as one step, with its cost
+    with Progress(f'k-modes k={kmodes.n_clusters}', 1, len(data_mat)) as progress:
+        kmodes.fit_predict(data_mat)
+        progress.update(cost=kmodes.cost_, iterations=kmodes.n_iter_)
     labels = kmodes.labels_
-    db_score = davies_bouldin_score(data_mat, labels)
-    ch_score = calinski_harabasz_score(data_mat, labels)
-    sil_score = silhouette_score(data_mat, labels, metric='hamming')
-    dict_to_json({'silhouette': sil_score,
-        'davies_boulden': db_score,
-        'calinski_harabasz': ch_score},
-        osp.join(out_folder, 'scores.json'))
-    # write centroids to file
-    centroid_comorbidities = {}
-    for count, cntrd in enumerate(kmodes.cluster_centroids_):
-        centroid_comorbidities[count] = []
-        for count2, m in enumerate(cntrd):
-            if m == 1:
-                centroid_comorbidities[count].append(cgrps[count2])
-    dict_to_json(centroid_comorbidities, osp.join(out_folder, 'centroids.json'))
+    write_kmodes_results(data_mat, labels, kmodes.cluster_centroids_, out_folder, cgrps)
     logger.info(f'Finished k-modes clustering with Huang metric.')
     return kmodes, labels
+
+
+def fit_minibatch_kmodes(get_batches,
+                         out_folder: str,
+                         cgrps: List[str],
+                         k: int = 10,
+                         init_centroids=None,
+                         max_passes: int = MINIBATCH_PASSES,
+                         random_state: int = None):
+    """Fits k-modes on a cohort streamed in batches of rows, so that it never has to be in memory at once. Each
+    batch is assigned to the current modes and added onto the per-cluster condition counts of the pass, and the
+    modes of the clusters with rows so far are derived again from those counts. Passes are repeated until a pass
+    leaves the modes as they were, or max_passes. Then one pass labels every row, and one more scores the result.
+    :param get_batches: a function returning a new iterator over the cohort as (dataframe, matrix, condition names)
+            batches, with the same rows in the same order every time (see clustr.utils.iter_data_chunks)
+    :param out_folder: the folder to which the result files should be written.
+    :param cgrps: an array of the condition groups being clustered
+    :param k: the number k clusters
+    :param init_centroids: the centroids of a previous run (see load_kmodes_state) to warm start from;
+            if None, they are drawn from the first batch by Huang initialisation
+    :param max_passes: the most passes over the cohort before the labelling pass
+    :param random_state: the seed of the initialisation
+    :returns: the modes, and a dataframe of the cluster label (kmodes_cluster_labels) and number of conditions
+            (tot_conditions) of each row, indexed by patient ID
+    """
+    logger.info(f'Performing mini-batch k-modes clustering with Huang metric.')
+    if init_centroids is None:
+        batches = get_batches()
+        _, first_batch, _ = next(batches)
+        batches.close()
+        init_centroids = init_huang(first_batch, k, matching_dissim, np.random.RandomState(random_state))
+    else:
+        warn_warm_start_k(k, len(init_centroids))
+    centroids = np.array(init_centroids, dtype=int)
+    k = len(centroids)
+
+    with Progress(f'mini-batch k-modes k={k}', max_passes, unit='pass') as progress:
+        for _ in range(max_passes):
+            start_centroids = centroids.copy()
+            counts, sizes = np.zeros(centroids.shape, dtype=np.int64), np.zeros(k, dtype=np.int64)
+            for _, batch, _ in get_batches():
+                batch_counts, batch_sizes = get_kmodes_counts(batch, assign_to_modes(batch, centroids), k)
+                counts += batch_counts
+                sizes += batch_sizes
+                # clusters without rows so far in this pass keep their modes
+                seen = sizes > 0
+                centroids[seen] = counts_to_modes(counts[seen], sizes[seen])
+            changed = int(np.sum(centroids != start_centroids))
+            progress.update(changed=changed)
+            if not changed:
+                break
+
+    # the labelling pass, which also gathers the count matrices of the final labels
+    counts, sizes = np.zeros(centroids.shape, dtype=np.int64), np.zeros(k, dtype=np.int64)
+    cost, labelled = 0, []
+    index = HammingIndex(centroids)
+    for df, batch, _ in get_batches():
+        labels, dists = index.query(batch)
+        cost += int(dists.sum())
+        batch_counts, batch_sizes = get_kmodes_counts(batch, labels, k)
+        counts += batch_counts
+        sizes += batch_sizes
+        labelled.append(pd.DataFrame({'kmodes_cluster_labels': labels, 'tot_conditions': df['tot_conditions']},
+                                     index=df.index))
+    labelled = pd.concat(labelled)
+    logger.info(f'Mini-batch k-modes cost: {cost}')
+
+    # the scoring pass
+    def get_labelled_batches():
+        start = 0
+        for _, batch, _ in get_batches():
+            yield batch, labelled['kmodes_cluster_labels'].to_numpy()[start:start + len(batch)]
+            start += len(batch)
+    dict_to_json(get_streamed_scores(get_labelled_batches(), sizes, counts), osp.join(out_folder, 'scores.json'))
+    write_kmodes_centroids(centroids, out_folder, cgrps)
+    save_kmodes_state(out_folder, centroids, counts, sizes)
+    logger.info(f'Finished mini-batch k-modes clustering with Huang metric.')
+    return centroids, labelled
+
+
+def get_matrix_batches(df: pd.DataFrame,
+                       mat,
+                       cgrps: List[str],
+                       batch_size: int):
+    """Splits a cohort in memory into batches of rows, as fit_minibatch_kmodes takes them"""
+    for start in range(0, len(mat), batch_size):
+        yield df.iloc[start:start + batch_size], mat[start:start + batch_size], cgrps
+
+
+def update_kmodes(data_mat,
+                  out_folder: str,
+                  cgrps: List[str],
+                  prev_state,
+                  update_rows,
+                  max_iter: int = 10):
+    """Updates the modes of a previous k-modes run with new rows only, by adding the new rows
+    onto the previous per-cluster condition counts; then labels all rows against the updated modes
+    :param data_mat: the numpy array containing the sample features
+    :param out_folder: the folder to which the figure files should be written.
+    :param cgrps: an array of the condition groups being clustered
+    :param prev_state: the (centroids, counts, sizes) of the previous run (see load_kmodes_state)
+    :param update_rows: boolean mask of the rows in data_mat which the previous run has not seen
+    :param max_iter: the maximum number of reassignments of the new rows
+    :returns: the updated centroids and the corresponding cluster labels
+    """
+    logger.info(f'Updating k-modes clusters with {int(np.sum(update_rows))} new rows.')
+    centroids, counts, sizes = prev_state
+    new_mat = data_mat[update_rows]
+    # with no new rows, the modes are kept and only the labels are written
+    if len(new_mat):
+        new_labels = assign_to_modes(new_mat, centroids)
+        with Progress('k-modes update', max_iter, len(new_mat)) as progress:
+            for _ in range(max_iter):
+                new_counts, new_sizes = get_kmodes_counts(new_mat, new_labels, len(centroids))
+                centroids = counts_to_modes(counts + new_counts, sizes + new_sizes)
+                relabelled = assign_to_modes(new_mat, centroids)
+                moved = int(np.sum(relabelled != new_labels))
+                progress.update(moved=moved)
+                if not moved:
+                    break
+                new_labels = relabelled
+    labels = assign_to_modes(data_mat, centroids)
+    write_kmodes_results(data_mat, labels, centroids, out_folder, cgrps)
+    logger.info(f'Finished updating k-modes clusters.')
+    return centroids, labels
@@ -1,14 +1,59 @@
+import hashlib
+import os
+import os.path as osp
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 import numpy as np
 import scipy.stats as stats
+from clustr.kernels import e_step, m_step_sums, get_kernel_backend
+from clustr.sharded import get_shard_shape, get_shard_key, get_shard_statistics, get_shard_labels
+from clustr.utils import get_checkpoint_key
+from clustr.progress import Progress
+
+
+# the convergence criteria of EM: the change of the log likelihood between iterations is compared with tol,
+# with tol times the log likelihood, or with tol times the number of rows
+CONVERGENCE_CRITERIA = ('absolute', 'relative', 'per_sample')
+
+# the factor by which the longest SQUAREM step grows or shrinks
+SQUAREM_STEP_FACTOR = 4.0
 
 
 class LCA:
-    def __init__(self, n_components=2, tol=1e-3, max_iter=100, random_state=None):
+    def __init__(self, n_components=2, tol=1e-3, max_iter=100, random_state=None, warm_start=False,
+                 checkpoint_file=None, checkpoint_every=10, dtype=np.float64, convergence='absolute',
+                 accelerate=False):
+        if convergence not in CONVERGENCE_CRITERIA:
+            raise ValueError(f'Unknown convergence criterion {convergence}; choose from {list(CONVERGENCE_CRITERIA)}')
         self.n_components = n_components
         self.random_state = random_state
         self.tol = tol
         self.max_iter = max_iter
 
+        # how tol is compared with the change of the log likelihood; see CONVERGENCE_CRITERIA
+        self.convergence = convergence
+
+        # run SQUAREM iterations (three E-steps each) instead of plain EM ones
+        self.accelerate = accelerate
+
+        # the longest SQUAREM step allowed; it starts at a plain EM step and grows while the steps succeed
+        self._step_max = 1.0
+
+        # reuse the current weight/theta as the starting point of the next fit
+        self.warm_start = warm_start
+
+        # EM state is saved to checkpoint_file every checkpoint_every iterations, and an
+        # interrupted fit resumes from it
+        self.checkpoint_file = checkpoint_file
+        self.checkpoint_every = checkpoint_every
+
+        # the fingerprint of the data being fitted, saved with the checkpoints so that only a fit on the same data
+        # resumes from them
+        self._checkpoint_key = None
+
+        # dtype of the data, posteriors and parameters during EM; float32 halves the memory traffic
+        self.dtype = dtype
+
         # flag to indicate if converged
         self.converged_ = False
 
@@ -18,6 +63,16 @@ class LCA:
         self.theta = None
         self.responsibility = None
 
+        # sufficient statistics (sum of r, sum of r*x, rows) of the rows seen so far
+        self.resp_sum_ = None
+        self.weighted_sum_ = None
+        self.n_rows_ = 0
+
+        # sufficient statistics of earlier rows which are held fixed during partial_fit
+        self._prior_resp_sum = 0.0
+        self._prior_weighted_sum = 0.0
+        self._prior_n_rows = 0
+
         # bic estimation
         self.bic = None
 
@@ -26,13 +81,7 @@ class LCA:
 
     def _calculate_responsibility(self, data):
 
-        n_rows, n_cols = np.shape(data)
-        r_numerator = np.zeros(shape=(n_rows, self.n_components))
-        for k in range(self.n_components):
-            r_numerator[:, k] = self.weight[k] * np.prod(stats.bernoulli.pmf(
-                data, p=self.theta[k]), axis=1)
-        r_denominator = np.sum(r_numerator, axis=1)
-        return r_numerator / np.tile(r_denominator, (self.n_components, 1)).T
+        return e_step(np.asarray(data, dtype=self.dtype), self.theta, self.weight)[0]
 
     def _do_e_step(self, data):
 
@@ -41,19 +90,21 @@ class LCA:
     def _do_m_step(self, data):
 
         n_rows, n_cols = np.shape(data)
+        resp_sum, weighted_sum = m_step_sums(data, self.responsibility)
+        self._update_params(resp_sum, weighted_sum, n_rows)
+
+    def _update_params(self, resp_sum, weighted_sum, n_rows):
+
+        # sufficient statistics, added onto those of any earlier rows
+        self.resp_sum_ = resp_sum + self._prior_resp_sum
+        self.weighted_sum_ = weighted_sum + self._prior_weighted_sum
+        self.n_rows_ = n_rows + self._prior_n_rows
 
         # pi
-        for k in range(self.n_components):
-            self.weight[k] = np.sum(self.responsibility[:, k]) / float(n_rows)
+        self.weight = (self.resp_sum_ / float(self.n_rows_)).astype(self.dtype, copy=False)
 
         # theta
-        for k in range(self.n_components):
-            numerator = np.zeros((n_rows, n_cols))
-            for n in range(n_rows):
-                numerator[n, :] = self.responsibility[n, k] * data[n, :]
-            numerator = np.sum(numerator, axis=0)
-            denominator = np.sum(self.responsibility[:, k])
-            self.theta[k] = numerator / denominator
+        self.theta = (self.weighted_sum_ / self.resp_sum_[:, np.newaxis]).astype(self.dtype, copy=False)
 
         # correct numerical issues
         mask = self.theta > 1.0
@@ -61,11 +112,87 @@ class LCA:
         mask = self.theta < 0.0
         self.theta[mask] = 0.0
 
-    def fit(self, data):
+    def _get_statistics(self, data):
+        """The E-step over data, fused with the log likelihood, and the sums the next M-step needs"""
+        self.responsibility, log_likelihood = e_step(data, self.theta, self.weight)
+        resp_sum, weighted_sum = m_step_sums(data, self.responsibility)
+        return resp_sum, weighted_sum, log_likelihood
 
-        # initialization step
-        n_rows, n_cols = np.shape(data)
-        if n_rows < self.n_components:
+    def _squarem_step(self, resp_sum, weighted_sum, n_rows, get_statistics):
+        """One SQUAREM iteration (Varadhan & Roland, 2008): two EM steps from the current parameters, then a jump
+        along their squared extrapolation. If the jump lowers the log likelihood below that of the second EM step,
+        the second EM step is kept instead, so that the log likelihood never decreases. The step length is bounded
+        by _step_max, which grows fourfold whenever a full-length step is taken and shrinks after a rejected one.
+        :returns: the statistics of the new parameters, as those of get_statistics
+        """
+        start = np.concatenate([self.weight, self.theta.ravel()]).astype(np.float64)
+        self._update_params(resp_sum, weighted_sum, n_rows)
+        first = np.concatenate([self.weight, self.theta.ravel()]).astype(np.float64)
+        resp_sum, weighted_sum, _ = get_statistics()
+        self._update_params(resp_sum, weighted_sum, n_rows)
+        weight, theta = self.weight.copy(), self.theta.copy()
+        second_statistics = get_statistics()
+
+        step = first - start
+        curvature = np.concatenate([weight, theta.ravel()]) - 2 * first + start
+        if not np.any(curvature):
+            return second_statistics
+        # the step length of the SqS3 scheme; -1 lands on the second EM step
+        alpha = -min(max(np.sqrt(np.sum(step ** 2) / np.sum(curvature ** 2)), 1.0), self._step_max)
+        if -alpha == self._step_max:
+            self._step_max *= SQUAREM_STEP_FACTOR
+        if alpha == -1.0:
+            return second_statistics
+        jump = start - 2 * alpha * step + alpha ** 2 * curvature
+
+        # back into the parameter space
+        jump_weight = np.maximum(jump[:self.n_components], np.finfo(self.dtype).tiny)
+        self.weight = (jump_weight / jump_weight.sum()).astype(self.dtype)
+        self.theta = np.clip(jump[self.n_components:], 0.0, 1.0).reshape(theta.shape).astype(self.dtype)
+        jump_statistics = get_statistics()
+        if jump_statistics[2] >= second_statistics[2]:
+            return jump_statistics
+        self.weight, self.theta = weight, theta
+        self._step_max = max(1.0, self._step_max / SQUAREM_STEP_FACTOR)
+        return second_statistics
+
+    def _has_converged(self, ll_val, n_rows):
+        """Whether the log likelihood ll_val changed from the last one by less than the tolerance of the
+        convergence criterion (see CONVERGENCE_CRITERIA)"""
+        change = np.abs(ll_val - self.ll_[-1])
+        if self.convergence == 'relative':
+            tol = self.tol * np.abs(ll_val)
+        elif self.convergence == 'per_sample':
+            tol = self.tol * n_rows
+        else:
+            tol = self.tol
+        # the log likelihood is not resolved more finely than the rounding of the working dtype
+        return change < max(tol, np.finfo(self.dtype).eps * np.abs(ll_val))
+
+    def _save_checkpoint(self, n_iter):
+        # write to a temporary file first so that a crash never leaves a truncated checkpoint
+        tmp_file = self.checkpoint_file + '.tmp.npz'
+        np.savez(tmp_file, weight=self.weight, theta=self.theta, ll=np.array(self.ll_), n_iter=n_iter,
+                 key=self._checkpoint_key)
+        os.replace(tmp_file, self.checkpoint_file)
+
+    def _load_checkpoint(self, n_cols):
+        if not self.checkpoint_file or not osp.exists(self.checkpoint_file):
+            return 0
+        state = np.load(self.checkpoint_file)
+        # a checkpoint written for other data, or before the checkpoints had keys, is ignored
+        if 'key' not in state.files or str(state['key']) != self._checkpoint_key:
+            return 0
+        if state['theta'].shape != (self.n_components, n_cols):
+            return 0
+        self.weight = state['weight'].astype(self.dtype)
+        self.theta = state['theta'].astype(self.dtype)
+        self.ll_ = list(state['ll'])
+        return int(state['n_iter']) + 1
+
+    def _initialize(self, n_rows, n_cols, key=None):
+
+        if n_rows < self.n_components and not self._prior_n_rows:
             raise ValueError(
                 '''
                 LCA estimation with {n_components} components, but got only
@@ -75,35 +202,153 @@ class LCA:
         if self.verbose > 0:
             print('EM algorithm started')
 
-        self.weight = stats.dirichlet.rvs(np.ones(shape=self.n_components) / 2, random_state=self.random_state)[0]
-        self.theta = stats.dirichlet.rvs(alpha=np.ones(shape=n_cols) / 2,
-                                         size=self.n_components,
-                                         random_state=self.random_state)
+        if self.warm_start and self.theta is not None:
+            if np.shape(self.theta) != (self.n_components, n_cols):
+                raise ValueError(
+                    '''
+                    Cannot warm start LCA with theta of shape {theta_shape} on
+                    data with {n_cols} columns
+                    '''.format(theta_shape=np.shape(self.theta), n_cols=n_cols))
+            self.weight = np.array(self.weight, dtype=self.dtype)
+            self.theta = np.array(self.theta, dtype=self.dtype)
+        else:
+            self.weight = stats.dirichlet.rvs(np.ones(shape=self.n_components) / 2,
+                                              random_state=self.random_state)[0].astype(self.dtype)
+            self.theta = stats.dirichlet.rvs(alpha=np.ones(shape=n_cols) / 2,
+                                             size=self.n_components,
+                                             random_state=self.random_state).astype(self.dtype)
+        self.ll_ = [-np.inf]
+        self._step_max = 1.0
+        self._checkpoint_key = key
+        return self._load_checkpoint(n_cols)
+
+    def _run_em(self, n_rows, start_iter, get_statistics):
+        """Runs EM from the current parameters; get_statistics returns the sums of the responsibilities and of
+        the responsibility-weighted rows, and the log likelihood, of all rows under the current parameters"""
+
+        resp_sum, weighted_sum, _ = get_statistics()
+        with Progress(f'LCA k={self.n_components}', self.max_iter - start_iter, n_rows) as progress:
+            for i in range(start_iter, self.max_iter):
+                if self.verbose > 0:
+                    print('\tEM iteration {n_iter}'.format(n_iter=i))
 
-        for i in range(self.max_iter):
-            if self.verbose > 0:
-                print('\tEM iteration {n_iter}'.format(n_iter=i))
+                if self.accelerate:
+                    resp_sum, weighted_sum, ll_val = self._squarem_step(resp_sum, weighted_sum, n_rows,
+                                                                        get_statistics)
+                else:
+                    # M-step, from the responsibilities of the current parameters
+                    self._update_params(resp_sum, weighted_sum, n_rows)
 
-            # E-step
-            self._do_e_step(data)
+                    # E-step, fused with the log likelihood for the convergence check
+                    resp_sum, weighted_sum, ll_val = get_statistics()
+                progress.update(log_likelihood=ll_val)
+                if self._has_converged(ll_val, n_rows):
+                    break
+                else:
+                    self.ll_.append(ll_val)
 
-            # M-step
-            self._do_m_step(data)
+                if self.checkpoint_file and self.checkpoint_every and (i + 1) % self.checkpoint_every == 0:
+                    self._save_checkpoint(i)
 
-            # Check for convergence
-            aux = np.zeros(shape=(n_rows, self.n_components))
-            for k in range(self.n_components):
-                normal_prob = np.prod(stats.bernoulli.pmf(data, p=self.theta[k]), axis=1)
-                aux[:, k] = self.weight[k] * normal_prob
-            ll_val = np.sum(np.log(np.sum(aux, axis=1)))
-            if np.abs(ll_val - self.ll_[-1]) < self.tol:
-                break
-            else:
-                self.ll_.append(ll_val)
+        if self.accelerate:
+            # a last EM step from the extrapolated parameters, so that they agree with the sufficient statistics; the
+            # responsibilities and the log likelihood (and so the BIC) are then those of the final parameters
+            self._update_params(resp_sum, weighted_sum, n_rows)
+            _, _, ll_val = get_statistics()
+            self.ll_.append(ll_val)
 
+        # the fit is complete, so a later fit should not resume from it
+        if self.checkpoint_file and osp.exists(self.checkpoint_file):
+            os.remove(self.checkpoint_file)
+
+        self._set_bic(n_rows)
+
+    def _set_bic(self, n_rows):
         # calculate bic
         self.bic = np.log(n_rows)*(sum(self.theta.shape)+len(self.weight)) - 2.0*self.ll_[-1]
 
+    def fit(self, data):
+
+        # initialization step
+        n_rows, n_cols = np.shape(data)
+        data = np.asarray(data, dtype=self.dtype)
+        start_iter = self._initialize(n_rows, n_cols, get_checkpoint_key(data) if self.checkpoint_file else None)
+
+        self._run_em(n_rows, start_iter, lambda: self._get_statistics(data))
+
+    def fit_shards(self, shards, executor=None):
+        """Fits the model on a cohort split into row shards (see clustr.sharded.write_shards), as map-reduce EM:
+        each iteration, every shard's sufficient statistics are computed by a task of executor, and the sums
+        are reduced here. The fit matches fit on the concatenated shards, up to floating point rounding.
+        :param shards: the shard files; .npy files are memory-mapped, .tsv files are read once per worker process
+        :param executor: any concurrent.futures.Executor, e.g. one of a cluster whose workers can read the shard
+                files; if None, a local process pool with a worker per shard, up to the number of cores
+        """
+        if executor is None:
+            with ProcessPoolExecutor(max_workers=min(len(shards), os.cpu_count() or 1)) as executor:
+                return self.fit_shards(shards, executor)
+
+        shapes = list(executor.map(get_shard_shape, shards))
+        n_rows, n_cols = sum(shape[0] for shape in shapes), shapes[0][1]
+        key = None
+        if self.checkpoint_file:
+            key = hashlib.sha1(''.join(executor.map(get_shard_key, shards)).encode()).hexdigest()
+        start_iter = self._initialize(n_rows, n_cols, key)
+        backend = get_kernel_backend()
+
+        def get_statistics():
+            results = list(executor.map(get_shard_statistics, shards, repeat(self.theta), repeat(self.weight),
+                                        repeat(backend)))
+            return (sum(result[0] for result in results),
+                    sum(result[1] for result in results),
+                    sum(result[2] for result in results))
+
+        self._run_em(n_rows, start_iter, get_statistics)
+
+    def predict_shards(self, shards, executor=None):
+        """Predicts the class of every row of the shards, in order
+        :param shards: the shard files, as in fit_shards
+        :param executor: any concurrent.futures.Executor; if None, the shards are predicted in this process
+        """
+        mapper = executor.map if executor is not None else map
+        backend = get_kernel_backend()
+        return np.concatenate(list(mapper(get_shard_labels, shards, repeat(self.theta), repeat(self.weight),
+                                          repeat(backend))))
+
+    def partial_fit(self, data, all_data=None):
+        """Updates a fitted model with new rows only. The sufficient statistics of the rows
+        seen in earlier fits are held fixed, and EM is run over the new rows starting from the
+        current weight/theta; with no new rows, the model is left as it is.
+        :param data: the new rows
+        :param all_data: the rows seen in earlier fits together with the new ones; if given, the final log
+                likelihood and the BIC are those of all of them, as after a fit. Otherwise the BIC is None, as EM
+                only sees the log likelihood of the new rows
+        """
+        if self.theta is None or self.resp_sum_ is None:
+            raise ValueError('LCA must be fitted before calling partial_fit')
+
+        if len(data):
+            self._prior_resp_sum = self.resp_sum_
+            self._prior_weighted_sum = self.weighted_sum_
+            self._prior_n_rows = self.n_rows_
+            warm_start, self.warm_start = self.warm_start, True
+            try:
+                self.fit(data)
+            finally:
+                self.warm_start = warm_start
+                self._prior_resp_sum = 0.0
+                self._prior_weighted_sum = 0.0
+                self._prior_n_rows = 0
+
+        if all_data is None:
+            self.bic = None
+        else:
+            self.responsibility, log_likelihood = e_step(np.asarray(all_data, dtype=self.dtype), self.theta,
+                                                         self.weight)
+            self.ll_.append(log_likelihood)
+            self._set_bic(len(all_data))
+        return self
+
     def predict(self, data):
         return np.argmax(self.predict_proba(data), axis=1)
 
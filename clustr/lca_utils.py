@@ -1,58 +1,187 @@
 from scipy import stats
+import numpy as np
 from clustr.lca import LCA
+from clustr.sharded import local_shards
+from contextlib import nullcontext
+from clustr.precision import get_float_dtype
 from clustr.startup import logger
-from clustr.utils import dict_to_json
+from clustr.plotting import submit_plot
+from clustr.progress import Progress
+from clustr.utils import dict_to_json, get_checkpoint_key, load_checkpoint, write_checkpoint, warn_warm_start_k
+from clustr.store import stored
 import os.path as osp
 import matplotlib.pyplot as plt
-from sklearn.metrics import silhouette_score, davies_bouldin_score, calinski_harabasz_score
+from clustr.scoring import get_scores
 from collections import OrderedDict
 
 
+# the EM tolerance of each convergence criterion (see clustr.lca.CONVERGENCE_CRITERIA); the absolute one is
+# the change of the log likelihood, which grows with the cohort, and the others scale with it
+TOLERANCES = {'absolute': 10e-4,
+              'relative': 1e-8,
+              'per_sample': 1e-6}
+
+
+def make_lca(k: int,
+             convergence: str = 'absolute',
+             accelerate: bool = False,
+             **kwargs):
+    """Creates an LCA model with the EM settings of the commands
+    :param k: the number k clusters
+    :param convergence: the convergence criterion of EM: 'absolute', 'relative' or 'per_sample'
+    :param accelerate: whether to run SQUAREM-accelerated EM
+    :param kwargs: any further arguments of LCA
+    """
+    return LCA(n_components=k, tol=TOLERANCES[convergence], max_iter=1000, dtype=get_float_dtype(),
+               convergence=convergence, accelerate=accelerate, **kwargs)
+
+
+def render_bics(bics,
+                out_folder: str):
+    """Draws the BIC per k"""
+    ks = list(bics.keys())
+    bic_values = list(bics.values())
+    fig, ax = plt.subplots(figsize=(15, 5))
+    try:
+        ax.plot(ks, bic_values, linewidth=3)
+        ax.grid(True)
+        ax.set_title("Model Selection Using BIC")
+        ax.set_xlabel("k clusters")
+        ax.set_ylabel("Bayesian Information Criterion (BIC)")
+        plt.savefig(osp.join(out_folder, 'model_selection.png'), dpi=300, bbox_inches='tight')
+    finally:
+        plt.close(fig)
+
+
 def select_lca_model(data_mat,
                      out_folder: str,
                      min_k: int = 2,
-                     max_k: int = 10):
-    """Generates a plot of BIC per k number of clusters for model selection"""
+                     max_k: int = 10,
+                     checkpoint_every: int = 10,
+                     n_shards: int = 1,
+                     convergence: str = 'absolute',
+                     accelerate: bool = False):
+    """Generates a plot of BIC per k number of clusters for model selection. Each finished k is
+    written to lca_checkpoint.json in out_folder, and the EM state of the current k is saved every
+    checkpoint_every iterations, so that rerunning resumes an interrupted sweep. With n_shards > 1,
+    the rows are split into that many shards once, and each k is fitted as map-reduce EM over them.
+    Each k is fitted with the convergence criterion and acceleration of make_lca"""
     logger.info(f'Choosing k for LCA with BIC metric.')
+    checkpoint_file = osp.join(out_folder, 'lca_checkpoint.json')
+    key = get_checkpoint_key(data_mat)
+    done = load_checkpoint(checkpoint_file, key)
     ks = [k for k in range(min_k, max_k + 1)]
     bics = OrderedDict()
-    for k in ks:
-        lca = LCA(n_components=k, tol=10e-4, max_iter=1000)
-        lca.fit(data_mat)
-        bics[k] = lca.bic
+    sharding = local_shards(data_mat, osp.join(out_folder, 'shards'), n_shards) if n_shards > 1 else nullcontext()
+    with sharding as sharded, Progress('LCA sweep', len(ks), len(data_mat), unit='k') as progress:
+        for k in ks:
+            if k in done:
+                bics[k] = done[k]
+                progress.update(k=k, bic=bics[k])
+                continue
+            lca = make_lca(k, convergence, accelerate,
+                           checkpoint_file=osp.join(out_folder, f'lca_em_checkpoint_k{k}.npz'),
+                           checkpoint_every=checkpoint_every)
+            if sharded:
+                lca.fit_shards(*sharded)
+            else:
+                lca.fit(data_mat)
+            bics[k] = float(lca.bic)
+            done[k] = bics[k]
+            write_checkpoint(done, checkpoint_file, key)
+            progress.update(k=k, bic=bics[k])
     # Plot the BIC per K
-    ks = list(bics.keys())
-    bic_values = list(bics.values())
-    _, ax = plt.subplots(figsize=(15, 5))
-    ax.plot(ks, bic_values, linewidth=3)
-    ax.grid(True)
-    ax.set_title("Model Selection Using BIC")
-    ax.set_xlabel("k clusters")
-    ax.set_ylabel("Bayesian Information Criterion (BIC)")
-    plt.savefig(osp.join(out_folder, 'model_selection.png'), dpi=300, bbox_inches='tight')
+    submit_plot(render_bics, dict(bics), out_folder)
 
     return dict(bics)
 
 
+def save_lca_model(lca: LCA,
+                   out_folder: str):
+    """Writes the fitted LCA parameters and sufficient statistics to lca_model.npz so that
+    a later run can warm start from them
+    :param lca: the fitted LCA model
+    :param out_folder: the folder to which the model file should be written.
+    """
+    np.savez(osp.join(out_folder, 'lca_model.npz'),
+             weight=lca.weight,
+             theta=lca.theta,
+             resp_sum=lca.resp_sum_,
+             weighted_sum=lca.weighted_sum_,
+             n_rows=lca.n_rows_)
+
+
+def load_lca_model(in_folder: str,
+                   convergence: str = 'absolute',
+                   accelerate: bool = False):
+    """Loads an LCA model written by save_lca_model, ready to be warm started
+    :param in_folder: the results folder of a previous LCA run, containing lca_model.npz
+    :param convergence: the convergence criterion of further EM, as in make_lca
+    :param accelerate: whether further EM is SQUAREM-accelerated
+    :returns: the LCA model
+    """
+    params = np.load(osp.join(in_folder, 'lca_model.npz'))
+    lca = make_lca(len(params['weight']), convergence, accelerate, warm_start=True)
+    lca.weight = params['weight']
+    lca.theta = params['theta']
+    lca.resp_sum_ = params['resp_sum']
+    lca.weighted_sum_ = params['weighted_sum']
+    lca.n_rows_ = int(params['n_rows'])
+    return lca
+
+
+@stored('fit', outputs='out_folder', seeds=('init_model', 'random_state'))
 def get_lca_clusters(data_mat,
                      out_folder: str,
-                     k: int = 10):
+                     k: int = 10,
+                     init_model: LCA = None,
+                     update_rows=None,
+                     checkpoint_every: int = 10,
+                     n_shards: int = 1,
+                     convergence: str = 'absolute',
+                     accelerate: bool = False,
+                     random_state: int = None):
     """Generates clustering results with LCA
     :param data_mat: the numpy array containing the sample features
     :param out_folder: the folder to which the figure files should be written.
     :param k: the number k clusters
+    :param init_model: a previously fitted LCA model (see load_lca_model) to warm start from;
+            if None, the model is initialised randomly
+    :param update_rows: boolean mask of the rows in data_mat which init_model has not seen yet;
+            if given, the model is only updated with these rows, and all rows are labelled
+    :param checkpoint_every: the number of EM iterations between saves of the EM state to
+            lca_em_checkpoint.npz in out_folder, from which an interrupted fit resumes; 0 disables this
+    :param n_shards: the number of row shards to fit across worker processes as map-reduce EM; 1 fits
+            in this process. An update with only new rows always runs in this process
+    :param convergence: the convergence criterion of EM: 'absolute', the change of the log likelihood, 'relative',
+            its change relative to the log likelihood, or 'per_sample', its change per row; a warm-started
+            init_model keeps its own, as loaded
+    :param accelerate: whether to run SQUAREM-accelerated EM, which needs far fewer iterations on flat
+            likelihood surfaces; a warm-started init_model keeps its own
+    :param random_state: the seed of the random initialisation; unseeded fits are not stored (see clustr.store)
     """
     logger.info(f'Performing Latent Class Analysis')
-    lca = LCA(n_components=k, tol=10e-4, max_iter=1000)
-    lca.fit(data_mat)
+    if init_model is not None:
+        warn_warm_start_k(k, init_model.n_components)
+    if update_rows is not None:
+        lca = init_model
+        lca.partial_fit(data_mat[update_rows], data_mat)
+    else:
+        if init_model is None:
+            lca = make_lca(k, convergence, accelerate,
+                           checkpoint_file=osp.join(out_folder, 'lca_em_checkpoint.npz'),
+                           checkpoint_every=checkpoint_every, random_state=random_state)
+        else:
+            lca = init_model
+            lca.warm_start = True
+        if n_shards > 1:
+            with local_shards(data_mat, osp.join(out_folder, 'shards'), n_shards) as (shards, executor):
+                lca.fit_shards(shards, executor)
+        else:
+            lca.fit(data_mat)
+    save_lca_model(lca, out_folder)
     labels = lca.predict(data_mat)
-    db_score = davies_bouldin_score(data_mat, labels)
-    ch_score = calinski_harabasz_score(data_mat, labels)
-    sil_score = silhouette_score(data_mat, labels, metric='hamming')
-    dict_to_json({'silhouette': sil_score,
-                  'davies_boulden': db_score,
-                  'calinski_harabasz': ch_score},
-                 osp.join(out_folder, 'scores.json'))
+    dict_to_json(get_scores(data_mat, labels), osp.join(out_folder, 'scores.json'))
     # TODO: use lca.predict_proba(data_mat) to get probabilities as well?
     logger.info(f'Finished Latent Class Analysis')
     return lca, labels
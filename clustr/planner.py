@@ -0,0 +1,143 @@
+import numpy as np
+import psutil
+from clustr.startup import logger
+from clustr.precision import get_precision, get_float_dtype
+
+
+# the memory budget of a job in bytes; see configure_memory_limit
+_MEMORY_LIMIT = None
+
+# the methods which hold dense n x n distance matrices
+SQUARE_METHODS = ('agg', 'kmedoids', 'kmeselect')
+
+# the fewest rows a sampled fit is allowed to use
+MIN_FIT_ROWS = 100
+
+# the agg linkages under which clustering the distinct rows gives the same clusters: duplicate rows merge first, at
+# distance 0, and leave the minimum and maximum distances between clusters unchanged. Under average linkage they
+# weigh on the cluster averages, so they cannot be dropped
+DEDUPLICATED_LINKAGES = ('single', 'complete')
+
+# the fields of a plan which change the results of a job; the others follow the memory available when it is planned
+PLAN_RESULT_FIELDS = ('dtype', 'strategy', 'fit_rows')
+
+
+def configure_memory_limit(memory_limit: float = None):
+    """Sets the memory budget of each job
+    :param memory_limit: the budget in GB; if None, the memory available when a job is planned
+    """
+    global _MEMORY_LIMIT
+    _MEMORY_LIMIT = None if memory_limit is None else int(memory_limit * 2 ** 30)
+
+
+def get_memory_limit():
+    """The memory budget of a job in bytes"""
+    return _MEMORY_LIMIT or psutil.virtual_memory().available
+
+
+def estimate_job_memory(method: str,
+                        n_rows: int,
+                        n_cols: int):
+    """Roughly estimates the peak memory (bytes) of one job; the hierarchical and k-medoids
+    methods hold dense n x n distance matrices, in the float dtype of the precision mode,
+    and the linkage holds a condensed float64 copy"""
+    itemsize = np.dtype(get_float_dtype()).itemsize
+    if method == 'agg':
+        return (itemsize + 8) * n_rows ** 2
+    if method in SQUARE_METHODS:
+        return 2 * itemsize * n_rows ** 2
+    return 4 * itemsize * n_rows * n_cols
+
+
+def _format_size(n_bytes):
+    return f'{n_bytes / 2 ** 30:.2f}GB' if n_bytes >= 2 ** 30 else f'{n_bytes / 2 ** 20:.1f}MB'
+
+
+def _get_max_rows(method: str,
+                  n_cols: int,
+                  memory_limit: int):
+    """The most rows whose estimated peak memory fits within memory_limit"""
+    per_square_row = estimate_job_memory(method, 1, n_cols)
+    return int(np.sqrt(memory_limit / per_square_row))
+
+
+def plan_job(method: str,
+             data_mat,
+             linkage: str = None,
+             n_clusters: int = 1):
+    """Plans how to run a clustering method within the memory budget, before anything large is allocated.
+    The methods which are linear in the rows always run in full. For the methods with n x n distance matrices:
+    the full data is used if it fits; otherwise, for agg with single or complete linkage, the distinct rows, since
+    duplicate rows are merged first anyway (see DEDUPLICATED_LINKAGES); otherwise a random sample of rows is fitted,
+    and every row is then assigned in chunks that fit. If not even a sample of MIN_FIT_ROWS fits, a MemoryError with
+    the estimate is raised.
+    :param method: the command name, e.g. 'agg'
+    :param data_mat: the numpy array containing the sample features
+    :param linkage: the linkage of agg
+    :param n_clusters: the number of clusters agg cuts its tree into; there must be at least as many distinct rows
+            for them to be clustered instead of the data
+    :returns: the plan, as a dictionary which is written to plan.json
+    """
+    n_rows, n_cols = data_mat.shape
+    memory_limit = get_memory_limit()
+    estimate = estimate_job_memory(method, n_rows, n_cols)
+    plan = {'method': method,
+            'n_rows': n_rows,
+            'n_cols': n_cols,
+            'dtype': get_precision(),
+            'memory_limit': memory_limit,
+            'estimated_peak': estimate,
+            'strategy': 'full',
+            'fit_rows': n_rows,
+            'chunk_rows': n_rows}
+    if estimate <= memory_limit:
+        return plan
+    if method not in SQUARE_METHODS:
+        raise MemoryError(f'{method} on {n_rows} rows x {n_cols} conditions needs an estimated '
+                          f'{_format_size(estimate)}, over the memory limit of {_format_size(memory_limit)}.')
+
+    max_rows = _get_max_rows(method, n_cols, memory_limit)
+    if method == 'agg' and linkage in DEDUPLICATED_LINKAGES:
+        n_unique = len(np.unique(data_mat, axis=0))
+        if n_clusters <= n_unique <= max_rows:
+            plan.update(strategy='deduplicated', fit_rows=n_unique,
+                        estimated_peak=estimate_job_memory(method, n_unique, n_cols))
+            logger.info(f'Planned {method} on the {n_unique} distinct rows to fit within the memory limit.')
+            return plan
+    if max_rows < MIN_FIT_ROWS:
+        raise MemoryError(f'{method} on {n_rows} rows x {n_cols} conditions needs an estimated '
+                          f'{_format_size(estimate)}, and even a sample of {MIN_FIT_ROWS} rows does not fit '
+                          f'within the memory limit of {_format_size(memory_limit)}.')
+    # the assignment of every row to the fitted sample uses at most a quarter of the budget at a time
+    itemsize = np.dtype(get_float_dtype()).itemsize
+    chunk_rows = max(1, min(n_rows, memory_limit // (4 * itemsize * max_rows)))
+    plan.update(strategy='sampled', fit_rows=max_rows, chunk_rows=int(chunk_rows),
+                estimated_peak=estimate_job_memory(method, max_rows, n_cols))
+    logger.warning(f'{method} on {n_rows} rows needs an estimated {_format_size(estimate)}, over the memory limit '
+                   f'of {_format_size(memory_limit)}; fitting a sample of {max_rows} rows instead.')
+    return plan
+
+
+def get_plan_key(plan):
+    """The part of a plan which changes the results of a job, by which stored results are keyed (see clustr.store);
+    the memory limit, the estimated peak and the assignment chunks are left out, as they change from run to run"""
+    return {field: plan[field] for field in PLAN_RESULT_FIELDS}
+
+
+def get_fit_rows(data_mat,
+                 plan,
+                 random_state: int = 0):
+    """Gets the rows which a plan fits on
+    :param data_mat: the numpy array containing the sample features
+    :param plan: the plan of plan_job
+    :param random_state: the seed of the sample of a sampled plan
+    :returns: the rows to fit on, and, for a deduplicated plan, the index of each row of data_mat
+            among them (None otherwise)
+    """
+    if plan['strategy'] == 'deduplicated':
+        unique_rows, inverse = np.unique(data_mat, axis=0, return_inverse=True)
+        return unique_rows, inverse.ravel()
+    if plan['strategy'] == 'sampled':
+        rng = np.random.default_rng(random_state)
+        return data_mat[np.sort(rng.choice(len(data_mat), plan['fit_rows'], replace=False))], None
+    return data_mat, None
@@ -0,0 +1,55 @@
+from concurrent.futures import ProcessPoolExecutor
+from clustr.startup import logger
+
+
+# rendering settings; see configure_plots
+_ENABLED = True
+_BACKGROUND = True
+_EXECUTOR = None
+_FUTURES = []
+
+
+def configure_plots(enabled: bool = True,
+                    background: bool = True):
+    """Sets how figures are rendered
+    :param enabled: whether to render figures at all; if False, submit_plot does nothing
+    :param background: whether to render figures in a background process pool, off the critical path;
+            if False, figures are rendered immediately in the calling process
+    """
+    global _ENABLED, _BACKGROUND
+    _ENABLED = enabled
+    _BACKGROUND = background
+
+
+def plots_enabled():
+    """Whether figures are rendered at all"""
+    return _ENABLED
+
+
+def submit_plot(render,
+                *args):
+    """Renders a figure from a small precomputed summary, in the background if configured to
+    :param render: a module-level function which draws, saves and closes the figure
+    :param args: the summary and output arguments of render; they are pickled for the background process
+    """
+    global _EXECUTOR
+    if not _ENABLED:
+        return
+    if not _BACKGROUND:
+        render(*args)
+        return
+    if _EXECUTOR is None:
+        _EXECUTOR = ProcessPoolExecutor(max_workers=2)
+    _FUTURES.append(_EXECUTOR.submit(render, *args))
+
+
+def wait_for_plots():
+    """Waits for the figures submitted so far to be written; errors are logged rather than raised,
+    since the results they depict have already been written"""
+    global _FUTURES
+    for future in _FUTURES:
+        try:
+            future.result()
+        except Exception:
+            logger.exception('Rendering a figure failed.')
+    _FUTURES = []
@@ -0,0 +1,35 @@
+import numpy as np
+
+
+# precision mode -> (dtype of the binary feature matrix, dtype of distances, posteriors and EM parameters);
+# a data dtype of None keeps the matrix as loaded
+PRECISIONS = {'float64': (None, np.float64),
+              'float32': (np.uint8, np.float32)}
+
+_PRECISION = 'float64'
+
+
+def configure_precision(precision: str = 'float64'):
+    """Sets the precision mode of the pipeline
+    :param precision: 'float64', the default, or 'float32', in which the binary features are held as uint8
+            (exact) and distances, EM posteriors and parameters are float32, halving or better the memory traffic
+    """
+    global _PRECISION
+    if precision not in PRECISIONS:
+        raise ValueError(f'Unknown precision {precision}; choose from {sorted(PRECISIONS)}')
+    _PRECISION = precision
+
+
+def get_precision():
+    """The name of the current precision mode"""
+    return _PRECISION
+
+
+def get_data_dtype():
+    """The dtype in which the binary feature matrix is held; None to keep it as loaded"""
+    return PRECISIONS[_PRECISION][0]
+
+
+def get_float_dtype():
+    """The dtype of distances, posteriors and EM parameters"""
+    return PRECISIONS[_PRECISION][1]
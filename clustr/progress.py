@@ -0,0 +1,130 @@
+import json
+import os
+import time
+import psutil
+from tqdm import tqdm
+
+
+# reporting settings; see configure_progress
+_BARS = True
+_METRICS_FILE = None
+
+# the latest metrics of each fit or sweep of this process, for the Prometheus textfile
+_LATEST = {}
+
+# the least number of seconds between two writes of the metrics of one fit
+METRICS_INTERVAL = 1.0
+
+
+def configure_progress(bars: bool = True,
+                       metrics_file: str = None):
+    """Sets how the progress of fits and sweeps is reported
+    :param bars: whether to draw live progress bars on the console (only when it is a terminal)
+    :param metrics_file: a file to which the progress metrics are written as they change, for monitoring;
+            JSON lines are appended to it, or, if it ends with .prom, each process keeps the current metrics
+            in its own Prometheus textfile next to it (<name>.<pid>.prom); if None, no metrics are written
+    """
+    global _BARS, _METRICS_FILE
+    _BARS = bars
+    _METRICS_FILE = metrics_file
+    _LATEST.clear()
+
+
+def get_metrics_file():
+    """The file to which the progress metrics are written, or None"""
+    return _METRICS_FILE
+
+
+def _write_prometheus(record):
+    _LATEST[record['name']] = record
+    values = {}
+    for latest in _LATEST.values():
+        labels = f'name="{latest["name"]}",pid="{latest["pid"]}"'
+        gauges = {'last_update_timestamp_seconds': latest['time'],
+                  'finished': int(latest['status'] == 'finished'),
+                  'failed': int(latest['status'] == 'failed')}
+        gauges.update((key, value) for key, value in latest.items()
+                      if key not in ('time', 'name', 'pid', 'status') and value is not None)
+        for key, value in gauges.items():
+            values.setdefault(key, []).append(f'clustr_{key}{{{labels}}} {value}')
+    lines = []
+    for key, samples in values.items():
+        lines.append(f'# TYPE clustr_{key} gauge')
+        lines.extend(samples)
+    # replaced in one step, so that a scrape never reads a partial file
+    filename = f'{_METRICS_FILE[:-len(".prom")]}.{record["pid"]}.prom'
+    tmp_file = filename + '.tmp'
+    with open(tmp_file, 'w') as outfile:
+        outfile.write('\n'.join(lines) + '\n')
+    os.replace(tmp_file, filename)
+
+
+def _write_metrics(record):
+    if _METRICS_FILE.endswith('.prom'):
+        _write_prometheus(record)
+    else:
+        with open(_METRICS_FILE, 'a') as outfile:
+            outfile.write(json.dumps(record) + '\n')
+
+
+class Progress:
+    """Reports the progress of a fit or sweep: iterations per second, the current metrics (e.g. the log likelihood
+    or cost), rows processed, ETA and the resident memory of the process, as a live console bar and to the metrics
+    file (see configure_progress). Use as a context manager, calling update after every iteration."""
+
+    def __init__(self, name: str, total: int, n_rows: int = None, unit: str = 'it'):
+        """
+        :param name: the name of the fit or sweep, e.g. 'LCA k=10'
+        :param total: the most iterations it can take
+        :param n_rows: the number of rows processed in each iteration
+        :param unit: the unit of the iterations, e.g. 'k'
+        """
+        self.name = name
+        self.total = total
+        self.n_rows = n_rows
+        self.metrics = {}
+        self._process = psutil.Process()
+        self._last_write = 0.0
+        self._bar = tqdm(total=total, desc=name, unit=unit, leave=False, disable=None if _BARS else True)
+        self._start = time.time()
+        self._step = 0
+
+    def _get_record(self, status):
+        elapsed = time.time() - self._start
+        rate = self._step / elapsed if elapsed > 0 else None
+        eta = (self.total - self._step) / rate if rate else None
+        return {'time': time.time(),
+                'pid': os.getpid(),
+                'name': self.name,
+                'status': status,
+                'step': self._step,
+                'total': self.total,
+                'rows_processed': self._step * self.n_rows if self.n_rows is not None else None,
+                'iterations_per_second': rate,
+                'eta_seconds': eta,
+                'rss_bytes': self._process.memory_info().rss,
+                **self.metrics}
+
+    def update(self, n: int = 1, **metrics):
+        """Records that n more iterations have finished, with the current metrics, e.g. cost=..."""
+        self._step += n
+        self.metrics.update(metrics)
+        postfix = {key: f'{value:.6g}' if isinstance(value, float) else value for key, value in self.metrics.items()}
+        postfix['rss'] = f'{self._process.memory_info().rss / 2 ** 20:.0f}MB'
+        self._bar.set_postfix(postfix, refresh=False)
+        self._bar.update(n)
+        if _METRICS_FILE and time.time() - self._last_write >= METRICS_INTERVAL:
+            _write_metrics(self._get_record('running'))
+            self._last_write = time.time()
+
+    def close(self, status: str = 'finished'):
+        """Closes the bar and writes the final metrics, with the status 'finished' or 'failed'"""
+        self._bar.close()
+        if _METRICS_FILE:
+            _write_metrics(self._get_record(status))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close('failed' if exc_type else 'finished')
@@ -0,0 +1,219 @@
+import operator
+import os.path as osp
+import re
+from typing import List, Dict, Any
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as pa_ds
+except ImportError:
+    pa = pa_ds = None
+
+
+# the columnar formats read through pyarrow, by file extension; anything else is read as a tab-separated file
+COLUMNAR_FORMATS = {'.parquet': 'parquet',
+                    '.pq': 'parquet',
+                    '.feather': 'feather',
+                    '.arrow': 'ipc',
+                    '.ipc': 'ipc'}
+
+# the comparisons a row filter can make; 'in' keeps the rows whose value is any of a list
+FILTER_OPERATORS = {'==': operator.eq,
+                    '!=': operator.ne,
+                    '>=': operator.ge,
+                    '<=': operator.le,
+                    '>': operator.gt,
+                    '<': operator.lt}
+
+# the number of rows of a tab-separated file which are read and filtered at a time
+FILTER_CHUNK_ROWS = 100000
+
+_FILTER_PATTERN = re.compile(r'^\s*(.+?)\s*(==|!=|>=|<=|=|>|<)\s*(.+?)\s*$')
+
+
+def _parse_value(value: str):
+    """Reads a filter value as written, without any quotes; it is cast to the type of its column when the rows are
+    filtered, so that e.g. "zip == 01" matches the string '01' in a text column and the number 1 in a numeric one"""
+    return value.strip('\'"')
+
+
+def _cast_error(column: str,
+                column_type,
+                value):
+    return ValueError(f'Cannot compare the column {column} ({column_type}) with the filter value {value!r}')
+
+
+def _cast_to_dtype(column: str,
+                   dtype,
+                   value):
+    """Casts a filter value, or a list of them, to the pandas dtype of its column: numbers for numeric columns,
+    booleans for boolean ones, and strings otherwise"""
+    if isinstance(value, list):
+        return [_cast_to_dtype(column, dtype, v) for v in value]
+    try:
+        if pd.api.types.is_bool_dtype(dtype):
+            return value if isinstance(value, bool) else {'true': True, 'false': False}[str(value).lower()]
+        if pd.api.types.is_numeric_dtype(dtype):
+            return pd.to_numeric(value)
+    except (KeyError, ValueError, TypeError):
+        raise _cast_error(column, dtype, value)
+    return str(value)
+
+
+def _cast_to_arrow_type(column: str,
+                        arrow_type,
+                        value):
+    """Casts a filter value, or a list of them, to the Arrow type of its column, as pyarrow compares only values of
+    the same type"""
+    if isinstance(value, list):
+        return [_cast_to_arrow_type(column, arrow_type, v) for v in value]
+    if pa.types.is_dictionary(arrow_type):
+        arrow_type = arrow_type.value_type
+    if pa.types.is_integer(arrow_type) or pa.types.is_floating(arrow_type):
+        # any number compares with a numeric column, e.g. "age > 40.5" with integer ages, as in pandas
+        try:
+            number = pd.to_numeric(value)
+        except (ValueError, TypeError):
+            raise _cast_error(column, arrow_type, value)
+        return number.item() if hasattr(number, 'item') else number
+    try:
+        return pa.array([value]).cast(arrow_type)[0].as_py()
+    except (pa.ArrowInvalid, pa.ArrowNotImplementedError, pa.ArrowTypeError):
+        raise _cast_error(column, arrow_type, value)
+
+
+def parse_filter(expression: str):
+    """Parses a row filter such as "sex == F", "age >= 40" or "region = north,east" (any of the listed values)
+    :param expression: the column, a comparison (==, =, !=, >=, <=, > or <) and a value, or a comma-separated list
+            of values for == and =
+    :returns: a (column, operator, value) filter, in the form pyarrow and pandas.read_parquet take; the values are
+            strings, which are cast to the type of their column when the rows are filtered
+    """
+    match = _FILTER_PATTERN.match(expression)
+    if not match:
+        raise ValueError(f'Cannot parse the filter {expression!r}; expected e.g. "sex == F" or "age >= 40"')
+    column, op, value = match.groups()
+    values = [_parse_value(v.strip()) for v in value.split(',')]
+    if op in ('=', '=='):
+        return (column, 'in', values) if len(values) > 1 else (column, '==', values[0])
+    if len(values) > 1:
+        raise ValueError(f'Only == can be given a list of values, in {expression!r}')
+    return column, op, values[0]
+
+
+def get_subgroup_filters(subgroup: Dict[str, Any]):
+    """Turns a subgroup of a batch configuration, {column: value(s)}, into row filters"""
+    return [(column, 'in', value) if isinstance(value, list) else (column, '==', value)
+            for column, value in (subgroup or {}).items()]
+
+
+def get_filter_mask(df: pd.DataFrame,
+                    filters: List[tuple]):
+    """Finds the rows of a loaded dataframe which pass every filter
+    :param df: the dataframe
+    :param filters: a list of (column, operator, value) filters, e.g. from parse_filter; the values are cast to the
+            dtypes of their columns
+    :returns: a boolean series, indexed as df
+    """
+    mask = pd.Series(True, index=df.index)
+    for column, op, value in filters or []:
+        value = _cast_to_dtype(column, df[column].dtype, value)
+        mask &= df[column].isin(value) if op == 'in' else FILTER_OPERATORS[op](df[column], value)
+    return mask
+
+
+def _get_filter_expression(filters: List[tuple],
+                           schema):
+    """Turns filters into a pyarrow expression, so that the rows are filtered while they are scanned; the values
+    are cast to the types of their columns in the schema"""
+    expression = None
+    for column, op, value in filters or []:
+        value = _cast_to_arrow_type(column, schema.field(column).type, value)
+        field = pa_ds.field(column)
+        term = field.isin(value) if op == 'in' else FILTER_OPERATORS[op](field, value)
+        expression = term if expression is None else expression & term
+    return expression
+
+
+def _get_columns(names: List[str],
+                 metadata: List[str],
+                 keep_metadata: bool):
+    """The columns to read: the first (the patient IDs) and the conditions, and the metadata columns if kept"""
+    return [names[0]] + [col for col in names[1:] if keep_metadata or col not in (metadata or [])]
+
+
+def _open_dataset(input_file: str,
+                  file_format: str):
+    """Opens a columnar file as a pyarrow dataset, whose columns are put in the order of a tab-separated file: the
+    patient IDs (the pandas index, if the file was written by pandas, or else the first column) first"""
+    if pa_ds is None:
+        raise ImportError(f'Reading {input_file} requires pyarrow; install it with `pip install clustr[columnar]`.')
+    dataset = pa_ds.dataset(input_file, format=file_format)
+    index_columns = [col for col in (dataset.schema.pandas_metadata or {}).get('index_columns', [])
+                     if isinstance(col, str)]
+    names = dataset.schema.names
+    return dataset, index_columns[:1] + [col for col in names if col not in index_columns[:1]]
+
+
+def _to_frame(table):
+    """Converts the pyarrow table or batch of a columnar file to a dataframe indexed by patient ID"""
+    df = table.to_pandas(ignore_metadata=True)
+    df = df.set_index(df.columns[0])
+    if str(df.index.name).startswith('__index_level_'):
+        df.index.name = None
+    return df
+
+
+def read_cohort(input_file: str,
+                metadata: List[str] = None,
+                filters: List[tuple] = None,
+                keep_metadata: bool = False):
+    """Reads the cohort, with only the columns and rows needed. Parquet, Feather and Arrow files are read through
+    pyarrow, which only reads the projected columns and applies the filters while scanning; a tab-separated file is
+    read in chunks, each filtered before the next is read
+    :param input_file: the file containing the data, in which columns are conditions, rows are patients (the first
+            column, or the pandas index, being their IDs), and values are binary
+    :param metadata: the columns which are not conditions (e.g. sex or age); they are not read, unless kept
+    :param filters: the (column, operator, value) filters the rows must pass, e.g. from parse_filter; they may
+            refer to columns which are not read
+    :param keep_metadata: whether the metadata columns are read too
+    :returns: the dataframe of the data, indexed by patient ID
+    """
+    file_format = COLUMNAR_FORMATS.get(osp.splitext(input_file)[1].lower())
+    if file_format:
+        dataset, names = _open_dataset(input_file, file_format)
+        return _to_frame(dataset.to_table(columns=_get_columns(names, metadata, keep_metadata),
+                                          filter=_get_filter_expression(filters, dataset.schema)))
+    names = list(pd.read_csv(input_file, sep='\t', nrows=0).columns)
+    columns = _get_columns(names, metadata, keep_metadata)
+    if not filters:
+        return pd.read_csv(input_file, sep='\t', index_col=0, usecols=columns)
+    return pd.concat(iter_cohort_chunks(input_file, FILTER_CHUNK_ROWS, metadata, filters, keep_metadata))
+
+
+def iter_cohort_chunks(input_file: str,
+                       chunk_rows: int,
+                       metadata: List[str] = None,
+                       filters: List[tuple] = None,
+                       keep_metadata: bool = False):
+    """Reads the cohort in chunks of rows, with only the columns and rows needed, as in read_cohort; the chunks of a
+    columnar file follow its row groups, so they may be smaller than chunk_rows
+    :returns: a generator of the dataframes of the chunks
+    """
+    file_format = COLUMNAR_FORMATS.get(osp.splitext(input_file)[1].lower())
+    if file_format:
+        dataset, names = _open_dataset(input_file, file_format)
+        for batch in dataset.to_batches(columns=_get_columns(names, metadata, keep_metadata),
+                                        filter=_get_filter_expression(filters, dataset.schema),
+                                        batch_size=chunk_rows):
+            if batch.num_rows:
+                yield _to_frame(batch)
+        return
+    names = list(pd.read_csv(input_file, sep='\t', nrows=0).columns)
+    columns = _get_columns(names, metadata, keep_metadata)
+    # the filtered columns are read alongside, and dropped once the rows are filtered
+    usecols = columns + [col for col in dict.fromkeys(f[0] for f in filters or []) if col not in columns]
+    with pd.read_csv(input_file, sep='\t', index_col=0, usecols=usecols, chunksize=chunk_rows) as reader:
+        for chunk in reader:
+            yield chunk.loc[get_filter_mask(chunk, filters), columns[1:]]
@@ -0,0 +1,488 @@
+import os
+import os.path as osp
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import partial
+import multiprocessing as mp
+from typing import List, Dict, Any
+import numpy as np
+import pandas as pd
+import psutil
+import yaml
+from clustr.constants import HIER_AGG_RESULTS, LCA_RESULTS, KMEDOIDS_RESULTS, KMODES_RESULTS
+from clustr.startup import logger
+from clustr.plotting import configure_plots, plots_enabled
+from clustr.precision import configure_precision, get_precision, get_data_dtype
+from clustr.kernels import configure_kernels, get_kernel_backend
+from clustr.planner import configure_memory_limit, get_memory_limit, plan_job
+from clustr.progress import Progress, configure_progress, get_metrics_file
+from clustr.store import configure_store, get_store_settings
+from clustr.readers import read_cohort, parse_filter, get_filter_mask, get_subgroup_filters
+from clustr.cooccurrence import get_cluster_cooccurrences, get_cooccurrence_table
+from clustr.enrichment import get_enrichments
+from clustr.utils import prepare_data, plot_ks, plot_morbidity_dist, dict_to_json, read_labels, get_label_drift, \
+    read_label_runs, write_labels, find_labels_file, iter_data_chunks
+from clustr.hier_agg_utils import AGG_CLUSTERS, get_agg_clusters, plot_dendrogram
+from clustr.lca_utils import select_lca_model, get_lca_clusters, load_lca_model
+from clustr.kmedoids_utils import calculate_kmedoids, fit_kmedoids
+from clustr.kmodes_utils import calculate_kmodes, fit_kmodes, update_kmodes, load_kmodes_state, \
+    fit_minibatch_kmodes, get_matrix_batches
+
+
+def record_plan(method: str,
+                mat,
+                foldr: str,
+                **options):
+    """Plans a job within the memory budget (see clustr.planner.plan_job, which takes the options) and writes the
+    plan to plan.json"""
+    os.makedirs(foldr, exist_ok=True)
+    plan = plan_job(method, mat, **options)
+    dict_to_json(plan, osp.join(foldr, 'plan.json'))
+    return plan
+
+
+def run_agg(df: pd.DataFrame,
+            mat,
+            cgrps: List[str],
+            subdir: str = None,
+            metric: str = 'hamming',
+            linkage: str = 'complete'):
+    """Hierarchical agglomerative clustering of prepared data; see the agg command"""
+    foldr = osp.join(HIER_AGG_RESULTS, subdir) if subdir else HIER_AGG_RESULTS
+    plan = record_plan('agg', mat, foldr, linkage=linkage, n_clusters=AGG_CLUSTERS)
+    _, labels = get_agg_clusters(mat, foldr, metric, linkage, plan)
+    plot_dendrogram(mat, foldr, metric, linkage, plan)
+    df['aggl_cluster_labels'] = labels
+    write_labels(df[['aggl_cluster_labels']], osp.join(foldr, 'hier_agg_labels.tsv.gz'))
+    plot_morbidity_dist(df, 'aggl_cluster_labels', foldr, 'agglomerative_hierarchical')
+
+
+def run_lcaselect(df: pd.DataFrame,
+                  mat,
+                  cgrps: List[str],
+                  subdir: str = None,
+                  min_k: int = 2,
+                  max_k: int = 10,
+                  checkpoint_every: int = 10,
+                  shards: int = 1,
+                  convergence: str = 'absolute',
+                  accelerate: bool = False):
+    """Model selection for LCA on prepared data; see the lcaselect command"""
+    foldr = osp.join(LCA_RESULTS, subdir) if subdir else LCA_RESULTS
+    record_plan('lcaselect', mat, foldr)
+    bics = select_lca_model(mat, foldr, min_k, max_k, checkpoint_every, shards, convergence, accelerate)
+    dict_to_json(bics, osp.join(foldr, 'bics.json'))
+
+
+def run_lca(df: pd.DataFrame,
+            mat,
+            cgrps: List[str],
+            subdir: str = None,
+            repetitions: int = 1,
+            kclusters: int = 10,
+            warm_start: str = None,
+            update_only: bool = False,
+            checkpoint_every: int = 10,
+            wide_table: bool = False,
+            posteriors: bool = False,
+            shards: int = 1,
+            convergence: str = 'absolute',
+            accelerate: bool = False):
+    """LCA clustering of prepared data; see the lca command"""
+    foldr = osp.join(LCA_RESULTS, subdir) if subdir else LCA_RESULTS
+    record_plan('lca', mat, foldr)
+
+    prev_labels, update_rows = None, None
+    if warm_start:
+        prev_labels = read_labels(find_labels_file(warm_start, 'lca_cluster_labels.tsv'), 'lca_cluster_labels')
+        if update_only:
+            update_rows = ~df.index.isin(prev_labels.index)
+
+    runs = pd.DataFrame(index=df.index)
+    # do r number of times:
+    with Progress('LCA repetitions', repetitions, len(mat)) as progress:
+        for i in range(repetitions):
+            if repetitions != 1:
+                subfolder = osp.join(foldr, f'run_{i}')
+            else:
+                subfolder = foldr
+
+            os.makedirs(subfolder, exist_ok=True)
+            init_model = load_lca_model(warm_start, convergence, accelerate) if warm_start else None
+            model, labels = get_lca_clusters(mat, subfolder, kclusters, init_model, update_rows, checkpoint_every,
+                                             shards, convergence, accelerate)
+            df['lca_cluster_labels'] = labels
+            if wide_table:
+                runs[f'run_{i}'] = labels
+            else:
+                write_labels(df[['lca_cluster_labels']], osp.join(subfolder, 'lca_cluster_labels.tsv.gz'))
+            if posteriors:
+                probs = pd.DataFrame(model.predict_proba(mat), index=df.index).add_prefix('posterior_')
+                write_labels(probs, osp.join(subfolder, 'lca_posteriors.tsv.gz'))
+            if prev_labels is not None:
+                dict_to_json(get_label_drift(prev_labels, df['lca_cluster_labels']),
+                             osp.join(subfolder, 'label_drift.json'))
+            plot_morbidity_dist(df, 'lca_cluster_labels', subfolder, 'latent_class_analysis')
+            progress.update()
+    if wide_table:
+        write_labels(runs, osp.join(foldr, 'lca_cluster_labels_runs.tsv.gz'))
+
+
+def run_kmeselect(df: pd.DataFrame,
+                  mat,
+                  cgrps: List[str],
+                  subdir: str = None,
+                  min_k: int = 2,
+                  max_k: int = 10):
+    """Model selection for k-medoids on prepared data; see the kmeselect command"""
+    foldr = osp.join(KMEDOIDS_RESULTS, subdir) if subdir else KMEDOIDS_RESULTS
+    plan = record_plan('kmeselect', mat, foldr)
+    costs, sil_scores = calculate_kmedoids(mat, min_k, max_k, osp.join(foldr, 'kmedoids_checkpoint.json'), plan)
+    dict_to_json(dict(costs), osp.join(foldr, 'costs.json'))
+    dict_to_json(dict(sil_scores), osp.join(foldr, 'sil_scores.json'))
+    plot_ks(costs, foldr, 'costs', min_k, max_k)
+    plot_ks(sil_scores, foldr, 'silhouette', min_k, max_k)
+
+
+def run_kmedoids(df: pd.DataFrame,
+                 mat,
+                 cgrps: List[str],
+                 subdir: str = None,
+                 kclusters: int = 10):
+    """k-medoids clustering of prepared data; see the kmedoids command"""
+    foldr = osp.join(KMEDOIDS_RESULTS, subdir) if subdir else KMEDOIDS_RESULTS
+    plan = record_plan('kmedoids', mat, foldr)
+    _, labels = fit_kmedoids(mat, foldr, cgrps, kclusters, plan)
+    df['kmedoids_cluster_labels'] = labels
+    write_labels(df[['kmedoids_cluster_labels']], osp.join(foldr, 'kmedoids_cluster_labels.tsv.gz'))
+    plot_morbidity_dist(df, 'kmedoids_cluster_labels', foldr, 'kmedoids')
+
+
+def run_kmoselect(df: pd.DataFrame,
+                  mat,
+                  cgrps: List[str],
+                  subdir: str = None,
+                  min_k: int = 2,
+                  max_k: int = 10):
+    """Model selection for k-modes on prepared data; see the kmoselect command"""
+    foldr = osp.join(KMODES_RESULTS, subdir) if subdir else KMODES_RESULTS
+    record_plan('kmoselect', mat, foldr)
+    costs, sil_scores = calculate_kmodes(mat, min_k, max_k, checkpoint_file=osp.join(foldr, 'kmodes_checkpoint.json'))
+    dict_to_json(dict(costs), osp.join(foldr, 'costs.json'))
+    dict_to_json(dict(sil_scores), osp.join(foldr, 'sil_scores.json'))
+    plot_ks(costs, foldr, 'costs', min_k, max_k)
+    plot_ks(sil_scores, foldr, 'silhouette', min_k, max_k)
+
+
+def run_kmodes(df: pd.DataFrame,
+               mat,
+               cgrps: List[str],
+               subdir: str = None,
+               repetitions: int = 1,
+               kclusters: int = 10,
+               warm_start: str = None,
+               update_only: bool = False,
+               wide_table: bool = False,
+               batch_size: int = None):
+    """k-modes clustering of prepared data; see the kmodes command. With batch_size, mini-batch k-modes is
+    fitted over batches of that many rows"""
+    foldr = osp.join(KMODES_RESULTS, subdir) if subdir else KMODES_RESULTS
+    record_plan('kmodes', mat, foldr)
+
+    prev_labels, prev_state = None, None
+    if warm_start:
+        prev_labels = read_labels(find_labels_file(warm_start, 'kmodes_cluster_labels.tsv'), 'kmodes_cluster_labels')
+        prev_state = load_kmodes_state(warm_start)
+
+    runs = pd.DataFrame(index=df.index)
+    # do r number of times:
+    with Progress('k-modes repetitions', repetitions, len(mat)) as progress:
+        for i in range(repetitions):
+            if repetitions != 1:
+                subfolder = osp.join(foldr, f'run_{i}')
+            else:
+                subfolder = foldr
+
+            os.makedirs(subfolder, exist_ok=True)
+
+            if update_only:
+                update_rows = ~df.index.isin(prev_labels.index)
+                _, labels = update_kmodes(mat, subfolder, cgrps, prev_state, update_rows)
+            elif batch_size:
+                init_centroids = prev_state[0] if warm_start else None
+                _, labelled = fit_minibatch_kmodes(partial(get_matrix_batches, df, mat, cgrps, batch_size), subfolder,
+                                                   cgrps, kclusters, init_centroids)
+                labels = labelled['kmodes_cluster_labels'].to_numpy()
+            else:
+                init_centroids = prev_state[0] if warm_start else None
+                _, labels = fit_kmodes(mat, subfolder, cgrps, kclusters, init_centroids)
+            df['kmodes_cluster_labels'] = labels
+            if wide_table:
+                runs[f'run_{i}'] = labels
+            else:
+                write_labels(df[['kmodes_cluster_labels']], osp.join(subfolder, 'kmodes_cluster_labels.tsv.gz'))
+            if prev_labels is not None:
+                dict_to_json(get_label_drift(prev_labels, df['kmodes_cluster_labels']),
+                             osp.join(subfolder, 'label_drift.json'))
+            plot_morbidity_dist(df, 'kmodes_cluster_labels', subfolder, 'kmodes')
+            progress.update()
+    if wide_table:
+        write_labels(runs, osp.join(foldr, 'kmodes_cluster_labels_runs.tsv.gz'))
+
+
+def run_kmodes_stream(infile: str,
+                      batch_size: int,
+                      sample_frac: float = 1,
+                      drop_healthy: bool = False,
+                      coi=None,
+                      subdir: str = None,
+                      repetitions: int = 1,
+                      kclusters: int = 10,
+                      warm_start: str = None,
+                      wide_table: bool = False,
+                      metadata: List[str] = None,
+                      filters: List[tuple] = None):
+    """Mini-batch k-modes clustering of a cohort streamed from infile in batches of batch_size rows, so that it is
+    never loaded at once; see the kmodes command. The metadata columns are not read, and only the rows which pass
+    the filters are (see clustr.readers.read_cohort)"""
+    foldr = osp.join(KMODES_RESULTS, subdir) if subdir else KMODES_RESULTS
+    get_batches = partial(iter_data_chunks, infile, batch_size, sample_frac, drop_healthy, coi, metadata, filters)
+    batches = get_batches()
+    _, first_batch, cgrps = next(batches)
+    batches.close()
+    # only one batch is held at a time
+    record_plan('kmodes', first_batch, foldr)
+
+    prev_labels, init_centroids = None, None
+    if warm_start:
+        prev_labels = read_labels(find_labels_file(warm_start, 'kmodes_cluster_labels.tsv'), 'kmodes_cluster_labels')
+        init_centroids = load_kmodes_state(warm_start)[0]
+
+    runs = None
+    with Progress('k-modes repetitions', repetitions) as progress:
+        for i in range(repetitions):
+            if repetitions != 1:
+                subfolder = osp.join(foldr, f'run_{i}')
+            else:
+                subfolder = foldr
+
+            os.makedirs(subfolder, exist_ok=True)
+            _, labelled = fit_minibatch_kmodes(get_batches, subfolder, cgrps, kclusters, init_centroids)
+            if wide_table:
+                runs = pd.DataFrame(index=labelled.index) if runs is None else runs
+                runs[f'run_{i}'] = labelled['kmodes_cluster_labels']
+            else:
+                write_labels(labelled[['kmodes_cluster_labels']], osp.join(subfolder, 'kmodes_cluster_labels.tsv.gz'))
+            if prev_labels is not None:
+                dict_to_json(get_label_drift(prev_labels, labelled['kmodes_cluster_labels']),
+                             osp.join(subfolder, 'label_drift.json'))
+            plot_morbidity_dist(labelled, 'kmodes_cluster_labels', subfolder, 'kmodes')
+            progress.update()
+    if wide_table:
+        write_labels(runs, osp.join(foldr, 'kmodes_cluster_labels_runs.tsv.gz'))
+
+
+def run_cooccurrence(df: pd.DataFrame,
+                     mat,
+                     cgrps: List[str],
+                     labels_file: str,
+                     labels_column: str = None,
+                     min_observed: int = 1):
+    """Tests the condition pairs of prepared data for co-occurrence within each cluster of a labels file written by
+    the CLI, and writes the clusters x pairs table next to it; see the cooccurrence command"""
+    labels = read_labels(labels_file, labels_column)
+    labels = labels[labels.index.isin(df.index)]
+    if len(labels) < len(df):
+        logger.info(f'{len(df) - len(labels)} patients without a label in {labels_file} are left out')
+    clusters, sizes, counts = get_cluster_cooccurrences(mat[df.index.get_indexer(labels.index)], labels.to_numpy())
+    table = get_cooccurrence_table(clusters, sizes, counts, cgrps, min_observed)
+    outfile = osp.join(osp.dirname(labels_file), f'{labels.name}_cooccurrences.tsv.gz')
+    table.to_csv(outfile, sep='\t', index=False, compression='gzip', float_format='%.6g')
+    logger.info(f'Wrote the co-occurrences of {len(table)} cluster condition pairs to {outfile}')
+
+
+def run_enrichment(df: pd.DataFrame,
+                   mat,
+                   cgrps: List[str],
+                   labels_file: str,
+                   labels_columns: List[str] = None,
+                   n_workers: int = None):
+    """Computes the enrichment of the conditions of prepared data in every cluster of several label columns of a
+    labels file written by the CLI (e.g. the repetitions of lca or kmodes), and writes the arrays next to it; see
+    the enrichment command"""
+    labels = read_label_runs(labels_file, labels_columns)
+    labels = labels[labels.index.isin(df.index)]
+    if len(labels) < len(df):
+        logger.info(f'{len(df) - len(labels)} patients without a label in {labels_file} are left out')
+    enrichments = get_enrichments(mat[df.index.get_indexer(labels.index)], labels.to_numpy().T, n_workers)
+    name = osp.basename(labels_file).split('.')[0]
+    outfile = osp.join(osp.dirname(labels_file), f'{name}_enrichment.npz')
+    np.savez_compressed(outfile, runs=np.asarray(labels.columns, dtype=str), conditions=np.asarray(cgrps, dtype=str),
+                        **enrichments)
+    logger.info(f'Wrote the enrichment of {len(labels.columns)} runs x {enrichments["clusters"].shape[1]} clusters x '
+                f'{len(cgrps)} conditions to {outfile}')
+
+
+RUNNERS = {'agg': run_agg,
+           'lcaselect': run_lcaselect,
+           'lca': run_lca,
+           'kmeselect': run_kmeselect,
+           'kmedoids': run_kmedoids,
+           'kmoselect': run_kmoselect,
+           'kmodes': run_kmodes}
+
+
+def load_config(config_file: str):
+    """Reads a batch experiment configuration from a yaml file, e.g.
+
+        infile: ./data/cohort.tsv   # or a Parquet, Feather or Arrow file
+        sample_frac: 1
+        drop_healthy: True
+        metadata: [sex]             # non-condition columns, used only to define subgroups
+        subgroups:                  # subgroup name (the subdirectory) -> {column: value(s)}
+          women: {sex: F}
+          men: {sex: M}
+        filters: [age >= 18]        # optional; rows to keep, applied while the file is read
+        cois: [null, Depression]    # conditions of interest to take out; null keeps all conditions
+        methods:                    # command name -> options of that command
+          lca: {kclusters: 10, repetitions: 5}
+          kmodes: {kclusters: 10}
+        workers: 4                  # optional; by default sized to the available cores and memory
+        plots: True                 # optional; whether to render the figures
+        dtype: float32              # optional; the precision mode, float64 (default) or float32
+        kernels: numba              # optional; the kernel backend, numpy (default) or numba
+        memory_limit: 16            # optional; the memory budget of each job in GB, by default the available memory
+        metrics_file: metrics.jsonl # optional; a file to which the progress metrics are written
+        store: True                 # optional; whether the stages return stored results (default is False)
+        store_gb: 20                # optional; the size cap of the store in GB
+
+    :param config_file: the yaml configuration file
+    :returns: the configuration as a dictionary
+    """
+    with open(config_file) as infile:
+        config = yaml.safe_load(infile)
+    if 'infile' not in config or 'methods' not in config:
+        raise ValueError(f'{config_file} must specify an infile and methods')
+    unknown = set(config['methods']) - set(RUNNERS)
+    if unknown:
+        raise ValueError(f'Unknown methods {sorted(unknown)}; choose from {sorted(RUNNERS)}')
+    return config
+
+
+def get_jobs(config: Dict[str, Any]):
+    """Expands a configuration into one job per method, subgroup and condition of interest
+    :returns: a list of (method, subgroup, coi, subdir, options) tuples
+    """
+    subgroups = config.get('subgroups') or {None: {}}
+    cois = config.get('cois') or [None]
+    jobs = []
+    for method, options in config['methods'].items():
+        for subgroup in subgroups:
+            for coi in cois:
+                subdir = '_'.join(part for part in [subgroup, f'no_{coi}' if coi else None] if part) or None
+                jobs.append((method, subgroup, coi, subdir, options or {}))
+    return jobs
+
+
+def get_job_peak(job,
+                 mat):
+    """Estimates the peak memory of a job as it is planned (see clustr.planner.plan_job), so that a job which fits
+    a sample or the distinct rows is sized by those
+    :param job: the job, as from get_jobs
+    :param mat: the condition matrix of the cohort, of which each job clusters a subset
+    """
+    method, _, _, _, options = job
+    plan_options = {'linkage': options.get('linkage', 'complete'), 'n_clusters': AGG_CLUSTERS} if method == 'agg' \
+        else {}
+    try:
+        return plan_job(method, mat, **plan_options)['estimated_peak']
+    except MemoryError:
+        # the job fails once it is planned in its worker, within the budget
+        return get_memory_limit()
+
+
+# the cohort shared by the worker processes; with the fork start method it is inherited, not copied
+_COHORT = None
+
+
+def _init_worker(cohort,
+                 plots: bool,
+                 precision: str,
+                 kernels: str,
+                 memory_limit: float,
+                 metrics_file: str,
+                 store_settings):
+    global _COHORT
+    _COHORT = cohort
+    # the console bars of concurrent jobs would overwrite each other, so only the metrics are written
+    configure_progress(bars=False, metrics_file=metrics_file)
+    configure_precision(precision)
+    configure_kernels(kernels)
+    configure_memory_limit(memory_limit)
+    configure_store(*store_settings)
+    # the job itself already runs off the main process, so its figures are rendered in place
+    configure_plots(enabled=plots, background=False)
+
+
+def _run_job(job,
+             subgroups: Dict[str, Dict[str, Any]],
+             metadata: List[str],
+             sample_frac: float,
+             drop_healthy: bool):
+    """Derives the subgroup and COI view of the shared cohort for one job and runs it"""
+    method, subgroup, coi, subdir, options = job
+    logger.info(f'Running {method} on subgroup {subgroup} without {coi}.')
+    df = _COHORT
+    mask = get_filter_mask(df, get_subgroup_filters(subgroups.get(subgroup)))
+    df = df.loc[mask, [col for col in df.columns if col not in metadata]]
+    df, mat, _, _, cgrps = prepare_data(df, sample_frac, drop_healthy, coi)
+    RUNNERS[method](df, mat, cgrps, subdir, **options)
+    logger.info(f'Finished {method} on subgroup {subgroup} without {coi}.')
+    return subdir
+
+
+def run_experiments(config: Dict[str, Any]):
+    """Loads the cohort once and runs every job of the configuration across a process pool
+    :param config: the configuration; see load_config
+    """
+    configure_precision(config.get('dtype', get_precision()))
+    configure_kernels(config.get('kernels', get_kernel_backend()))
+    store_enabled, store_folder, store_gb = get_store_settings()
+    configure_store(config.get('store', store_enabled), store_folder, config.get('store_gb', store_gb))
+    metadata = config.get('metadata') or []
+    logger.info(f'Processing data from {config["infile"]}...')
+    # the metadata columns are kept, to derive the subgroups from
+    cohort = read_cohort(config['infile'], metadata, [parse_filter(f) for f in config.get('filters') or []],
+                         keep_metadata=True)
+    logger.info(f'Finished processing data from {config["infile"]}.')
+    jobs = get_jobs(config)
+
+    workers = config.get('workers')
+    if not workers:
+        configure_memory_limit(config.get('memory_limit'))
+        mat = cohort[[col for col in cohort.columns if col not in metadata]].to_numpy(dtype=get_data_dtype())
+        peak = max(get_job_peak(job, mat) for job in jobs)
+        del mat
+        workers = min(os.cpu_count() or 1, psutil.virtual_memory().available // max(peak, 1))
+    workers = max(1, min(int(workers), len(jobs)))
+    logger.info(f'Running {len(jobs)} jobs with {workers} worker processes.')
+
+    context = mp.get_context('fork') if 'fork' in mp.get_all_start_methods() else None
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                             initializer=_init_worker, initargs=(cohort, config.get('plots', True) and plots_enabled(),
+                                       get_precision(), get_kernel_backend(),
+                                       config.get('memory_limit'),
+                                       config.get('metrics_file', get_metrics_file()),
+                                       get_store_settings())) as executor:
+        futures = {executor.submit(_run_job, job, config.get('subgroups') or {}, metadata,
+                                   config.get('sample_frac', 1), config.get('drop_healthy', False)): job
+                   for job in jobs}
+        failed = []
+        for future in as_completed(futures):
+            method, subgroup, coi, _, _ = futures[future]
+            try:
+                future.result()
+            except Exception:
+                logger.exception(f'{method} on subgroup {subgroup} without {coi} failed.')
+                failed.append(futures[future][:3])
+    if failed:
+        raise RuntimeError(f'{len(failed)} of {len(jobs)} jobs failed: {failed}')
@@ -0,0 +1,176 @@
+import numpy as np
+import scipy.sparse as sp
+from scipy.spatial.distance import cdist
+from clustr.store import stored
+
+
+def get_cluster_sums(data_mat,
+                     labels):
+    """Gets the sufficient statistics of binary data for cluster scoring, in one pass
+    :param data_mat: the binary numpy array containing the sample features
+    :param labels: the cluster label of each row
+    :returns: the cluster index of each row (0 to k-1), the cluster sizes (k), and the
+            per-cluster condition sums (k x conditions)
+    """
+    _, codes = np.unique(labels, return_inverse=True)
+    codes = codes.ravel()
+    n_clusters = codes.max() + 1
+    one_hot = sp.csr_matrix((np.ones(len(codes), dtype=np.int64), (codes, np.arange(len(codes)))),
+                            shape=(n_clusters, len(codes)))
+    sums = np.asarray(one_hot @ data_mat, dtype=np.int64)
+    sizes = np.bincount(codes, minlength=n_clusters)
+    return codes, sizes, sums
+
+
+def _check_number_of_labels(n_labels, n_samples):
+    # the same check, and error, as scikit-learn's scores
+    if not 1 < n_labels < n_samples:
+        raise ValueError(f'Number of labels is {n_labels}. Valid values are 2 to n_samples - 1 (inclusive)')
+
+
+def calinski_harabasz(sizes,
+                      sums):
+    """The Calinski-Harabasz score of binary data, exactly from the cluster sizes and condition sums"""
+    n_samples, n_labels = sizes.sum(), len(sizes)
+    _check_number_of_labels(n_labels, n_samples)
+    centroids = sums / sizes[:, np.newaxis]
+    mean = sums.sum(axis=0) / n_samples
+    # for 0/1 data, the sum of squared norms within a cluster is its sum of condition counts
+    within = np.sum(sums) - np.sum(sizes * np.sum(centroids ** 2, axis=1))
+    between = np.sum(sizes * np.sum((centroids - mean) ** 2, axis=1))
+    return float(1.0 if within == 0.0 else between * (n_samples - n_labels) / (within * (n_labels - 1.0)))
+
+
+def _get_cooccurrences(data_mat,
+                       sums):
+    """Gets, for each row, how many conditions it shares with each cluster in total (n x k)"""
+    return np.asarray(data_mat @ sums.T, dtype=np.float64)
+
+
+def _get_centroid_distances(data_mat,
+                            codes,
+                            sizes,
+                            sums,
+                            cooccurrences):
+    """Gets the Euclidean distance of each row to its cluster centroid; the squared distance is
+    |x| - 2 x.c + |c|^2, so only the row sums and the cooccurrences with the cluster sums are needed"""
+    centroid_sq_norms = np.sum((sums / sizes[:, np.newaxis]) ** 2, axis=1)
+    row_sums = np.asarray(data_mat.sum(axis=1), dtype=np.float64).ravel()
+    own = cooccurrences[np.arange(len(codes)), codes] / sizes[codes]
+    return np.sqrt(np.maximum(row_sums - 2 * own + centroid_sq_norms[codes], 0))
+
+
+def _combine_davies_bouldin(intra_dists,
+                            sizes,
+                            sums):
+    """The Davies-Bouldin score from the mean distance of each cluster's rows to its centroid"""
+    centroids = sums / sizes[:, np.newaxis]
+    centroid_dists = cdist(centroids, centroids)
+    if np.allclose(intra_dists, 0) or np.allclose(centroid_dists, 0):
+        return 0.0
+    centroid_dists[centroid_dists == 0] = np.inf
+    combined_intra_dists = intra_dists[:, np.newaxis] + intra_dists
+    scores = np.max(combined_intra_dists / centroid_dists, axis=1)
+    return float(np.mean(scores))
+
+
+def davies_bouldin(data_mat,
+                   codes,
+                   sizes,
+                   sums,
+                   cooccurrences=None):
+    """The Davies-Bouldin score of binary data, from the row sums and the cooccurrences with the cluster sums"""
+    n_samples, n_labels = sizes.sum(), len(sizes)
+    _check_number_of_labels(n_labels, n_samples)
+    if cooccurrences is None:
+        cooccurrences = _get_cooccurrences(data_mat, sums)
+    distances = _get_centroid_distances(data_mat, codes, sizes, sums, cooccurrences)
+    intra_dists = np.bincount(codes, weights=distances, minlength=n_labels) / sizes
+    return _combine_davies_bouldin(intra_dists, sizes, sums)
+
+
+def _get_silhouettes(data_mat,
+                     codes,
+                     sizes,
+                     sums,
+                     cooccurrences):
+    """Gets the silhouette coefficient of each row with the Hamming metric. The summed Hamming distance
+    from a row x to the rows of cluster j is x.(n_j - 2 s_j) + sum(s_j), so no pairwise distances are needed"""
+    n_conditions = sums.shape[1]
+    row_sums = np.asarray(data_mat.sum(axis=1), dtype=np.float64).ravel()
+    dist_sums = (row_sums[:, np.newaxis] * sizes - 2 * cooccurrences + sums.sum(axis=1)) / n_conditions
+
+    rows = np.arange(len(codes))
+    own_sizes = sizes[codes]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        intra = dist_sums[rows, codes] / (own_sizes - 1)
+        mean_dists = dist_sums / sizes
+    mean_dists[rows, codes] = np.inf
+    inter = mean_dists.min(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sil = (inter - intra) / np.maximum(intra, inter)
+    # as in scikit-learn, rows in singleton clusters score 0
+    return np.where(own_sizes > 1, np.nan_to_num(sil), 0)
+
+
+def hamming_silhouette(data_mat,
+                       codes,
+                       sizes,
+                       sums,
+                       cooccurrences=None):
+    """The mean silhouette coefficient of binary data with the Hamming metric"""
+    n_samples, n_labels = sizes.sum(), len(sizes)
+    _check_number_of_labels(n_labels, n_samples)
+    if cooccurrences is None:
+        cooccurrences = _get_cooccurrences(data_mat, sums)
+    return float(np.mean(_get_silhouettes(data_mat, codes, sizes, sums, cooccurrences)))
+
+
+@stored('scores')
+def get_scores(data_mat,
+               labels):
+    """Gets the silhouette (Hamming), Davies-Bouldin and Calinski-Harabasz scores of a clustering of binary data
+    from one pass of sufficient statistics; these match scikit-learn's scores
+    :param data_mat: the binary numpy array containing the sample features
+    :param labels: the cluster label of each row
+    :returns: a dictionary of the scores, as written to scores.json
+    """
+    codes, sizes, sums = get_cluster_sums(data_mat, labels)
+    cooccurrences = _get_cooccurrences(data_mat, sums)
+    return {'silhouette': hamming_silhouette(data_mat, codes, sizes, sums, cooccurrences),
+            'davies_boulden': davies_bouldin(data_mat, codes, sizes, sums, cooccurrences),
+            'calinski_harabasz': calinski_harabasz(sizes, sums)}
+
+
+def get_silhouette(data_mat,
+                   labels):
+    """Gets the mean silhouette coefficient (Hamming) of a clustering of binary data; as silhouette_score"""
+    codes, sizes, sums = get_cluster_sums(data_mat, labels)
+    return hamming_silhouette(data_mat, codes, sizes, sums)
+
+
+def get_streamed_scores(batches,
+                        sizes,
+                        sums):
+    """Gets the same scores as get_scores in one pass over a cohort streamed in batches, given the cluster sizes
+    and condition sums of the whole clustering (e.g. from get_kmodes_counts over the batches)
+    :param batches: an iterable of (rows, labels) batches, where labels are cluster indices into sizes and sums
+    :param sizes: the size of each cluster; empty clusters are left out, as get_scores never sees them
+    :param sums: the per-cluster condition sums (clusters x conditions)
+    :returns: a dictionary of the scores, as written to scores.json
+    """
+    present = sizes > 0
+    codes_of = np.cumsum(present) - 1
+    sizes, sums = sizes[present], sums[present]
+    n_samples, n_labels = sizes.sum(), len(sizes)
+    _check_number_of_labels(n_labels, n_samples)
+    sil_sum, intra_sums = 0.0, np.zeros(n_labels)
+    for data_mat, labels in batches:
+        codes = codes_of[labels]
+        cooccurrences = _get_cooccurrences(data_mat, sums)
+        sil_sum += np.sum(_get_silhouettes(data_mat, codes, sizes, sums, cooccurrences))
+        intra_sums += np.bincount(codes, weights=_get_centroid_distances(data_mat, codes, sizes, sums, cooccurrences),
+                                  minlength=n_labels)
+    return {'silhouette': float(sil_sum / n_samples),
+            'davies_boulden': _combine_davies_bouldin(intra_sums / sizes, sizes, sums),
+            'calinski_harabasz': calinski_harabasz(sizes, sums)}
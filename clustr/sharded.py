@@ -0,0 +1,102 @@
+import os
+import os.path as osp
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from typing import List
+import numpy as np
+import pandas as pd
+from clustr.kernels import configure_kernels, e_step, m_step_sums
+from clustr.utils import get_checkpoint_key
+
+
+# the shards this worker process has opened, by file
+_SHARDS = {}
+
+
+def write_shards(data_mat,
+                 folder: str,
+                 n_shards: int):
+    """Splits the rows of a matrix into shards, written as .npy files which the workers memory-map
+    :param data_mat: the numpy array containing the sample features
+    :param folder: the folder to which the shards should be written
+    :param n_shards: the number of shards
+    :returns: the shard files, in row order
+    """
+    os.makedirs(folder, exist_ok=True)
+    shards = []
+    for i, rows in enumerate(np.array_split(data_mat, n_shards)):
+        shard = osp.join(folder, f'shard_{i}.npy')
+        np.save(shard, rows)
+        shards.append(shard)
+    return shards
+
+
+def load_shard(shard: str):
+    """Opens a shard: a .npy file is memory-mapped, and a .tsv partition (participants as rows, the prepared binary
+    conditions as columns, as prepared by get_data) is read; either is kept open for the next iteration"""
+    if shard not in _SHARDS:
+        if shard.endswith('.npy'):
+            _SHARDS[shard] = np.load(shard, mmap_mode='r')
+        else:
+            _SHARDS[shard] = pd.read_csv(shard, sep='\t', index_col=0).to_numpy()
+    return _SHARDS[shard]
+
+
+def get_shard_shape(shard: str):
+    """The number of rows and conditions of a shard"""
+    return load_shard(shard).shape
+
+
+def get_shard_key(shard: str):
+    """The fingerprint of a shard's rows (see get_checkpoint_key)"""
+    return get_checkpoint_key(load_shard(shard))
+
+
+def get_shard_statistics(shard: str,
+                         theta,
+                         weight,
+                         backend: str = 'numpy'):
+    """The map step of sharded EM: the E-step over one shard under the given parameters
+    :returns: the sums of the responsibilities and of the responsibility-weighted rows, and the log likelihood
+    """
+    configure_kernels(backend)
+    data = np.asarray(load_shard(shard), dtype=theta.dtype)
+    responsibility, log_likelihood = e_step(data, theta, weight)
+    resp_sum, weighted_sum = m_step_sums(data, responsibility)
+    return resp_sum, weighted_sum, log_likelihood
+
+
+def get_shard_labels(shard: str,
+                     theta,
+                     weight,
+                     backend: str = 'numpy'):
+    """The most probable class of each row of one shard under the given parameters"""
+    configure_kernels(backend)
+    data = np.asarray(load_shard(shard), dtype=theta.dtype)
+    return np.argmax(e_step(data, theta, weight)[0], axis=1)
+
+
+def remove_shards(shards: List[str]):
+    """Deletes shard files written by write_shards"""
+    for shard in shards:
+        _SHARDS.pop(shard, None)
+        if osp.exists(shard):
+            os.remove(shard)
+
+
+@contextmanager
+def local_shards(data_mat,
+                 folder: str,
+                 n_shards: int):
+    """Writes the shards of a matrix and opens a local process pool, with a worker per shard up to the number of
+    cores, for sharded fits (see LCA.fit_shards); both are removed at the end of the block
+    :yields: the shard files and the executor
+    """
+    shards = write_shards(data_mat, folder, n_shards)
+    try:
+        with ProcessPoolExecutor(max_workers=min(n_shards, os.cpu_count() or 1)) as executor:
+            yield shards, executor
+    finally:
+        remove_shards(shards)
+        if not os.listdir(folder):
+            os.rmdir(folder)
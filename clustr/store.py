@@ -0,0 +1,331 @@
+import functools
+import glob
+import hashlib
+import inspect
+import json
+import os
+import os.path as osp
+import pickle
+import time
+import numpy as np
+import pandas as pd
+from clustr.constants import STORE
+from clustr.startup import logger
+from clustr.precision import get_precision
+
+
+# bumped when the layout of the artifacts changes, so that older artifacts are no longer found
+STORE_VERSION = 2
+
+# the default size cap of the store in GB
+DEFAULT_STORE_GB = 10
+
+# store settings; see configure_store. The store is off unless it is enabled
+_ENABLED = False
+_FOLDER = STORE
+_MAX_BYTES = int(DEFAULT_STORE_GB * 1024 ** 3)
+
+# the fingerprints of input files this process has hashed, by (path, size, modification time)
+_FILE_FINGERPRINTS = {}
+
+# the fingerprint of the package's version and code; see get_code_fingerprint
+_CODE_FINGERPRINT = None
+
+
+def configure_store(enabled: bool = True,
+                    folder: str = None,
+                    max_gb: float = DEFAULT_STORE_GB):
+    """Sets whether and where the outputs of the pipeline stages are stored; until this is called, they are not
+    :param enabled: whether stages return stored outputs and store new ones; if False, every stage is computed
+    :param folder: the folder of the store; by default, ~/.clustr/store
+    :param max_gb: the size cap of the store in GB, beyond which the least recently used artifacts are evicted
+    """
+    global _ENABLED, _FOLDER, _MAX_BYTES
+    _ENABLED = enabled
+    _FOLDER = folder or STORE
+    _MAX_BYTES = int(max_gb * 1024 ** 3)
+
+
+def get_store_settings():
+    """The store settings of this process, as the arguments of configure_store, e.g. for worker processes"""
+    return _ENABLED, _FOLDER, _MAX_BYTES / 1024 ** 3
+
+
+def fingerprint_file(path: str):
+    """Hashes the contents of a file; the hash is remembered by the file's size and modification time, in this
+    process and in the store, so an unchanged file is only read once"""
+    stat = os.stat(path)
+    memo = (osp.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if memo not in _FILE_FINGERPRINTS:
+        memo_file = osp.join(_FOLDER, 'files', hashlib.sha1(repr(memo).encode()).hexdigest())
+        if osp.exists(memo_file):
+            with open(memo_file) as infile:
+                _FILE_FINGERPRINTS[memo] = infile.read()
+        else:
+            digest = hashlib.sha1()
+            with open(path, 'rb') as infile:
+                for block in iter(lambda: infile.read(1 << 24), b''):
+                    digest.update(block)
+            _FILE_FINGERPRINTS[memo] = digest.hexdigest()
+            os.makedirs(osp.dirname(memo_file), exist_ok=True)
+            with open(memo_file, 'w') as outfile:
+                outfile.write(_FILE_FINGERPRINTS[memo])
+    return _FILE_FINGERPRINTS[memo]
+
+
+def get_code_fingerprint():
+    """Hashes the version of the package and the sources of all its modules, so that a change to any code a stage
+    calls, not only to the stage itself, leads to new keys"""
+    global _CODE_FINGERPRINT
+    if _CODE_FINGERPRINT is None:
+        try:
+            from importlib.metadata import version
+            package_version = version('clustr')
+        except Exception:
+            # python 3.7, or the package is run from its sources without being installed
+            package_version = None
+        digest = hashlib.sha1(repr(package_version).encode())
+        for source in sorted(glob.glob(osp.join(osp.dirname(osp.abspath(__file__)), '*.py'))):
+            digest.update(osp.basename(source).encode())
+            with open(source, 'rb') as infile:
+                digest.update(infile.read())
+        _CODE_FINGERPRINT = digest.hexdigest()
+    return _CODE_FINGERPRINT
+
+
+def fingerprint(value):
+    """Hashes an input of a stage by its contents: arrays by their bytes, dataframes and series by their values,
+    index and columns, and containers by their items; anything else by its pickle"""
+    digest = hashlib.sha1()
+    if isinstance(value, np.ndarray):
+        digest.update(f'ndarray{value.dtype.str}{value.shape}'.encode())
+        digest.update(np.ascontiguousarray(value).data)
+    elif isinstance(value, (pd.DataFrame, pd.Series)):
+        digest.update(f'{type(value).__name__}{value.shape}'.encode())
+        digest.update(pd.util.hash_pandas_object(value, index=True).to_numpy().data)
+        if isinstance(value, pd.DataFrame):
+            digest.update(repr((list(value.columns), [str(dtype) for dtype in value.dtypes])).encode())
+        else:
+            digest.update(repr((value.name, str(value.dtype))).encode())
+    elif isinstance(value, dict):
+        digest.update(b'dict')
+        for key, item in value.items():
+            digest.update(fingerprint(key).encode() + fingerprint(item).encode())
+    elif isinstance(value, (list, tuple, pd.Index)):
+        digest.update(type(value).__name__.encode())
+        for item in value:
+            digest.update(fingerprint(item).encode())
+    elif value is None or isinstance(value, (str, bytes, int, float, bool, np.generic)):
+        digest.update(repr(value).encode())
+    else:
+        digest.update(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+    return digest.hexdigest()
+
+
+def _describe(value):
+    """A short description of an input of a stage, for listing the store"""
+    if isinstance(value, (np.ndarray, pd.DataFrame, pd.Series)):
+        return f'{type(value).__name__}{value.shape}'
+    text = repr(value)
+    return text if len(text) <= 60 else text[:57] + '...'
+
+
+def _artifact_file(key: str):
+    return osp.join(_FOLDER, 'artifacts', key[:2], key + '.pkl')
+
+
+def _write_atomically(filename: str,
+                      write):
+    """Writes a file through a temporary file which then replaces it, so that concurrent jobs never read a partial
+    artifact"""
+    os.makedirs(osp.dirname(filename), exist_ok=True)
+    tmp_file = f'{filename}.{os.getpid()}.tmp'
+    with open(tmp_file, 'wb') as outfile:
+        write(outfile)
+    os.replace(tmp_file, filename)
+
+
+def _read_folder_outputs(folder: str,
+                         since: float):
+    """The files a stage wrote into its output folder (top level only), by name"""
+    outputs = {}
+    for name in os.listdir(folder) if osp.isdir(folder) else []:
+        path = osp.join(folder, name)
+        if osp.isfile(path) and os.stat(path).st_mtime >= since:
+            with open(path, 'rb') as infile:
+                outputs[name] = infile.read()
+    return outputs
+
+
+def _restore_folder_outputs(folder: str,
+                            outputs):
+    os.makedirs(folder, exist_ok=True)
+    for name, contents in outputs.items():
+        _write_atomically(osp.join(folder, name), lambda outfile: outfile.write(contents))
+
+
+def stored(stage: str,
+           files=(),
+           outputs: str = None,
+           ignore=(),
+           seeds=(),
+           keys=None):
+    """Makes a function a pipeline stage whose results are kept in the content-addressed store: the key is the hash
+    of the package's code (see get_code_fingerprint) and of all the function's arguments (by content), so a call with
+    unchanged inputs returns the stored result at once, and any upstream change leads to a new key
+    :param stage: the name of the stage, e.g. 'load', 'fit', 'labels', 'scores' or 'enrichment'
+    :param files: the arguments which are paths to input files, which are hashed by their contents
+    :param outputs: the argument which is the folder the stage writes its files into, if any; the files are stored
+            with the result and written back when it is returned from the store. The folder is part of the key, as
+            repeated fits into different folders (e.g. run_0, run_1) are distinct
+    :param ignore: the arguments which do not change the result (e.g. the number of worker processes), and are left
+            out of the key
+    :param seeds: the arguments which make a random stage repeatable (e.g. random_state, or the model a fit is warm
+            started from); a call in which all of them are None is random, and is computed without being stored
+    :param keys: the arguments of which only a part changes the result, each with the function which gets that
+            part, e.g. the fields of a memory plan which do not depend on the memory available
+    """
+    keys = keys or {}
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _ENABLED:
+                return func(*args, **kwargs)
+            arguments = signature.bind(*args, **kwargs)
+            arguments.apply_defaults()
+            arguments = arguments.arguments
+            if seeds and all(arguments[name] is None for name in seeds):
+                return func(*args, **kwargs)
+            folder = arguments.get(outputs) if outputs else None
+            hashes = {name: fingerprint_file(value) if name in files and value is not None
+                      else fingerprint(keys[name](value)) if name in keys and value is not None
+                      else fingerprint(osp.abspath(value) if name == outputs and value else value)
+                      for name, value in arguments.items() if name not in ignore}
+            key = fingerprint([STORE_VERSION, stage, func.__module__, func.__qualname__, get_code_fingerprint(),
+                               get_precision(), sorted(hashes.items())])
+            artifact_file = _artifact_file(key)
+            try:
+                with open(artifact_file, 'rb') as infile:
+                    artifact = pickle.load(infile)
+            except (OSError, EOFError, pickle.UnpicklingError):
+                artifact = None
+            if artifact is not None:
+                # the modification time of the artifact is the time it was last used, for the LRU eviction
+                os.utime(artifact_file)
+                if folder:
+                    _restore_folder_outputs(folder, artifact['outputs'])
+                logger.info(f'Loaded the {stage} stage {func.__qualname__} from the store ({key[:12]}).')
+                return artifact['result']
+
+            started = time.time() - 1
+            result = func(*args, **kwargs)
+            artifact = {'result': result,
+                        'outputs': _read_folder_outputs(folder, started) if folder else {},
+                        'info': {'key': key,
+                                 'stage': stage,
+                                 'function': f'{func.__module__}.{func.__qualname__}',
+                                 'created': time.time(),
+                                 'arguments': {name: _describe(value) for name, value in arguments.items()}}}
+            _write_atomically(artifact_file, lambda outfile: pickle.dump(artifact, outfile, pickle.HIGHEST_PROTOCOL))
+            _write_atomically(artifact_file[:-len('.pkl')] + '.json',
+                              lambda outfile: outfile.write(json.dumps(artifact['info']).encode()))
+            evict()
+            return result
+        return wrapper
+    return decorator
+
+
+def _iter_artifacts():
+    """The (artifact file, info file) of every artifact in the store"""
+    root = osp.join(_FOLDER, 'artifacts')
+    for prefix in sorted(os.listdir(root)) if osp.isdir(root) else []:
+        for name in sorted(os.listdir(osp.join(root, prefix))):
+            if name.endswith('.pkl'):
+                artifact_file = osp.join(root, prefix, name)
+                yield artifact_file, artifact_file[:-len('.pkl')] + '.json'
+
+
+def list_artifacts(stage: str = None):
+    """Lists the artifacts in the store
+    :param stage: if given, only the artifacts of this stage are listed
+    :returns: a dataframe with a row per artifact (its key, stage, function, size, creation and last use, and the
+            arguments it was computed from), the most recently used first
+    """
+    rows = []
+    for artifact_file, info_file in _iter_artifacts():
+        try:
+            with open(info_file) as infile:
+                info = json.load(infile)
+            stat = os.stat(artifact_file)
+        except (OSError, ValueError):
+            continue
+        if stage is None or info['stage'] == stage:
+            rows.append({'key': info['key'],
+                         'stage': info['stage'],
+                         'function': info['function'],
+                         'size_mb': stat.st_size / 1024 ** 2,
+                         'created': pd.Timestamp(info['created'], unit='s'),
+                         'last_used': pd.Timestamp(stat.st_mtime, unit='s'),
+                         'arguments': info['arguments']})
+    columns = ['key', 'stage', 'function', 'size_mb', 'created', 'last_used', 'arguments']
+    return pd.DataFrame(rows, columns=columns).sort_values('last_used', ascending=False, ignore_index=True)
+
+
+def _remove_artifact(artifact_file: str,
+                     info_file: str):
+    for filename in (artifact_file, info_file):
+        try:
+            os.remove(filename)
+        except FileNotFoundError:
+            # another process removed it first
+            pass
+
+
+def invalidate(stage: str = None,
+               key: str = None,
+               function: str = None):
+    """Removes artifacts from the store, so that their stages are computed again; with no arguments, all of them
+    :param stage: if given, only the artifacts of this stage are removed
+    :param key: if given, only the artifact whose key starts with this is removed
+    :param function: if given, only the artifacts of the functions whose name ends with this are removed
+    :returns: the number of artifacts removed
+    """
+    removed = 0
+    for artifact_file, info_file in list(_iter_artifacts()):
+        try:
+            with open(info_file) as infile:
+                info = json.load(infile)
+        except (OSError, ValueError):
+            info = {'key': osp.basename(artifact_file)[:-len('.pkl')], 'stage': None, 'function': ''}
+        if ((stage is None or info['stage'] == stage) and (key is None or info['key'].startswith(key))
+                and (function is None or info['function'].endswith(function))):
+            _remove_artifact(artifact_file, info_file)
+            removed += 1
+    logger.info(f'Removed {removed} artifacts from the store.')
+    return removed
+
+
+def evict(max_bytes: int = None):
+    """Removes the least recently used artifacts until the store is within its size cap
+    :param max_bytes: the size cap in bytes; by default, the one set by configure_store
+    :returns: the number of artifacts removed
+    """
+    max_bytes = _MAX_BYTES if max_bytes is None else max_bytes
+    artifacts = []
+    for artifact_file, info_file in _iter_artifacts():
+        try:
+            stat = os.stat(artifact_file)
+        except FileNotFoundError:
+            continue
+        artifacts.append((stat.st_mtime, stat.st_size, artifact_file, info_file))
+    total = sum(size for _, size, _, _ in artifacts)
+    removed = 0
+    for _, size, artifact_file, info_file in sorted(artifacts):
+        if total <= max_bytes:
+            break
+        _remove_artifact(artifact_file, info_file)
+        total -= size
+        removed += 1
+    return removed
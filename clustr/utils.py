@@ -6,10 +6,17 @@ import pandas as pd
 import numpy as np
 from typing import List, Dict, Any
 import json
+import hashlib
+import os
 import os.path as osp
 from scipy.stats import fisher_exact
+from sklearn.metrics import adjusted_rand_score, normalized_mutual_info_score
 from statsmodels.stats.multitest import multipletests
 from clustr.startup import logger
+from clustr.plotting import submit_plot
+from clustr.precision import get_data_dtype
+from clustr.readers import read_cohort, iter_cohort_chunks
+from clustr.store import stored
 
 
 def dict_to_json(d: Dict[Any, Any],
@@ -19,6 +26,49 @@ def dict_to_json(d: Dict[Any, Any],
         json.dump(d, outfile)
 
 
+def get_checkpoint_key(data_mat):
+    """Gets a fingerprint of the data matrix, so that a checkpoint is only resumed on the same data"""
+    return hashlib.sha1(np.ascontiguousarray(data_mat).data).hexdigest()
+
+
+def load_checkpoint(filename: str,
+                    key: str):
+    """Reads the per-k results of an interrupted model-selection sweep
+    :param filename: the checkpoint file; if None or missing, nothing is resumed
+    :param key: the fingerprint of the data (see get_checkpoint_key); a checkpoint
+            written for other data is ignored
+    :returns: a dictionary of {k: result} for each k already finished
+    """
+    if filename is None or not osp.exists(filename):
+        return {}
+    with open(filename) as infile:
+        checkpoint = json.load(infile)
+    if checkpoint.get('key') != key:
+        logger.info(f'Ignoring checkpoint {filename}, which was written for different data.')
+        return {}
+    logger.info(f'Resuming from checkpoint {filename}.')
+    return {int(k): v for k, v in checkpoint['results'].items()}
+
+
+def write_checkpoint(results: Dict[int, Any],
+                     filename: str,
+                     key: str):
+    """Writes the per-k results of a model-selection sweep so far; the file is replaced
+    atomically so that an interruption never leaves a truncated checkpoint
+    :param results: a dictionary of {k: result} for each k finished
+    :param filename: the checkpoint file; if None, nothing is written
+    :param key: the fingerprint of the data (see get_checkpoint_key)
+    """
+    if filename is None:
+        return
+    try:
+        dict_to_json({'key': key, 'results': results}, filename + '.tmp')
+    except Exception:
+        os.remove(filename + '.tmp')
+        raise
+    os.replace(filename + '.tmp', filename)
+
+
 def get_top_cluster_conds(df: pd.DataFrame,
                           conditions: List[str],
                           labels_column: str,
@@ -50,6 +100,7 @@ def get_adjusted_cluster_conds(df: pd.DataFrame,
     return dict(arfs), dict(cluster_prevalences)
 
 
+@stored('enrichment')
 def get_arfs_prevalences(df: pd.DataFrame,
                          labels_column: str,
                          conditions: List[str]):
@@ -95,12 +146,13 @@ def generate_contingency_table(df: pd.DataFrame,
     # the rest of the people with the condition
     tot_cond = df[condition].sum() - clust_cond
     # the rest of the people without the condition
-    tot_no_cond = len(df) - tot_cond - clust_no_cond
+    tot_no_cond = len(df) - len(clust) - tot_cond
     cont_table = np.array([[clust_cond, clust_no_cond],
                            [tot_cond, tot_no_cond]])
     return cont_table
 
 
+@stored('enrichment')
 def get_fischers_coefficients(df: pd.DataFrame,
                                labels_column: str,
                                conditions: List[str],
@@ -169,6 +221,86 @@ def plot_freqs(df: pd.DataFrame,
     # TODO: get the pvalues or **s somehow represented on this plot
 
 
+def get_morbidity_counts(df: pd.DataFrame,
+                         cluster_labels: str):
+    """Counts the patients with each total number of conditions in each cluster, in one pass
+    :param df: the dataframe being operated upon (must contain tot_conditions column)
+    :param cluster_labels: the column name containing the cluster labels
+    :returns: a dataframe of counts, with a row per cluster and a column per number of conditions (0 to the max)
+    """
+    codes, clusters = pd.factorize(df[cluster_labels], sort=True)
+    tot_conditions = df['tot_conditions'].to_numpy(dtype=np.int64)
+    width = int(tot_conditions.max()) + 1
+    counts = np.bincount(codes * width + tot_conditions, minlength=len(clusters) * width)
+    return pd.DataFrame(counts.reshape(len(clusters), width), index=clusters, columns=np.arange(width))
+
+
+def _count_percentile(values,
+                      cum_counts,
+                      p: float):
+    """Linearly interpolated percentile (as np.percentile) of data given as sorted values and cumulative counts"""
+    h = (cum_counts[-1] - 1) * p / 100
+    lo = values[np.searchsorted(cum_counts, np.floor(h), side='right')]
+    hi = values[np.searchsorted(cum_counts, np.ceil(h), side='right')]
+    return lo + (h - np.floor(h)) * (hi - lo)
+
+
+def get_count_box_stats(counts: pd.Series,
+                        whis: float = 1.5):
+    """Gets the boxplot statistics (as matplotlib's boxplot_stats) of the data described by a row of
+    get_morbidity_counts, without expanding it into patients
+    :param counts: the number of patients with each number of conditions
+    :param whis: the whisker reach, as a multiple of the interquartile range
+    :returns: a dictionary of boxplot statistics, for matplotlib's bxp
+    """
+    present = counts[counts > 0]
+    values = present.index.to_numpy(dtype=float)
+    cum_counts = np.cumsum(present.to_numpy())
+    q1, med, q3 = (_count_percentile(values, cum_counts, p) for p in (25, 50, 75))
+    iqr = q3 - q1
+    inside = values[(values >= q1 - whis * iqr) & (values <= q3 + whis * iqr)]
+    whislo = min(inside.min(), q1)
+    whishi = max(inside.max(), q3)
+    return {'label': counts.name,
+            'mean': float(np.dot(values, present.to_numpy()) / cum_counts[-1]),
+            'iqr': iqr,
+            'q1': q1,
+            'med': med,
+            'q3': q3,
+            'whislo': whislo,
+            'whishi': whishi,
+            'fliers': values[(values < whislo) | (values > whishi)]}
+
+
+def render_morbidity_dist(counts: pd.DataFrame,
+                          outfolder: str,
+                          clustering_method: str):
+    """Draws the histograms and boxplot of conditions per patient from get_morbidity_counts"""
+    # Individual Histograms
+    bin_no = counts.columns.max() + 1
+    fig, axes = plt.subplots(len(counts), 1, figsize=(10, 40), sharex=True, squeeze=False)
+    try:
+        for ax, (clust, row) in zip(axes[:, 0], counts.iterrows()):
+            ax.hist(counts.columns, weights=row.to_numpy(), range=[1, bin_no], bins=bin_no*2, align='mid')
+            ax.set_title(clust)
+            ax.set_ylabel('Frequency')
+        axes[-1, 0].set_xticks(np.arange(1, bin_no, 1))
+        axes[-1, 0].set_xlabel("Number of conditions")
+        fig.savefig(osp.join(outfolder, f'{clustering_method}_histograms.png'), dpi=300, bbox_inches='tight')
+    finally:
+        plt.close(fig)
+    # Boxplot for comparison
+    fig, ax = plt.subplots()
+    try:
+        ax.bxp([get_count_box_stats(row) for _, row in counts.iterrows()])
+        ax.set_ylabel("Total conditions per patient")
+        ax.set_xlabel("Cluster labels")
+        ax.set_title("Distribution of the number of conditions in each cluster")
+        fig.savefig(osp.join(outfolder, f'{clustering_method}_boxplot.png'), dpi=300, bbox_inches='tight')
+    finally:
+        plt.close(fig)
+
+
 def plot_morbidity_dist(df: pd.DataFrame,
                         cluster_labels: str,
                         outfolder: str,
@@ -180,20 +312,33 @@ def plot_morbidity_dist(df: pd.DataFrame,
     :param clustering_method: the clustering method used
     :returns: None; Outputs files to file location
     """
-    # Individual Histograms
-    bin_no = max(df['tot_conditions']) + 1
-    ax = df.plot.hist(column="tot_conditions", by=cluster_labels, range=[1, bin_no], bins=bin_no*2,
-                      align='mid', figsize=(10, 40))
-    plt.xticks(np.arange(1, bin_no, 1))
-    plt.xlabel("Number of conditions")
-    plt.savefig(osp.join(outfolder, f'{clustering_method}_histograms.png'), dpi=300, bbox_inches='tight')
-    # Boxplot for comparison
-    boxplot = df.boxplot(column="tot_conditions", by=cluster_labels)
-    plt.ylabel("Total conditions per patient")
-    plt.xlabel("Cluster labels")
-    plt.title("Distribution of the number of conditions in each cluster")
-    plt.suptitle("")
-    plt.savefig(osp.join(outfolder, f'{clustering_method}_boxplot.png'), dpi=300, bbox_inches='tight')
+    counts = get_morbidity_counts(df, cluster_labels)
+    counts.to_csv(osp.join(outfolder, f'{clustering_method}_morbidity_counts.tsv'), sep='\t')
+    submit_plot(render_morbidity_dist, counts, outfolder, clustering_method)
+
+
+def render_ks(cost,
+              out_folder,
+              metric='costs',
+              min_k=1,
+              max_k=10):
+    """Draws the respective costs per K"""
+    df_cost = pd.DataFrame.from_dict(cost, orient='index', columns=['Cost'])
+    df_cost.reset_index(inplace=True)
+    df_cost.columns = ['Cluster', 'Cost']
+    num_ks = max_k - min_k
+    fig = plt.figure(figsize=(int(num_ks * 8 / 9), 4.8))
+    try:
+        plt.plot(df_cost['Cluster'], df_cost['Cost'], marker='o', linestyle='-')
+        plt.scatter(df_cost['Cluster'], df_cost['Cost'])
+        for i, txt in enumerate(df_cost['Cluster']):
+            plt.annotate(txt, (df_cost['Cluster'][i], df_cost['Cost'][i]+1000), size=max_k)
+        plt.title('Optimal number of Clusters')
+        plt.xlabel('Number of Clusters (k)')
+        plt.ylabel(f'{metric}')
+        plt.savefig(osp.join(out_folder, f'model_selection_{metric}.png'), dpi=300)
+    finally:
+        plt.close(fig)
 
 
 def plot_ks(cost,
@@ -202,35 +347,29 @@ def plot_ks(cost,
             min_k=1,
             max_k=10):
     """Plots the respective costs per K"""
-    df_cost = pd.DataFrame.from_dict(cost, orient='index', columns=['Cost'])
-    df_cost.reset_index(inplace=True)
-    df_cost.columns = ['Cluster', 'Cost']
-    num_ks = max_k - min_k
-    plt.figure(figsize=(int(num_ks * 8 / 9), 4.8))
-    plt.plot(df_cost['Cluster'], df_cost['Cost'], marker='o', linestyle='-')
-    plt.scatter(df_cost['Cluster'], df_cost['Cost'])
-    for i, txt in enumerate(df_cost['Cluster']):
-        plt.annotate(txt, (df_cost['Cluster'][i], df_cost['Cost'][i]+1000), size=max_k)
-    plt.title('Optimal number of Clusters')
-    plt.xlabel('Number of Clusters (k)')
-    plt.ylabel(f'{metric}')
-    plt.savefig(osp.join(out_folder, f'model_selection_{metric}.png'), dpi=300)
-    plt.close()
+    submit_plot(render_ks, dict(cost), out_folder, metric, min_k, max_k)
 
 
 
+@stored('load', files=('input_file',))
 def get_data(input_file,
              sample_frac: float = 1,
              drop_healthy: bool = False,
-             coi=None):
+             coi=None,
+             metadata: List[str] = None,
+             filters: List[tuple] = None):
     """Gets the data and returns it as a numpy matrix without the depression column.
     :param input_file: the file containing the data, in which columns are conditions, 
-            rows are patients, and values are binary
+            rows are patients, and values are binary; a tab-separated file, or a Parquet, Feather or Arrow file
+            (which requires pyarrow)
     :param sample_frac: the fraction of the data to be sampled; default is 1, so all the data is used
     :param drop_healthy: boolean value indicating whether to drop those with no conditions
     :param coi: the conditions of interest; these columns are removed from the data for clustering
                 and stored/returned separately; if None, all conditions are used.
                 Should be a string or a list of strings (List[str])
+    :param metadata: the columns of the file which are not conditions (e.g. sex or age); they are not read
+    :param filters: the (column, operator, value) filters, e.g. from clustr.readers.parse_filter, which the rows
+                must pass to be read, such as ('sex', '==', 'F'); see clustr.readers.read_cohort
     :returns: dataframe of the data,
                 numpy matrix of features,
                 patient ids,
@@ -238,7 +377,50 @@ def get_data(input_file,
                 condition names
     """
     logger.info(f'Processing data from {input_file}...')
-    df = pd.read_csv(input_file, sep='\t', index_col=0)
+    df = read_cohort(input_file, metadata, filters)
+    df, mat, pat_ids, exclusions, cgrps = prepare_data(df, sample_frac, drop_healthy, coi)
+    logger.info(f'Finished processing data from {input_file}.')
+    return df, mat, pat_ids, exclusions, cgrps
+
+
+def iter_data_chunks(input_file,
+                     chunk_rows: int,
+                     sample_frac: float = 1,
+                     drop_healthy: bool = False,
+                     coi=None,
+                     metadata: List[str] = None,
+                     filters: List[tuple] = None):
+    """Reads the data in chunks of rows, each prepared as in get_data, so that a cohort larger than memory can be
+    streamed; every call reads the file again, and yields the same rows in the same order
+    :param input_file: the file containing the data, as in get_data
+    :param chunk_rows: the number of rows read at a time
+    :param sample_frac: the fraction of each chunk to be sampled; default is 1, so all the data is used
+    :param drop_healthy: boolean value indicating whether to drop those with no conditions
+    :param coi: the conditions of interest, which are removed from the data, as in get_data
+    :param metadata: the columns of the file which are not conditions, as in get_data
+    :param filters: the filters which the rows must pass to be read, as in get_data
+    :returns: a generator of the dataframe, numpy matrix of features and condition names of each chunk
+    """
+    for chunk in iter_cohort_chunks(input_file, chunk_rows, metadata, filters):
+        df, mat, _, _, cgrps = prepare_data(chunk, sample_frac, drop_healthy, coi)
+        if len(df):
+            yield df, mat, cgrps
+
+
+def prepare_data(df: pd.DataFrame,
+                 sample_frac: float = 1,
+                 drop_healthy: bool = False,
+                 coi=None):
+    """Prepares an already loaded cohort for clustering, as in get_data; the given dataframe is not modified,
+    so one loaded cohort can be prepared for several runs
+    :param df: the dataframe of the data, in which columns are conditions, rows are patients, and values are binary
+    :param sample_frac: the fraction of the data to be sampled; default is 1, so all the data is used
+    :param drop_healthy: boolean value indicating whether to drop those with no conditions
+    :param coi: the conditions of interest; these columns are removed from the data for clustering
+                and stored/returned separately; if None, all conditions are used.
+                Should be a string or a list of strings (List[str])
+    :returns: the same as get_data
+    """
     # Subset the data if necessary
     df = df.sample(frac=sample_frac, random_state=1)
     # Get patient IDs
@@ -254,61 +436,155 @@ def get_data(input_file,
         df = df.loc[df.sum(numeric_only=True, axis=1) != 0]
     # Get column names (conditions)
     cgrps = list(df.columns)
-    # Convert dataframe to matrix
-    mat = df.to_numpy()
+    # Convert dataframe to matrix, in the dtype of the precision mode
+    mat = df.to_numpy(dtype=get_data_dtype())
     # Get total conditions column for later
     df['tot_conditions'] = df[cgrps].sum(numeric_only=True, axis=1)
-    logger.info(f'Finished processing data from {input_file}.')
     return df, mat, pat_ids, exclusions, cgrps
 
 
+def write_labels(labels: pd.DataFrame,
+                 labels_file: str):
+    """Writes only the patient IDs and cluster labels (not the data itself) to a gzip-compressed tsv
+    :param labels: a dataframe of one or more label (or posterior) columns, indexed by patient ID
+    :param labels_file: the labels file, ending with .tsv.gz
+    """
+    labels.to_csv(labels_file, sep='\t', compression='gzip', float_format='%.6g')
+
+
+def find_labels_file(folder: str,
+                     filename: str):
+    """Finds a labels file in a results folder; the compact (.gz) format is preferred over the
+    older files which contain the whole data
+    :param folder: the results folder
+    :param filename: the name of the labels file, e.g. lca_cluster_labels.tsv
+    """
+    compact = osp.join(folder, filename + '.gz')
+    return compact if osp.exists(compact) else osp.join(folder, filename)
+
+
+def warn_warm_start_k(k: int,
+                      warm_k: int):
+    """Warns that a warm start keeps the number of clusters of the model it starts from, if k differs"""
+    if k != warm_k:
+        logger.warning(f'Warm starting from {warm_k} clusters; k={k} is ignored.')
+
+
+def join_labels(df: pd.DataFrame,
+                labels_file: str):
+    """Rejoins the labels written by the CLI to the cohort, e.g. the dataframe from get_data
+    :param df: the dataframe of the data, indexed by patient ID
+    :param labels_file: the labels file written by the CLI
+    :returns: the dataframe with the label columns appended; patients without labels get NaN
+    """
+    labels = pd.read_csv(labels_file, sep='\t', index_col=0)
+    return df.join(labels.drop(columns=[col for col in labels.columns if col in df.columns]))
+
+
+@stored('labels', files=('labels_file',))
+def read_labels(labels_file: str,
+                labels_column: str = None):
+    """Reads only the patient IDs and the cluster labels from a labels file written by the CLI
+    :param labels_file: the labels file, e.g. results/lca/lca_cluster_labels.tsv
+    :param labels_column: the column name containing the cluster labels; if None, the first column after the IDs
+    :returns: a series of cluster labels indexed by patient ID
+    """
+    header = pd.read_csv(labels_file, sep='\t', nrows=0).columns
+    index_col = header[0]
+    labels_column = labels_column or header[1]
+    labels = pd.read_csv(labels_file, sep='\t', index_col=0, usecols=[index_col, labels_column])
+    return labels[labels_column]
+
+
+@stored('labels', files=('labels_file',))
+def read_label_runs(labels_file: str,
+                    labels_columns: List[str] = None):
+    """Reads the patient IDs and several columns of cluster labels from a labels file, e.g. one per repetition
+    :param labels_file: the labels file, e.g. results/lca/lca_cluster_labels.tsv
+    :param labels_columns: the column names containing the cluster labels; if None, all the columns after the IDs
+    :returns: a dataframe of cluster labels indexed by patient ID, with a column per run
+    """
+    header = pd.read_csv(labels_file, sep='\t', nrows=0).columns
+    labels_columns = list(labels_columns or header[1:])
+    return pd.read_csv(labels_file, sep='\t', index_col=0, usecols=[header[0]] + labels_columns)[labels_columns]
+
+
+def get_label_drift(prev_labels: pd.Series,
+                    labels: pd.Series):
+    """Compares the cluster labels of a refitted model with those of the previous model,
+    over the patients which are present in both
+    :param prev_labels: the previous cluster labels, indexed by patient ID
+    :param labels: the new cluster labels, indexed by patient ID
+    :returns: a dictionary summarising the label drift
+    """
+    common = prev_labels.index.intersection(labels.index)
+    prev_common = prev_labels.loc[common].to_numpy()
+    new_common = labels.loc[common].to_numpy()
+    return {'n_previous': len(prev_labels),
+            'n_current': len(labels),
+            'n_common': len(common),
+            'n_new': len(labels.index.difference(prev_labels.index)),
+            'n_dropped': len(prev_labels.index.difference(labels.index)),
+            'changed_fraction': float(np.mean(prev_common != new_common)) if len(common) else None,
+            'adjusted_rand': float(adjusted_rand_score(prev_common, new_common)) if len(common) else None,
+            'normalized_mutual_info': float(normalized_mutual_info_score(prev_common, new_common)) if len(common) else None}
+
+
 def map_to_scale(arf):
-    """Maps ARF value to a scaled value to show magnitude better"""
+    """Maps ARF value to a scaled value to show magnitude better; works elementwise on arrays"""
     scaled_arf = 2 * (arf - 1) / (arf + 1)
     return scaled_arf
 
 
+@stored('enrichment')
 def get_bubble_heatmap_input(values_dict,
                              pvalue_dict,
                              alpha: float = 0.05,
-                             arf_scaling = False):
+                             arf_scaling = False,
+                             conditions: List[str] = None,
+                             clusters: List[Any] = None):
     """Formats values so the user can make a bubble heatmap.
     :param values_dict: the dictionary of dictionaries containing {cluster ID: {condition: value}},
-        where value can be prevalences or ARF values
+        where value can be prevalences or ARF values; alternatively, a dataframe or numpy array of
+        conditions x clusters, such as those from the enrichment step
     :param pvalue_dict: the dictionary of dictionaries containing {cluster ID: {condition: pvalue}}; the user should
-        decide whether to use adjusted or regular p-values
+        decide whether to use adjusted or regular p-values; alternatively, a dataframe or numpy array
+        shaped like values_dict
     :param alpha: the pvalue threshold for significance; anything >= to pvalue is omitted
     :param arf_scaling: boolean value indicating whether to scale the values_dict for better visualization (recommended if they are ARFs)
+    :param conditions: the row (condition) names, if values_dict and pvalue_dict are numpy arrays
+    :param clusters: the column (cluster) names, if values_dict and pvalue_dict are numpy arrays
     """
-    assert set(values_dict.keys()) == set(pvalue_dict.keys()), "The keys of the values_dict and pvalue_dict must match"
-    
-    heatmap_data = pd.DataFrame(values_dict)
-
-    # get the masks to omit the non-significant values
-    heatmap_masks = {key: dict() for key in values_dict.keys()}
-    for cluster, val in values_dict.items():
-        for condition in val:
-            if pvalue_dict[cluster][condition] >= alpha:
-                heatmap_masks[cluster][condition] = True
-            else:
-                heatmap_masks[cluster][condition] = False
-    heatmap_masks = pd.DataFrame(heatmap_masks)
-
-    # find the rows where all columns are true, drop them
-    true_indices = heatmap_masks.all(axis=1)
-    true_indices = list(true_indices.index[true_indices])
-    heatmap_data.drop(true_indices, inplace=True)
-    heatmap_masks.drop(true_indices, inplace=True)
+    if isinstance(values_dict, dict):
+        assert set(values_dict.keys()) == set(pvalue_dict.keys()), "The keys of the values_dict and pvalue_dict must match"
+        heatmap_data = pd.DataFrame(values_dict)
+        pvalues = pd.DataFrame(pvalue_dict).reindex(index=heatmap_data.index, columns=heatmap_data.columns)
+    elif isinstance(values_dict, pd.DataFrame):
+        heatmap_data = values_dict
+        pvalues = pd.DataFrame(pvalue_dict).reindex(index=heatmap_data.index, columns=heatmap_data.columns)
+    else:
+        heatmap_data = pd.DataFrame(values_dict, index=conditions, columns=clusters)
+        pvalues = pd.DataFrame(pvalue_dict, index=heatmap_data.index, columns=heatmap_data.columns)
+    values = heatmap_data.to_numpy(dtype=float)
+
+    # mask the non-significant values, and drop the conditions with no significant values
+    masks = pvalues.to_numpy(dtype=float) >= alpha
+    keep = ~masks.all(axis=1)
+    values = values[keep]
+    masks = masks[keep]
 
     # scale if necessary
     if arf_scaling:
-        heatmap_data = heatmap_data.applymap(map_to_scale)
-
-    # Flatten the DataFrame
-    result_df = heatmap_data.where(~heatmap_masks, np.nan)
-    flattened_df = pd.melt(result_df.reset_index(), id_vars=['index'], var_name='cluster', value_name='values')
-    flattened_df.rename(columns={'index': 'condition'}, inplace=True)
-    flattened_df['abs_values'] = flattened_df['values'].map(lambda x: abs(x))  # get the absval for magnitude
-    flattened_df['overrep'] = flattened_df['values'].map(lambda x: 1 if x > 0 else 0)  # over or under represented directionality
+        values = map_to_scale(values)
+    values = np.where(masks, np.nan, values)
+
+    # Flatten column by column, as pd.melt would
+    n_conditions, n_clusters = values.shape
+    flat_values = values.T.ravel()
+    flattened_df = pd.DataFrame({'condition': np.tile(heatmap_data.index.to_numpy()[keep], n_clusters),
+                                 'cluster': np.repeat(heatmap_data.columns.to_numpy(), n_conditions),
+                                 'values': flat_values,
+                                 'abs_values': np.abs(flat_values),  # get the absval for magnitude
+                                 'overrep': (flat_values > 0).astype(np.int64)})  # over or under represented directionality
 
     return flattened_df
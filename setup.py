@@ -12,6 +12,8 @@ requirements = ['bayespy==0.5.22',
                 'memory_profiler==0.60.0',
                 'numpy==1.22.3',
                 'pandas==1.4.2',
+                'psutil==5.9.1',
+                'PyYAML==6.0',
                 'scikit-learn==1.1.1',
                 'scikit-learn-extra==0.2.0',
                 'scipy==1.9.0',
@@ -21,6 +23,9 @@ requirements = ['bayespy==0.5.22',
 
 test_requirements = ['pytest>=3', ]
 
+extras_requirements = {'numba': ['numba>=0.56'],
+                       'columnar': ['pyarrow>=8']}
+
 setup(
     author="Lauren Nicole DeLong",
     author_email='l.n.delong@sms.ed.ac.uk',
@@ -40,6 +45,7 @@ setup(
         ],
     },
     install_requires=requirements,
+    extras_require=extras_requirements,
     license="MIT license",
     include_package_data=True,
     keywords='clustr',
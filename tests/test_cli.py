@@ -0,0 +1,32 @@
+import logging
+import numpy as np
+from click.testing import CliRunner
+from clustr.cli import cli
+from clustr.kmodes_utils import save_kmodes_state, fit_kmodes
+from clustr.store import configure_store
+
+configure_store(enabled=False)
+
+
+def write_warm_start(folder: str,
+                     k: int = 3,
+                     n_conditions: int = 4):
+    save_kmodes_state(folder, np.eye(k, n_conditions, dtype=int), np.zeros((k, n_conditions), dtype=int),
+                      np.zeros(k, dtype=int))
+
+
+def test_kmodes_warm_start_rejects_a_different_kclusters(tmp_path):
+    write_warm_start(str(tmp_path))
+    result = CliRunner().invoke(cli, ['kmodes', '-i', 'missing.tsv', '-k', '5', '-w', str(tmp_path)])
+    assert result.exit_code == 2
+    assert '--kclusters 5 differs from the 3 clusters of the warm start' in result.output
+
+
+def test_fit_kmodes_warns_that_a_warm_start_keeps_its_k(tmp_path, caplog):
+    rng = np.random.default_rng(0)
+    data_mat = (rng.random((60, 4)) < 0.4).astype(np.uint8)
+    with caplog.at_level(logging.WARNING):
+        model, _ = fit_kmodes(data_mat, str(tmp_path), [f'disease_{i}' for i in range(4)], 5,
+                              np.eye(3, 4, dtype=int))
+    assert model.n_clusters == 3
+    assert 'k=5 is ignored' in caplog.text
@@ -0,0 +1,27 @@
+import numpy as np
+from scipy.stats import fisher_exact
+from clustr.cooccurrence import fisher_exact_pvalues
+
+
+def scipy_pvalues(tables):
+    return np.array([fisher_exact([[a, b], [c, d]])[1] for a, b, c, d in tables])
+
+
+def test_fisher_exact_pvalues_match_scipy():
+    rng = np.random.default_rng(0)
+    tables = np.concatenate([rng.integers(0, 12, (300, 4)), rng.integers(0, 400, (100, 4))])
+    assert np.allclose(fisher_exact_pvalues(*tables.T), scipy_pvalues(tables), rtol=1e-10, atol=1e-12)
+
+
+def test_fisher_exact_pvalues_of_ties_and_empty_margins():
+    # symmetric tables, whose two tails tie with the observed table, and tables with an empty row or column
+    tables = np.array([[3, 3, 3, 3], [5, 0, 0, 5], [0, 5, 5, 0], [2, 4, 4, 2], [1, 1, 1, 1], [10, 10, 10, 10],
+                       [0, 0, 3, 4], [3, 4, 0, 0], [0, 3, 0, 4], [3, 0, 4, 0], [0, 0, 0, 0], [0, 0, 0, 7]])
+    assert np.allclose(fisher_exact_pvalues(*tables.T), scipy_pvalues(tables), rtol=1e-10, atol=1e-12)
+    assert np.all(fisher_exact_pvalues(*tables[6:].T) == 1)
+
+
+def test_fisher_exact_pvalues_broadcast():
+    pvalues = fisher_exact_pvalues(np.arange(5), 3, 4, 6)
+    assert pvalues.shape == (5,)
+    assert np.allclose(pvalues, scipy_pvalues([(a, 3, 4, 6) for a in range(5)]), rtol=1e-10, atol=1e-12)
@@ -0,0 +1,49 @@
+import numpy as np
+import pandas as pd
+from clustr.store import configure_store
+from clustr.enrichment import get_enrichments, encode_label_runs
+from clustr.utils import get_arfs_prevalences, get_fischers_coefficients
+
+configure_store(enabled=False)
+
+
+def test_missing_labels_are_left_out():
+    codes, clusters = encode_label_runs([[2, np.nan, 1, 2], [0, 0, 1, np.nan]])
+    assert codes.tolist() == [[1, -1, 0, 1], [0, 0, 1, -1]]
+    assert clusters.tolist() == [[1, 2], [0, 1]]
+
+
+def test_enrichments_match_per_column_functions():
+    rng = np.random.default_rng(0)
+    n_rows, n_conditions = 300, 8
+    data_mat = (rng.random((n_rows, n_conditions)) < rng.uniform(0.05, 0.4, n_conditions)).astype(np.uint8)
+    label_matrix = rng.integers(0, 4, (3, n_rows)).astype(float)
+    label_matrix[2] = rng.integers(0, 2, n_rows)
+    label_matrix[1, :15] = np.nan
+    enrichments = get_enrichments(data_mat, label_matrix, 1)
+    conditions = [f'disease_{i}' for i in range(n_conditions)]
+    for run, labels in enumerate(label_matrix):
+        df = pd.DataFrame(data_mat.astype(np.int64), columns=conditions)
+        df['cluster'] = labels
+        df = df.dropna()
+        arfs, prevalences = get_arfs_prevalences(df, 'cluster', conditions)
+        pvalues, adj_pvalues = get_fischers_coefficients(df, 'cluster', conditions)
+        for i, cluster in enumerate(enrichments['clusters'][run]):
+            if np.isnan(cluster):
+                assert enrichments['sizes'][run, i] == 0 and np.isnan(enrichments['arfs'][run, i]).all()
+                continue
+            for name, expected in (('arfs', arfs), ('prevalences', prevalences), ('pvalues', pvalues),
+                                   ('adj_pvalues', adj_pvalues)):
+                assert np.allclose(enrichments[name][run, i], [expected[cluster][c] for c in conditions],
+                                   rtol=1e-9, atol=1e-12)
+
+
+def test_worker_pool_matches_one_process(monkeypatch):
+    rng = np.random.default_rng(1)
+    data_mat = (rng.random((1000, 6)) < 0.2).astype(np.uint8)
+    label_matrix = rng.integers(0, 5, (4, 1000))
+    expected = get_enrichments(data_mat, label_matrix, 1)
+    monkeypatch.setattr('clustr.enrichment.ENRICHMENT_CHUNK_ROWS', 150)
+    chunked = get_enrichments(data_mat, label_matrix, 3)
+    for name, values in expected.items():
+        assert np.array_equal(values, chunked[name], equal_nan=True)
@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+from clustr.hamming_index import HammingIndex
+from clustr.precision import configure_precision, get_precision
+
+
+@pytest.fixture(params=['float64', 'float32'])
+def precision(request):
+    previous = get_precision()
+    configure_precision(request.param)
+    yield request.param
+    configure_precision(previous)
+
+
+def brute_force_nearest(data_mat, centroids):
+    dists = (data_mat[:, np.newaxis, :] != centroids[np.newaxis, :, :]).sum(axis=2)
+    return np.argmin(dists, axis=1), dists.min(axis=1)
+
+
+def get_cohort(n_rows: int,
+               n_conditions: int,
+               n_distinct: int = None,
+               seed: int = 0):
+    """A random binary cohort; with n_distinct, its rows repeat a few distinct ones, as in sparse cohorts"""
+    rng = np.random.default_rng(seed)
+    if n_distinct is None:
+        return (rng.random((n_rows, n_conditions)) < 0.3).astype(np.uint8)
+    distinct = (rng.random((n_distinct, n_conditions)) < 0.2).astype(np.uint8)
+    return distinct[rng.integers(0, n_distinct, n_rows)]
+
+
+@pytest.mark.parametrize('n_distinct', [None, 40])
+@pytest.mark.parametrize('brute_force_k', [1, 1000])
+def test_query_matches_brute_force(precision, n_distinct, brute_force_k):
+    data_mat = get_cohort(2000, 13, n_distinct)
+    # centroids drawn from the rows, so that many rows equal a centroid, with duplicates among them
+    centroids = np.concatenate([data_mat[:50], data_mat[:5], get_cohort(20, 13, seed=1)])
+    labels, dists = HammingIndex(centroids, brute_force_k=brute_force_k).query(data_mat, chunk_rows=128)
+    expected_labels, expected_dists = brute_force_nearest(data_mat, centroids)
+    assert np.array_equal(labels, expected_labels)
+    assert np.array_equal(dists, expected_dists)
+
+
+def test_ties_go_to_the_first_centroid():
+    centroids = np.array([[1, 0, 0, 0], [0, 1, 0, 0], [1, 0, 0, 0]] * 12)
+    labels, dists = HammingIndex(centroids, brute_force_k=1).query(np.array([[0, 0, 0, 0], [1, 0, 0, 0]]))
+    assert labels.tolist() == [0, 0]
+    assert dists.tolist() == [1, 0]
@@ -0,0 +1,67 @@
+import numpy as np
+import pytest
+from clustr.kernels import configure_kernels, get_kernel_backend, e_step, m_step_sums, hamming_distances
+
+numba = pytest.importorskip('numba')
+
+
+def run_with_backend(backend: str,
+                     kernel,
+                     *args):
+    previous = get_kernel_backend()
+    configure_kernels(backend)
+    try:
+        return kernel(*args)
+    finally:
+        configure_kernels(previous)
+
+
+def get_mixture(dtype,
+                n_rows: int = 500,
+                n_conditions: int = 11,
+                n_components: int = 4,
+                seed: int = 0):
+    rng = np.random.default_rng(seed)
+    data = (rng.random((n_rows, n_conditions)) < 0.3).astype(dtype)
+    theta = rng.uniform(0.05, 0.95, (n_components, n_conditions))
+    weight = rng.dirichlet(np.ones(n_components))
+    return data, theta, weight
+
+
+@pytest.mark.parametrize('dtype, rtol', [(np.float64, 1e-10), (np.float32, 1e-5)])
+def test_numba_e_step_and_m_step_match_numpy(dtype, rtol):
+    data, theta, weight = get_mixture(dtype)
+    responsibility, log_likelihood = run_with_backend('numpy', e_step, data, theta, weight)
+    numba_responsibility, numba_log_likelihood = run_with_backend('numba', e_step, data, theta, weight)
+    assert numba_responsibility.dtype == responsibility.dtype == dtype
+    assert np.allclose(numba_responsibility, responsibility, rtol=rtol, atol=rtol)
+    assert np.isclose(numba_log_likelihood, log_likelihood, rtol=rtol)
+    for numba_sums, sums in zip(run_with_backend('numba', m_step_sums, data, responsibility),
+                                run_with_backend('numpy', m_step_sums, data, responsibility)):
+        assert numba_sums.dtype == sums.dtype == dtype
+        assert np.allclose(numba_sums, sums, rtol=rtol)
+
+
+def test_numba_m_step_sums_do_not_drift_in_float32():
+    n_rows = 2 ** 21
+    data = np.ones((n_rows, 1), dtype=np.float32)
+    responsibility = np.full((n_rows, 1), 0.3, dtype=np.float32)
+    previous_threads = numba.get_num_threads()
+    # one thread sums every row, as a single running sum
+    numba.set_num_threads(1)
+    try:
+        resp_sums, weighted_sums = run_with_backend('numba', m_step_sums, data, responsibility)
+    finally:
+        numba.set_num_threads(previous_threads)
+    expected = n_rows * float(np.float32(0.3))
+    assert np.isclose(resp_sums[0], expected, rtol=1e-6)
+    assert np.isclose(weighted_sums[0, 0], expected, rtol=1e-6)
+
+
+@pytest.mark.parametrize('dtype', [np.float64, np.float32])
+def test_numba_hamming_distances_match_numpy(dtype):
+    data_mat = (np.random.default_rng(0).random((150, 19)) < 0.3).astype(np.uint8)
+    dists = run_with_backend('numpy', hamming_distances, data_mat, dtype)
+    numba_dists = run_with_backend('numba', hamming_distances, data_mat, dtype)
+    assert numba_dists.dtype == dists.dtype == dtype
+    assert np.allclose(numba_dists, dists, rtol=0, atol=1e-6)
@@ -0,0 +1,88 @@
+from functools import partial
+import numpy as np
+import pandas as pd
+from clustr.kmodes_utils import update_kmodes, get_kmodes_counts, counts_to_modes, assign_to_modes, \
+    load_kmodes_state, fit_kmodes, fit_minibatch_kmodes, get_matrix_batches
+from clustr.utils import iter_data_chunks, prepare_data
+
+
+def get_separable_data(n_rows: int = 600,
+                       seed: int = 0):
+    """Rows drawn around three well separated binary modes, each condition flipped with probability 0.05"""
+    rng = np.random.default_rng(seed)
+    modes = np.zeros((3, 12), dtype=np.uint8)
+    for cluster in range(3):
+        modes[cluster, 4 * cluster:4 * cluster + 4] = 1
+    truth = rng.integers(0, 3, n_rows)
+    flips = rng.random((n_rows, 12)) < 0.05
+    return (modes[truth] ^ flips).astype(np.uint8), modes, truth
+
+
+def get_previous_state(data_mat,
+                       modes):
+    labels = assign_to_modes(data_mat, modes)
+    counts, sizes = get_kmodes_counts(data_mat, labels, len(modes))
+    return counts_to_modes(counts, sizes), counts, sizes
+
+
+def test_update_adds_the_new_rows_onto_the_previous_counts(tmp_path):
+    data_mat, modes, _ = get_separable_data()
+    update_rows = np.arange(len(data_mat)) >= 400
+    prev_state = get_previous_state(data_mat[~update_rows], modes)
+    centroids, labels = update_kmodes(data_mat, str(tmp_path), [f'disease_{i}' for i in range(12)], prev_state,
+                                      update_rows)
+    new_counts, new_sizes = get_kmodes_counts(data_mat[update_rows], labels[update_rows], len(modes))
+    assert np.array_equal(centroids, counts_to_modes(prev_state[1] + new_counts, prev_state[2] + new_sizes))
+    assert np.array_equal(centroids, modes)
+    assert np.array_equal(labels, assign_to_modes(data_mat, centroids))
+    assert np.array_equal(load_kmodes_state(str(tmp_path))[0], centroids)
+
+
+def test_update_without_new_rows_keeps_the_modes(tmp_path):
+    data_mat, modes, _ = get_separable_data()
+    prev_state = get_previous_state(data_mat, modes)
+    with np.errstate(all='raise'):
+        centroids, labels = update_kmodes(data_mat, str(tmp_path), [f'disease_{i}' for i in range(12)],
+                                          prev_state, np.zeros(len(data_mat), dtype=bool))
+    assert np.array_equal(centroids, prev_state[0])
+    assert np.array_equal(labels, assign_to_modes(data_mat, prev_state[0]))
+
+
+def get_separable_cohort(n_rows: int = 600):
+    data_mat, _, _ = get_separable_data(n_rows)
+    return pd.DataFrame(data_mat, columns=[f'disease_{i}' for i in range(12)],
+                        index=pd.Index([f'p{i}' for i in range(n_rows)], name='patient_id'))
+
+
+def test_minibatch_kmodes_finds_the_modes_of_kmodes(tmp_path):
+    df, mat, _, _, cgrps = prepare_data(get_separable_cohort())
+    (tmp_path / 'kmodes').mkdir()
+    (tmp_path / 'minibatch').mkdir()
+    kmodes, labels = fit_kmodes(mat, str(tmp_path / 'kmodes'), cgrps, 3, random_state=0)
+    centroids, labelled = fit_minibatch_kmodes(partial(get_matrix_batches, df, mat, cgrps, 64),
+                                               str(tmp_path / 'minibatch'), cgrps, 3, random_state=0)
+    # the same modes, up to the order of the clusters
+    assert sorted(map(tuple, centroids)) == sorted(map(tuple, kmodes.cluster_centroids_))
+    order = [next(i for i, mode in enumerate(kmodes.cluster_centroids_) if np.array_equal(mode, centroid))
+             for centroid in centroids]
+    assert np.array_equal(np.array(order)[labelled['kmodes_cluster_labels'].to_numpy()], labels)
+    assert labelled.index.equals(df.index)
+
+
+def test_streamed_batches_give_the_labels_of_batches_in_memory(tmp_path):
+    cohort = get_separable_cohort()
+    input_file = str(tmp_path / 'cohort.tsv')
+    cohort.to_csv(input_file, sep='\t')
+    # the rows in memory in the order they are streamed, as prepare_data shuffles each chunk
+    chunks = list(iter_data_chunks(input_file, 100))
+    df, mat, cgrps = pd.concat([chunk[0] for chunk in chunks]), np.concatenate([chunk[1] for chunk in chunks]), \
+        chunks[0][2]
+    (tmp_path / 'memory').mkdir()
+    (tmp_path / 'streamed').mkdir()
+    in_memory = fit_minibatch_kmodes(partial(get_matrix_batches, df, mat, cgrps, 100), str(tmp_path / 'memory'),
+                                     cgrps, 3, random_state=0)
+    streamed = fit_minibatch_kmodes(partial(iter_data_chunks, input_file, 100), str(tmp_path / 'streamed'),
+                                    cgrps, 3, random_state=0)
+    assert np.array_equal(streamed[0], in_memory[0])
+    pd.testing.assert_frame_equal(streamed[1], in_memory[1])
+    assert (tmp_path / 'streamed' / 'scores.json').read_text() == (tmp_path / 'memory' / 'scores.json').read_text()
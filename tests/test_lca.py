@@ -0,0 +1,97 @@
+import numpy as np
+from clustr.kernels import e_step
+from clustr.lca import LCA
+from clustr.sharded import write_shards
+from clustr.utils import get_checkpoint_key
+
+
+def get_binary_data(n_rows: int = 300,
+                    n_conditions: int = 6,
+                    seed: int = 0):
+    rng = np.random.default_rng(seed)
+    return (rng.random((n_rows, n_conditions)) < rng.uniform(0.1, 0.6, n_conditions)).astype(np.uint8)
+
+
+def write_em_checkpoint(data, checkpoint_file: str):
+    """Fits a few EM iterations and leaves their checkpoint behind, as an interrupted fit would"""
+    lca = LCA(n_components=3, max_iter=4, random_state=0, checkpoint_file=checkpoint_file)
+    lca.fit(data)
+    lca._save_checkpoint(3)
+    return lca
+
+
+def test_em_checkpoint_resumes_only_on_the_same_data(tmp_path):
+    data = get_binary_data()
+    checkpoint_file = str(tmp_path / 'lca_em_checkpoint.npz')
+    write_em_checkpoint(data, checkpoint_file)
+    lca = LCA(n_components=3, random_state=1, checkpoint_file=checkpoint_file)
+    assert lca._initialize(*data.shape, key=get_checkpoint_key(data.astype(np.float64))) == 4
+    assert lca._initialize(*data.shape, key=get_checkpoint_key(get_binary_data(seed=1).astype(np.float64))) == 0
+
+
+def test_em_checkpoint_of_other_data_is_ignored(tmp_path):
+    checkpoint_file = str(tmp_path / 'lca_em_checkpoint.npz')
+    stale = write_em_checkpoint(get_binary_data(seed=1), checkpoint_file)
+    data = get_binary_data(seed=2)
+    fresh = LCA(n_components=3, max_iter=1000, tol=1e-8, random_state=0)
+    fresh.fit(data)
+    for fit in ('fit', 'fit_shards'):
+        write_em_checkpoint(get_binary_data(seed=1), checkpoint_file)
+        lca = LCA(n_components=3, max_iter=1000, tol=1e-8, random_state=0, checkpoint_file=checkpoint_file)
+        if fit == 'fit':
+            lca.fit(data)
+        else:
+            lca.fit_shards(write_shards(data, str(tmp_path / 'shards'), 2))
+        assert np.allclose(lca.theta, fresh.theta) and len(lca.ll_) == len(fresh.ll_)
+        assert not np.allclose(lca.theta, stale.theta)
+
+
+def test_accelerated_fit_describes_its_final_parameters():
+    data = get_binary_data(n_rows=500, seed=3)
+    lca = LCA(n_components=3, max_iter=1000, tol=1e-6, random_state=0, accelerate=True)
+    lca.fit(data)
+    responsibility, log_likelihood = e_step(data.astype(np.float64), lca.theta, lca.weight)
+    assert np.allclose(lca.responsibility, responsibility)
+    assert np.isclose(lca.ll_[-1], log_likelihood)
+    assert np.isclose(lca.bic, np.log(len(data)) * (sum(lca.theta.shape) + len(lca.weight)) - 2.0 * log_likelihood)
+    # the parameters are those of an M-step from the stored sufficient statistics
+    assert np.allclose(lca.theta, lca.weighted_sum_ / lca.resp_sum_[:, np.newaxis])
+
+
+def test_partial_fit_reports_the_bic_of_all_rows():
+    data = get_binary_data(n_rows=510, seed=4)
+    lca = LCA(n_components=3, max_iter=1000, tol=1e-6, random_state=0)
+    lca.fit(data[:500])
+    lca.partial_fit(data[500:], data)
+    assert lca.n_rows_ == len(data)
+    _, log_likelihood = e_step(data.astype(np.float64), lca.theta, lca.weight)
+    assert np.isclose(lca.ll_[-1], log_likelihood)
+    assert np.isclose(lca.bic, np.log(len(data)) * (sum(lca.theta.shape) + len(lca.weight)) - 2.0 * log_likelihood)
+    # without the earlier rows, the log likelihood of the model is unknown
+    assert lca.partial_fit(data[500:]).bic is None
+
+
+def test_partial_fit_without_new_rows_keeps_the_model():
+    data = get_binary_data(n_rows=500, seed=4)
+    lca = LCA(n_components=3, max_iter=1000, tol=1e-6, random_state=0)
+    lca.fit(data)
+    theta, weight, bic = lca.theta.copy(), lca.weight.copy(), lca.bic
+    with np.errstate(all='raise'):
+        lca.partial_fit(data[:0], data)
+    assert np.array_equal(lca.theta, theta) and np.array_equal(lca.weight, weight)
+    assert lca.n_rows_ == len(data)
+    assert np.isclose(lca.bic, bic)
+
+
+def test_update_only_warns_when_k_differs(tmp_path, caplog):
+    import logging
+    from clustr.lca_utils import get_lca_clusters
+    data = get_binary_data(n_rows=500, seed=4)
+    lca = LCA(n_components=3, max_iter=1000, tol=1e-6, random_state=0)
+    lca.fit(data[:450])
+    update_rows = np.arange(len(data)) >= 450
+    with caplog.at_level(logging.WARNING):
+        model, labels = get_lca_clusters(data, str(tmp_path), 5, lca, update_rows)
+    assert 'k=5 is ignored' in caplog.text
+    assert model.n_components == 3 and len(labels) == len(data)
+    assert np.isfinite(model.bic)
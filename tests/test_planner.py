@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+from clustr.planner import configure_memory_limit, plan_job, estimate_job_memory
+
+
+@pytest.fixture
+def tight_memory():
+    """A budget which holds the distances of 200 rows, but not of the 2000 rows of the data"""
+    configure_memory_limit(estimate_job_memory('agg', 200, 8) / 2 ** 30)
+    yield
+    configure_memory_limit(None)
+
+
+def get_duplicated_rows(n_unique: int,
+                        n_rows: int = 2000,
+                        seed: int = 0):
+    rng = np.random.default_rng(seed)
+    unique_rows = np.unique((rng.random((4 * n_unique, 8)) < 0.5).astype(np.uint8), axis=0)[:n_unique]
+    return unique_rows[rng.integers(0, len(unique_rows), n_rows)]
+
+
+@pytest.mark.parametrize('linkage', ['single', 'complete'])
+def test_agg_clusters_distinct_rows_under_single_and_complete_linkage(tight_memory, linkage):
+    plan = plan_job('agg', get_duplicated_rows(50), linkage=linkage, n_clusters=10)
+    assert plan['strategy'] == 'deduplicated' and plan['fit_rows'] == 50
+
+
+def test_agg_keeps_duplicates_under_average_linkage(tight_memory):
+    plan = plan_job('agg', get_duplicated_rows(50), linkage='average', n_clusters=10)
+    assert plan['strategy'] == 'sampled'
+
+
+def test_agg_needs_as_many_distinct_rows_as_clusters(tight_memory):
+    plan = plan_job('agg', get_duplicated_rows(6), linkage='complete', n_clusters=10)
+    assert plan['strategy'] == 'sampled'
+
+
+def test_fits_planned_under_different_limits_share_their_stored_result(tmp_path, monkeypatch):
+    import clustr.store as store
+    from clustr.store import configure_store, get_store_settings, list_artifacts
+    from clustr.kmedoids_utils import fit_kmedoids
+    settings = get_store_settings()
+    configure_store(enabled=True, folder=str(tmp_path / 'store'))
+    monkeypatch.setattr(store, '_CODE_FINGERPRINT', None)
+    data_mat = (np.random.default_rng(0).random((100, 8)) < 0.4).astype(np.uint8)
+    # every row has a condition, so that its cosine distances are defined
+    data_mat[data_mat.sum(axis=1) == 0, 0] = 1
+    try:
+        for memory_limit in (1, 2):
+            configure_memory_limit(memory_limit)
+            plan = plan_job('kmedoids', data_mat)
+            assert plan['memory_limit'] == memory_limit * 2 ** 30
+            fit_kmedoids(data_mat, str(tmp_path), [f'disease_{i}' for i in range(8)], 3, plan, random_state=0)
+        assert len(list_artifacts('fit')) == 1
+    finally:
+        configure_memory_limit(None)
+        configure_store(*settings)
@@ -0,0 +1,18 @@
+import numpy as np
+import clustr.hier_agg_utils as hier_agg_utils
+from clustr.plotting import configure_plots, plots_enabled
+from clustr.hier_agg_utils import plot_dendrogram
+
+
+def test_no_plots_skips_the_dendrogram_linkage(tmp_path, monkeypatch):
+    def linkage(*args, **kwargs):
+        raise AssertionError('the linkage is computed with the plots disabled')
+
+    enabled = plots_enabled()
+    monkeypatch.setattr(hier_agg_utils.sch, 'linkage', linkage)
+    configure_plots(enabled=False)
+    try:
+        plot_dendrogram(np.eye(5, dtype=np.uint8), str(tmp_path))
+    finally:
+        configure_plots(enabled=enabled)
+    assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,62 @@
+import pandas as pd
+import pytest
+from clustr.readers import parse_filter, read_cohort, iter_cohort_chunks, get_filter_mask
+
+
+@pytest.fixture
+def cohort():
+    return pd.DataFrame({'id': ['p1', 'p2', 'p3', 'p4'],
+                         'zip': ['01', '02', '01', '10'],
+                         'age': [30, 45, 50, 70],
+                         'sex': ['F', 'M', 'F', 'M'],
+                         'disease_0': [1, 0, 1, 1],
+                         'disease_1': [0, 0, 1, 0]})
+
+
+@pytest.fixture(params=['tsv', 'parquet', 'feather'])
+def cohort_file(request, cohort, tmp_path):
+    if request.param != 'tsv':
+        pytest.importorskip('pyarrow')
+    filename = str(tmp_path / f'cohort.{request.param}')
+    if request.param == 'tsv':
+        cohort.to_csv(filename, sep='\t', index=False)
+    elif request.param == 'parquet':
+        cohort.to_parquet(filename, index=False)
+    else:
+        cohort.to_feather(filename)
+    return filename
+
+
+def test_parse_filter_keeps_the_values_as_written():
+    assert parse_filter('zip == 01') == ('zip', '==', '01')
+    assert parse_filter('age>=40') == ('age', '>=', '40')
+    assert parse_filter("region = 'north',east") == ('region', 'in', ['north', 'east'])
+    with pytest.raises(ValueError):
+        parse_filter('age >= 40,50')
+    with pytest.raises(ValueError):
+        parse_filter('age')
+
+
+@pytest.mark.parametrize('expression, expected', [('zip == 01', ['p1', 'p3']),
+                                                  ('zip = 01,10', ['p1', 'p3', 'p4']),
+                                                  ('age >= 45', ['p2', 'p3', 'p4']),
+                                                  ('age > 40.5', ['p2', 'p3', 'p4']),
+                                                  ('sex != F', ['p2', 'p4'])])
+def test_filters_match_the_same_rows_in_every_format(cohort_file, expression, expected):
+    filters = [parse_filter(expression)]
+    df = read_cohort(cohort_file, ['zip', 'age', 'sex'], filters)
+    assert list(df.index) == expected
+    assert list(df.columns) == ['disease_0', 'disease_1']
+    chunks = list(iter_cohort_chunks(cohort_file, 2, ['zip', 'age', 'sex'], filters))
+    assert [patient for chunk in chunks for patient in chunk.index] == expected
+
+
+def test_filter_values_which_do_not_fit_the_column_are_reported(cohort_file):
+    with pytest.raises(ValueError, match='age'):
+        read_cohort(cohort_file, ['zip', 'age', 'sex'], [parse_filter('age >= forty')])
+
+
+def test_subgroup_values_are_cast_to_the_loaded_columns(cohort):
+    df = cohort.set_index('id')
+    assert list(df[get_filter_mask(df, [('age', '==', 45), ('sex', 'in', ['M'])])].index) == ['p2']
+    assert list(df[get_filter_mask(df, [('age', '<', '50')])].index) == ['p1', 'p2']
@@ -0,0 +1,101 @@
+import json
+import numpy as np
+import pandas as pd
+import pytest
+import clustr.runner as runner
+from clustr.progress import configure_progress, get_metrics_file
+
+
+def test_failed_repetition_closes_its_progress(tmp_path, monkeypatch):
+    def fit_kmodes(*args, **kwargs):
+        raise RuntimeError('the fit failed')
+
+    metrics_file = str(tmp_path / 'metrics.jsonl')
+    previous = get_metrics_file()
+    configure_progress(bars=False, metrics_file=metrics_file)
+    monkeypatch.setattr(runner, 'fit_kmodes', fit_kmodes)
+    mat = np.eye(20, 4, dtype=np.uint8)
+    df = pd.DataFrame(mat, index=[f'p{i}' for i in range(20)])
+    try:
+        with pytest.raises(RuntimeError):
+            runner.run_kmodes(df, mat, list(df.columns), str(tmp_path / 'kmodes'), repetitions=3, kclusters=2)
+    finally:
+        configure_progress(metrics_file=previous)
+    with open(metrics_file) as infile:
+        records = [json.loads(line) for line in infile]
+    assert records[-1]['name'] == 'k-modes repetitions' and records[-1]['status'] == 'failed'
+
+
+def write_cohort(folder,
+                 n_rows: int = 120,
+                 n_conditions: int = 6):
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame((rng.random((n_rows, n_conditions)) < 0.3).astype(int),
+                      columns=[f'disease_{i}' for i in range(n_conditions)],
+                      index=pd.Index([f'p{i}' for i in range(n_rows)], name='patient_id'))
+    df['sex'] = np.where(np.arange(n_rows) % 2, 'F', 'M')
+    input_file = folder / 'cohort.tsv'
+    df.to_csv(input_file, sep='\t')
+    return str(input_file)
+
+
+def test_unknown_methods_are_rejected(tmp_path):
+    config_file = tmp_path / 'config.yaml'
+    config_file.write_text('infile: cohort.tsv\nmethods:\n  kmeans: {}\n')
+    with pytest.raises(ValueError, match='kmeans'):
+        runner.load_config(str(config_file))
+
+
+def test_jobs_cover_every_method_subgroup_and_coi():
+    config = {'methods': {'lca': {'kclusters': 3}, 'kmodes': None},
+              'subgroups': {'women': {'sex': 'F'}, 'men': {'sex': 'M'}},
+              'cois': [None, 'disease_0']}
+    jobs = runner.get_jobs(config)
+    assert len(jobs) == 8
+    assert ('lca', 'women', 'disease_0', 'women_no_disease_0', {'kclusters': 3}) in jobs
+    assert ('kmodes', 'men', None, 'men', {}) in jobs
+
+
+def test_workers_are_sized_by_the_planned_peak():
+    from clustr.planner import configure_memory_limit, estimate_job_memory
+    mat = (np.random.default_rng(0).random((2000, 8)) < 0.5).astype(np.uint8)
+    job = ('agg', None, None, None, {'linkage': 'average'})
+    configure_memory_limit(estimate_job_memory('agg', 200, 8) / 2 ** 30)
+    try:
+        peak = runner.get_job_peak(job, mat)
+    finally:
+        configure_memory_limit(None)
+    # the job is planned on a sample, which needs far less than all of its rows
+    assert peak <= estimate_job_memory('agg', 200, 8) < estimate_job_memory('agg', len(mat), 8)
+
+
+def test_run_writes_every_job_of_the_grid(tmp_path, monkeypatch):
+    from click.testing import CliRunner
+    from clustr.cli import cli
+    for results in ('LCA_RESULTS', 'KMODES_RESULTS'):
+        monkeypatch.setattr(runner, results, str(tmp_path / 'results' / results))
+    config_file = tmp_path / 'config.yaml'
+    config_file.write_text(f'''
+infile: {write_cohort(tmp_path)}
+metadata: [sex]
+subgroups:
+  women: {{sex: F}}
+  men: {{sex: M}}
+methods:
+  lca: {{kclusters: 2}}
+  kmodes: {{kclusters: 2}}
+plots: False
+''')
+    result = CliRunner().invoke(cli, ['-npb', 'run', str(config_file)])
+    assert result.exit_code == 0, result.output
+    for results, labels_file, labels_column in [('LCA_RESULTS', 'lca_cluster_labels.tsv.gz', 'lca_cluster_labels'),
+                                                ('KMODES_RESULTS', 'kmodes_cluster_labels.tsv.gz',
+                                                 'kmodes_cluster_labels')]:
+        for subgroup, sex in [('women', 'F'), ('men', 'M')]:
+            folder = tmp_path / 'results' / results / subgroup
+            assert (folder / 'plan.json').exists() and (folder / 'scores.json').exists()
+            labels = pd.read_csv(folder / labels_file, sep='\t', index_col=0)
+            # each subgroup is clustered on its own rows only
+            expected = [f'p{i}' for i in range(120) if (i % 2 == 1) == (sex == 'F')]
+            assert sorted(labels.index) == sorted(expected)
+            assert set(labels[labels_column]) <= {0, 1}
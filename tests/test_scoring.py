@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+from sklearn.metrics import silhouette_score, davies_bouldin_score, calinski_harabasz_score
+from clustr.kmodes_utils import get_kmodes_counts
+from clustr.precision import configure_precision, get_precision
+from clustr.scoring import get_scores, get_streamed_scores
+
+
+@pytest.fixture(params=['float64', 'float32'])
+def precision(request):
+    previous = get_precision()
+    configure_precision(request.param)
+    yield request.param
+    configure_precision(previous)
+
+
+def get_clustering(n_rows: int = 500,
+                   n_conditions: int = 9,
+                   k: int = 5,
+                   seed: int = 0):
+    rng = np.random.default_rng(seed)
+    return (rng.random((n_rows, n_conditions)) < 0.3).astype(np.uint8), rng.integers(0, k, n_rows)
+
+
+def test_scores_match_scikit_learn():
+    data_mat, labels = get_clustering()
+    scores = get_scores(data_mat, labels)
+    assert np.isclose(scores['silhouette'], silhouette_score(data_mat, labels, metric='hamming'), rtol=1e-10)
+    assert np.isclose(scores['davies_boulden'], davies_bouldin_score(data_mat, labels), rtol=1e-10)
+    assert np.isclose(scores['calinski_harabasz'], calinski_harabasz_score(data_mat, labels), rtol=1e-10)
+
+
+def test_streamed_scores_match_scores(precision):
+    data_mat, labels = get_clustering()
+    # the last cluster is empty, as a k-modes cluster may end up
+    counts, sizes = get_kmodes_counts(data_mat, labels, 6)
+    batches = [(data_mat[start:start + 64], labels[start:start + 64]) for start in range(0, len(data_mat), 64)]
+    streamed = get_streamed_scores(batches, sizes, counts)
+    expected = get_scores(data_mat, labels)
+    assert streamed.keys() == expected.keys()
+    for name, score in expected.items():
+        assert isinstance(streamed[name], float)
+        assert np.isclose(streamed[name], score, rtol=1e-12), name
@@ -0,0 +1,111 @@
+import numpy as np
+import pandas as pd
+import pytest
+import clustr.store as store
+from clustr.store import configure_store, get_store_settings, stored, list_artifacts, fingerprint
+
+CALLS = []
+
+
+@stored('enrichment')
+def count_calls(data_mat,
+                scale: int = 1):
+    CALLS.append(scale)
+    return data_mat.sum() * scale
+
+
+@stored('fit', seeds=('random_state',))
+def draw(n: int,
+         random_state: int = None):
+    CALLS.append(random_state)
+    return np.random.RandomState(random_state).random(n)
+
+
+@pytest.fixture
+def store_folder(tmp_path, monkeypatch):
+    settings = get_store_settings()
+    configure_store(enabled=True, folder=str(tmp_path))
+    monkeypatch.setattr(store, '_CODE_FINGERPRINT', None)
+    CALLS.clear()
+    yield tmp_path
+    configure_store(*settings)
+
+
+def test_store_is_off_by_default():
+    assert not get_store_settings()[0]
+
+
+def test_unchanged_inputs_are_returned_from_the_store(store_folder):
+    data_mat = np.eye(4, dtype=np.uint8)
+    assert count_calls(data_mat, 2) == 8
+    assert count_calls(data_mat.copy(), 2) == 8
+    assert CALLS == [2]
+    assert len(list_artifacts('enrichment')) == 1
+
+
+def test_changed_inputs_get_new_keys(store_folder):
+    data_mat = np.eye(4, dtype=np.uint8)
+    count_calls(data_mat)
+    count_calls(data_mat, 3)
+    data_mat[0, 1] = 1
+    count_calls(data_mat)
+    assert CALLS == [1, 3, 1]
+
+
+def test_changed_package_code_gets_new_keys(store_folder, tmp_path, monkeypatch):
+    data_mat = np.eye(4, dtype=np.uint8)
+    package = tmp_path / 'clustr'
+    package.mkdir()
+    (package / 'lca.py').write_text('x = 1\n')
+    monkeypatch.setattr(store, '__file__', str(package / 'store.py'))
+    count_calls(data_mat)
+    # an edit to any module of the package, not only to the stage itself
+    (package / 'lca.py').write_text('x = 2\n')
+    monkeypatch.setattr(store, '_CODE_FINGERPRINT', None)
+    count_calls(data_mat)
+    assert CALLS == [1, 1]
+
+
+def test_fingerprints_follow_contents():
+    df = pd.DataFrame({'a': [1, 0], 'b': [0, 1]}, index=['p1', 'p2'])
+    assert fingerprint(df) == fingerprint(df.copy())
+    assert fingerprint(df) != fingerprint(df.rename(index={'p2': 'p3'}))
+    assert fingerprint(np.zeros(3, dtype=np.uint8)) != fingerprint(np.zeros(3, dtype=np.int64))
+
+
+def test_unseeded_random_stages_are_not_stored(store_folder):
+    assert not np.array_equal(draw(5), draw(5))
+    assert np.array_equal(draw(5, 0), draw(5, 0))
+    assert CALLS == [None, None, 0]
+    assert len(list_artifacts('fit')) == 1
+
+
+def test_keys_follow_the_package_version_and_precision(store_folder, monkeypatch):
+    import importlib.metadata
+    from clustr.precision import configure_precision, get_precision
+    data_mat = np.eye(4, dtype=np.uint8)
+    count_calls(data_mat)
+    monkeypatch.setattr(importlib.metadata, 'version', lambda package: '99.0')
+    monkeypatch.setattr(store, '_CODE_FINGERPRINT', None)
+    count_calls(data_mat)
+    count_calls(data_mat)
+    previous = get_precision()
+    configure_precision('float32' if previous == 'float64' else 'float64')
+    try:
+        count_calls(data_mat)
+    finally:
+        configure_precision(previous)
+    assert CALLS == [1, 1, 1]
+
+
+def test_ignored_arguments_are_left_out_of_the_key(store_folder):
+    @stored('enrichment', ignore=('workers',))
+    def count_in_workers(data_mat,
+                         workers: int = 1):
+        CALLS.append(workers)
+        return data_mat.sum()
+
+    data_mat = np.eye(4, dtype=np.uint8)
+    count_in_workers(data_mat, 1)
+    count_in_workers(data_mat, 8)
+    assert CALLS == [1]
@@ -0,0 +1,40 @@
+import json
+import numpy as np
+import pytest
+from clustr.precision import configure_precision, get_precision
+from clustr.kmedoids_utils import calculate_kmedoids
+from clustr.kmodes_utils import calculate_kmodes
+from clustr.utils import write_checkpoint
+
+
+@pytest.fixture(params=['float64', 'float32'])
+def precision(request):
+    previous = get_precision()
+    configure_precision(request.param)
+    yield request.param
+    configure_precision(previous)
+
+
+def get_binary_data(n_rows: int = 120,
+                    n_conditions: int = 8,
+                    seed: int = 0):
+    rng = np.random.default_rng(seed)
+    return (rng.random((n_rows, n_conditions)) < 0.3).astype(np.uint8)
+
+
+@pytest.mark.parametrize('sweep', [calculate_kmedoids, calculate_kmodes])
+def test_sweep_checkpoints_are_written_at_every_precision(sweep, precision, tmp_path):
+    checkpoint_file = str(tmp_path / 'checkpoint.json')
+    cost, sil_scores = sweep(get_binary_data(), 2, 3, checkpoint_file=checkpoint_file)
+    with open(checkpoint_file) as infile:
+        results = json.load(infile)['results']
+    assert sorted(results) == ['2', '3']
+    assert all(isinstance(value, float) for value in list(cost.values()) + list(sil_scores.values()))
+    assert not (tmp_path / 'checkpoint.json.tmp').exists()
+
+
+def test_failed_checkpoint_leaves_no_temporary_file(tmp_path):
+    checkpoint_file = str(tmp_path / 'checkpoint.json')
+    with pytest.raises(TypeError):
+        write_checkpoint({2: {'cost': object()}}, checkpoint_file, 'key')
+    assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,130 @@
+import numpy as np
+import pandas as pd
+from matplotlib.cbook import boxplot_stats
+from clustr.utils import generate_contingency_table, get_morbidity_counts, get_count_box_stats, write_labels, \
+    join_labels, read_labels, get_bubble_heatmap_input, map_to_scale
+
+
+def get_labelled_cohort(n_rows: int = 200,
+                        n_conditions: int = 6,
+                        k: int = 4,
+                        seed: int = 0):
+    """A random binary cohort with a column of cluster labels"""
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame((rng.random((n_rows, n_conditions)) < 0.3).astype(int),
+                      columns=[f'disease_{i}' for i in range(n_conditions)])
+    df['cluster'] = rng.integers(0, k, n_rows)
+    return df
+
+
+def test_contingency_table_counts_every_patient_once():
+    df = get_labelled_cohort()
+    for cluster in range(4):
+        for condition in df.columns[:-1]:
+            table = generate_contingency_table(df, condition, 'cluster', cluster)
+            in_cluster = df['cluster'] == cluster
+            assert table.sum() == len(df)
+            assert table[0].sum() == in_cluster.sum()
+            assert table[:, 0].sum() == df[condition].sum()
+            assert table[1, 1] == ((~in_cluster) & (df[condition] == 0)).sum()
+
+
+def test_contingency_table_small_example():
+    df = pd.DataFrame({'disease_0': [1, 1, 0, 1, 0, 0, 0, 0],
+                       'cluster': [0, 0, 0, 1, 1, 1, 1, 1]})
+    table = generate_contingency_table(df, 'disease_0', 'cluster', 0)
+    assert table.tolist() == [[2, 1], [1, 4]]
+
+
+def get_morbidity_frame(seed: int = 0):
+    """Conditions per patient in a few clusters, with long tails so that the boxplots have outliers"""
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({'cluster': rng.integers(0, 4, 400),
+                         'tot_conditions': np.minimum(rng.geometric(0.35, 400) - 1, 14)})
+
+
+def test_morbidity_counts_match_the_value_counts_of_each_cluster():
+    df = get_morbidity_frame()
+    counts = get_morbidity_counts(df, 'cluster')
+    assert list(counts.index) == sorted(df['cluster'].unique())
+    assert list(counts.columns) == list(range(df['tot_conditions'].max() + 1))
+    for cluster, group in df.groupby('cluster'):
+        expected = group['tot_conditions'].value_counts().reindex(counts.columns, fill_value=0)
+        assert counts.loc[cluster].tolist() == expected.tolist()
+
+
+def test_count_box_stats_match_boxplot_stats_of_the_patients():
+    df = get_morbidity_frame(seed=1)
+    counts = get_morbidity_counts(df, 'cluster')
+    for cluster, group in df.groupby('cluster'):
+        stats = get_count_box_stats(counts.loc[cluster])
+        expected = boxplot_stats(group['tot_conditions'].to_numpy(), labels=[cluster])[0]
+        assert stats['label'] == expected['label']
+        for name in ('mean', 'iqr', 'q1', 'med', 'q3', 'whislo', 'whishi'):
+            assert np.isclose(stats[name], expected[name]), name
+        # repeated outliers are drawn once
+        assert np.array_equal(stats['fliers'], np.unique(expected['fliers']))
+
+
+def test_labels_files_rejoin_to_the_full_table_of_the_baseline(tmp_path):
+    df = get_labelled_cohort()
+    df.index = [f'p{i}' for i in range(len(df))]
+    df.index.name = 'patient_id'
+    conditions = df.drop(columns='cluster')
+    # the full table the commands wrote before, and the labels-only file they write now
+    full_file, labels_file = str(tmp_path / 'labels.tsv'), str(tmp_path / 'labels.tsv.gz')
+    df.to_csv(full_file, sep='\t')
+    write_labels(df[['cluster']], labels_file)
+    baseline = pd.read_csv(full_file, sep='\t', index_col=0)
+    pd.testing.assert_frame_equal(join_labels(conditions, labels_file), baseline)
+    # both formats are read alike
+    pd.testing.assert_series_equal(read_labels(labels_file, 'cluster'), baseline['cluster'])
+    pd.testing.assert_series_equal(read_labels(full_file, 'cluster'), baseline['cluster'])
+    # patients without labels get NaN
+    joined = join_labels(pd.concat([conditions, conditions.iloc[:1].rename(index={'p0': 'new'})]), labels_file)
+    assert np.isnan(joined.loc['new', 'cluster'])
+
+
+def loop_bubble_heatmap_input(values_dict,
+                              pvalue_dict,
+                              alpha: float = 0.05,
+                              arf_scaling=False):
+    """get_bubble_heatmap_input as it was before it was vectorized (with DataFrame.map, applymap's new name)"""
+    heatmap_data = pd.DataFrame(values_dict)
+    heatmap_masks = {key: dict() for key in values_dict.keys()}
+    for cluster, val in values_dict.items():
+        for condition in val:
+            heatmap_masks[cluster][condition] = pvalue_dict[cluster][condition] >= alpha
+    heatmap_masks = pd.DataFrame(heatmap_masks)
+    true_indices = heatmap_masks.all(axis=1)
+    true_indices = list(true_indices.index[true_indices])
+    heatmap_data.drop(true_indices, inplace=True)
+    heatmap_masks.drop(true_indices, inplace=True)
+    if arf_scaling:
+        heatmap_data = heatmap_data.map(map_to_scale)
+    result_df = heatmap_data.where(~heatmap_masks, np.nan)
+    flattened_df = pd.melt(result_df.reset_index(), id_vars=['index'], var_name='cluster', value_name='values')
+    flattened_df.rename(columns={'index': 'condition'}, inplace=True)
+    flattened_df['abs_values'] = flattened_df['values'].map(lambda x: abs(x))
+    flattened_df['overrep'] = flattened_df['values'].map(lambda x: 1 if x > 0 else 0)
+    return flattened_df
+
+
+def test_bubble_heatmap_input_matches_the_loops():
+    rng = np.random.default_rng(0)
+    conditions, clusters = [f'disease_{i}' for i in range(12)], [0, 1, 2, 3]
+    values = rng.uniform(0.2, 3.0, (12, 4))
+    pvalues = rng.uniform(0, 0.1, (12, 4))
+    # a condition which is significant in no cluster is dropped
+    pvalues[3] = 0.5
+    values_dict = {cluster: dict(zip(conditions, values[:, j])) for j, cluster in enumerate(clusters)}
+    pvalue_dict = {cluster: dict(zip(conditions, pvalues[:, j])) for j, cluster in enumerate(clusters)}
+    for arf_scaling in (False, True):
+        expected = loop_bubble_heatmap_input(values_dict, pvalue_dict, 0.05, arf_scaling)
+        assert 'disease_3' not in set(expected['condition'])
+        for result in (get_bubble_heatmap_input(values_dict, pvalue_dict, 0.05, arf_scaling),
+                       get_bubble_heatmap_input(pd.DataFrame(values_dict), pd.DataFrame(pvalue_dict), 0.05,
+                                                arf_scaling),
+                       get_bubble_heatmap_input(values, pvalues, 0.05, arf_scaling, conditions, clusters)):
+            # melt leaves the cluster names as objects, where they now keep their own dtype
+            pd.testing.assert_frame_equal(result, expected, check_dtype=False)